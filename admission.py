@@ -0,0 +1,164 @@
+"""
+Admission control for prediction and training requests.
+
+Prediction and training requests run in separate thread pools instead of the
+threadpool FastAPI shares between all endpoints, so a burst of trainings
+cannot take the threads /predict needs. A pool takes at most
+workers + queue size requests at a time, further requests are rejected right
+away with 503. A model that already has its maximum number of requests in a
+pool gets 429. Both come with a Retry-After header. A request for several
+models takes one place in the pool and counts against the limit of each of
+its models.
+
+The pools are configured with environment variables, e.g. for the prediction
+pool PREDICTION_WORKERS, PREDICTION_QUEUE_SIZE and PREDICTION_PER_MODEL.
+"""
+import asyncio
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Union
+
+ModelIds = Union[str, List[str]]
+
+# All pools by name, for the queue metrics.
+pools = {}
+
+
+def distinct_model_ids(model_ids: ModelIds) -> List[str]:
+    """The models of a request for one model ID or a list of them."""
+    if isinstance(model_ids, str):
+        return [model_ids]
+    return sorted(set(model_ids))
+
+
+class WorkPool:
+    """
+    A bounded thread pool for one class of work.
+
+    :param name: The name of the pool in the metrics and thread names.
+    :param workers: The number of threads.
+    :param queue_size: How many requests may wait for a thread.
+    :param per_model: How many requests of one model may be in the pool.
+    """
+
+    def __init__(self, name: str, workers: int, queue_size: int, per_model: int):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.per_model = per_model
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=name
+        )
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.running = 0
+        self.max_queued = 0
+        self.model_in_flight = {}
+        self.counts = {
+            "admitted": 0,
+            "completed": 0,
+            "rejected_full": 0,
+            "rejected_model": 0,
+        }
+
+    def admit(self, model_ids: ModelIds):
+        """
+        Take a place in the pool or raise a 503 or 429 HTTPException.
+
+        :param model_ids: The model ID of the request, or a list of them.
+        """
+        model_ids = distinct_model_ids(model_ids)
+        with self.lock:
+            if self.in_flight >= self.workers + self.queue_size:
+                self.counts["rejected_full"] += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail="The {} pool is full. Please try again later.".format(
+                        self.name
+                    ),
+                    headers={"Retry-After": "1"},
+                )
+            # All models are checked before any of them is counted.
+            for model_id in model_ids:
+                if self.model_in_flight.get(model_id, 0) >= self.per_model:
+                    self.counts["rejected_model"] += 1
+                    raise HTTPException(
+                        status_code=429,
+                        detail='Too many {} requests for model ID "{}".'
+                        " Please try again later.".format(self.name, model_id),
+                        headers={"Retry-After": "1"},
+                    )
+            self.in_flight += 1
+            for model_id in model_ids:
+                self.model_in_flight[model_id] = self.model_in_flight.get(model_id, 0) + 1
+            self.max_queued = max(self.max_queued, self.in_flight - self.running)
+            self.counts["admitted"] += 1
+
+    def release(self, model_ids: ModelIds):
+        with self.lock:
+            self.in_flight -= 1
+            for model_id in distinct_model_ids(model_ids):
+                self.model_in_flight[model_id] -= 1
+                if not self.model_in_flight[model_id]:
+                    del self.model_in_flight[model_id]
+            self.counts["completed"] += 1
+
+    def _call(self, func: Callable, args: tuple):
+        with self.lock:
+            self.running += 1
+        try:
+            return func(*args)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    async def run(self, model_ids: ModelIds, func: Callable, *args):
+        """
+        Run func(*args) in the pool once there is a free thread.
+
+        :param model_ids: The model the request is for, or a list of models.
+        :return: The result of func.
+        """
+        self.admit(model_ids)
+        try:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, self._call, func, args)
+        finally:
+            self.release(model_ids)
+
+    def metrics(self) -> Dict:
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "per_model": self.per_model,
+                "running": self.running,
+                "queued": self.in_flight - self.running,
+                "max_queued": self.max_queued,
+                "models": dict(self.model_in_flight),
+                **self.counts,
+            }
+
+
+def pool_from_env(name: str, workers: int, queue_size: int, per_model: int) -> WorkPool:
+    """Set up a pool, the arguments are defaults for the environment variables."""
+    prefix = name.upper()
+    pool = WorkPool(
+        name,
+        workers=int(os.environ.get(prefix + "_WORKERS", workers)),
+        queue_size=int(os.environ.get(prefix + "_QUEUE_SIZE", queue_size)),
+        per_model=int(os.environ.get(prefix + "_PER_MODEL", per_model)),
+    )
+    pools[name] = pool
+    return pool
+
+
+prediction_pool = pool_from_env("prediction", workers=8, queue_size=64, per_model=64)
+# Trainings of the same model would overwrite each other's results.
+training_pool = pool_from_env("training", workers=2, queue_size=4, per_model=1)
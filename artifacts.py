@@ -0,0 +1,104 @@
+"""
+The artifacts of a trained model, stored as one file.
+
+A trained model is stored as a single ONNX file, <model ID>.onnx in the ONNX
+model directory. Its metadata carries everything else that belongs to the
+training: the model columns, the bag of words of a model trained from
+answers, the training metrics and a version. The file is written under a
+temporary name and renamed over the previous version, so a reader sees
+either the old or the new model, never a partial file or the bag of words of
+another training.
+
+The bag of words and the metrics are also written as JSON files to the BOW
+model and metrics directories, for inspection and for the models that were
+stored before their bag of words was part of the ONNX file.
+"""
+import json
+import os
+import tempfile
+import time
+
+from typing import Dict
+from typing import List
+from typing import Optional
+
+MODEL_COLUMNS = "model_columns"
+MODEL_VERSION = "model_version"
+BOW = "bow"
+METRICS = "metrics"
+
+
+def new_version() -> str:
+    """A version that sorts after the versions of earlier trainings."""
+    return str(time.time_ns())
+
+
+def write_atomic(path: str, data: bytes):
+    """
+    Replace a file with data in one rename.
+
+    The data is written to a temporary file in the same directory and
+    flushed to disk before it is renamed over path.
+    """
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix="." + os.path.basename(path) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def write_json_atomic(path: str, value, **kwargs):
+    write_atomic(path, json.dumps(value, **kwargs).encode())
+
+
+def bundle(
+    onnx_model,
+    model_columns: List[str],
+    metrics: Dict,
+    bow_state: Optional[Dict] = None,
+    version: str = None,
+) -> bytes:
+    """
+    Add the artifacts of a training to the metadata of a converted model.
+
+    :param onnx_model: The ONNX ModelProto of the trained model.
+    :param bow_state: The state of the BOW extractor, if the model uses one.
+    :return: The serialized model.
+    """
+    # The metadata_props attribute only allows strings, so the lists and
+    # dictionaries are converted.
+    metadata = {
+        MODEL_COLUMNS: " ".join(model_columns),
+        MODEL_VERSION: version or new_version(),
+        METRICS: json.dumps(metrics),
+    }
+    if bow_state is not None:
+        metadata[BOW] = json.dumps(bow_state)
+    for key, value in metadata.items():
+        new_meta = onnx_model.metadata_props.add()
+        new_meta.key = key
+        new_meta.value = value
+    return onnx_model.SerializeToString()
+
+
+def add_bow(model_bytes: bytes, bow_state: Dict) -> bytes:
+    """
+    Add the bag of words to a serialized model that was stored before it was
+    part of the model file, so the model can be moved as one file.
+    """
+    # onnx is a dependency of skl2onnx, it is only needed here.
+    import onnx
+
+    onnx_model = onnx.load_model_from_string(model_bytes)
+    new_meta = onnx_model.metadata_props.add()
+    new_meta.key = BOW
+    new_meta.value = json.dumps(bow_state)
+    return onnx_model.SerializeToString()
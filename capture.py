@@ -0,0 +1,137 @@
+"""
+Opt-in capture of the requests the service gets, for replay with replay.py.
+
+Set TRAFFIC_CAPTURE_FILE to a JSONL file to append one record per request to
+/predict, /predictFromAnswers, /predictFromModels and /addInstance:
+
+    {"time": 1600000000.0, "endpoint": "/predict", "body": {...}}
+
+By default (TRAFFIC_CAPTURE_REDACT=hash) the learner data in the bodies (the
+CAS, the answer and the learner ID) is replaced by an HMAC-SHA256 and its
+length. Everything else (model IDs, items, labels, the number of instances)
+is kept, so that replay.py can rebuild requests of the same shape.
+TRAFFIC_CAPTURE_REDACT=none records the bodies as they are.
+
+The HMAC key is TRAFFIC_CAPTURE_KEY, or a random key of the process if it is
+not set. A plain hash of a short answer or a learner ID could be looked up
+in a dictionary of likely values; without the key it can not. Equal values
+get equal HMACs under the same key, so repeated requests stay repeated.
+
+The records are redacted, encoded and written by a thread, so that the
+endpoints only put the request into a queue. If the writer falls behind by
+more than MAX_PENDING records, further records are dropped and counted.
+"""
+import hashlib
+import hmac
+import json
+import os
+import queue
+import threading
+import time
+
+from pydantic import BaseModel
+from typing import Optional
+
+HASH = "hash"
+NONE = "none"
+REDACTED_FIELDS = ["cas", "answer", "learnerId"]
+MAX_PENDING = 10000
+
+
+def redact_value(value: str, key: bytes) -> dict:
+    return {
+        "hmac": hmac.new(key, value.encode(), hashlib.sha256).hexdigest(),
+        "length": len(value),
+    }
+
+
+def redact(body, key: bytes):
+    """Replace the learner data in a request body, recursively."""
+    if isinstance(body, dict):
+        return {
+            name: redact_value(value, key)
+            if name in REDACTED_FIELDS and isinstance(value, str)
+            else redact(value, key)
+            for name, value in body.items()
+        }
+    if isinstance(body, list):
+        return [redact(value, key) for value in body]
+    return body
+
+
+class TrafficCapture:
+    """
+    Append request records to a JSONL file.
+
+    :param path: The capture file.
+    :param redaction: HASH or NONE.
+    :param key: The HMAC key, by default TRAFFIC_CAPTURE_KEY or a random key.
+    """
+
+    def __init__(self, path: str, redaction: str = HASH, key: bytes = None):
+        if redaction not in (HASH, NONE):
+            raise ValueError("Unknown redaction {}".format(redaction))
+        self.path = path
+        self.redaction = redaction
+        if key is None:
+            key = os.environ.get("TRAFFIC_CAPTURE_KEY", "").encode() or os.urandom(32)
+        self.key = key
+        self.out_file = open(path, "a")
+        self.pending = queue.Queue(MAX_PENDING)
+        # The records that were dropped because the queue was full.
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.write_records, daemon=True)
+        self.writer.start()
+
+    def record(self, endpoint: str, req: BaseModel):
+        try:
+            self.pending.put_nowait((time.time(), endpoint, req))
+        except queue.Full:
+            self.dropped += 1
+
+    def write_records(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            record_time, endpoint, req = item
+            body = req.dict()
+            if self.redaction == HASH:
+                body = redact(body, self.key)
+            line = json.dumps({"time": record_time, "endpoint": endpoint, "body": body})
+            self.out_file.write(line + "\n")
+            # The file is flushed when the queue is drained.
+            if self.pending.empty():
+                self.out_file.flush()
+        self.out_file.close()
+
+    def close(self):
+        """Write the pending records and close the file."""
+        self.pending.put(None)
+        self.writer.join()
+        if self.dropped:
+            print("{} requests were not captured.".format(self.dropped))
+
+
+# The capture of this process, None if requests are not captured.
+traffic_capture = None  # type: Optional[TrafficCapture]
+
+
+def configure(path: Optional[str], redaction: str = HASH):
+    """Start capturing to path, or stop capturing if path is None."""
+    global traffic_capture
+    if traffic_capture is not None:
+        traffic_capture.close()
+    traffic_capture = TrafficCapture(path, redaction) if path else None
+
+
+def record(endpoint: str, req: BaseModel):
+    """Capture a request if capturing is on."""
+    if traffic_capture is not None:
+        traffic_capture.record(endpoint, req)
+
+
+configure(
+    os.environ.get("TRAFFIC_CAPTURE_FILE"),
+    os.environ.get("TRAFFIC_CAPTURE_REDACT", HASH),
+)
@@ -0,0 +1,408 @@
+"""
+Selective loading of CASes from XMI for the prediction path.
+
+load_cas_from_xmi builds feature structures for every annotation of every
+view, although the feature extractors only read a few views and types (the
+word embeddings alone make up most of a typical ISAAC CAS). The
+SelectiveCasXmiDeserializer parses the XMI incrementally like cassis, but
+only materializes the feature structures of the requested types, the ones
+they reference and the members of the requested views. Elements of types
+that can not be reached from the requested types are dropped as soon as
+they are parsed.
+
+Which views and types FeatureExtraction needs depends on the extractors of
+the features package, so SelectiveCasLoader records what the extractors
+actually select. The first CAS is parsed fully, later CASes selectively. If
+the extractors ever select a view or type that was not loaded, the CAS is
+parsed fully again and the recorded usage is extended, so the features are
+always the ones of the full parse.
+"""
+from collections import defaultdict
+from collections import namedtuple
+from io import BytesIO
+from typing import Iterable
+from typing import Optional
+from typing import Set
+
+from cassis.cas import Cas
+from cassis.typesystem import TypeSystem
+from cassis.xmi import CasXmiDeserializer
+from cassis.xmi import ProtoView
+from cassis.xmi import load_cas_from_xmi
+from lxml import etree
+
+NS_XMI = "{http://www.omg.org/XMI}"
+NS_CAS = "{http:///uima/cas.ecore}"
+
+TAG_XMI = NS_XMI + "XMI"
+TAG_CAS_SOFA = NS_CAS + "Sofa"
+TAG_CAS_VIEW = NS_CAS + "View"
+
+TOP_TYPE_NAME = "uima.cas.TOP"
+NULL_TYPE_NAME = "uima.cas.NULL"
+
+# A parsed element whose feature structure is only built when it is needed.
+# It provides what CasXmiDeserializer._parse_feature_structure reads from an
+# lxml element.
+_RawElement = namedtuple("_RawElement", ["tag", "attrib"])
+
+
+def _type_name(tag: str) -> str:
+    # Same mapping from element tags to type names as in cassis.
+    return tag[9:].replace("/", ".").replace("ecore}", "").strip()
+
+
+def _with_subtypes(typesystem: TypeSystem, type_name: str) -> Set[str]:
+    result = set()
+    open_list = [typesystem.get_type(type_name)]
+    while open_list:
+        t = open_list.pop()
+        if t.name not in result:
+            result.add(t.name)
+            open_list.extend(t.children)
+    return result
+
+
+def reachable_types(typesystem: TypeSystem, type_names: Iterable[str]) -> Set[str]:
+    """
+    Find all types whose feature structures can be referenced from the
+    given types.
+
+    :param typesystem: The type system of the CAS.
+    :param type_names: The types that are selected by the extractors.
+    :return: The given types, their subtypes and all types they can
+        reference, directly or indirectly. None if they can reference
+        feature structures of any type.
+    """
+    result = set()
+    open_list = list(type_names)
+    while open_list:
+        type_name = open_list.pop()
+        if type_name == TOP_TYPE_NAME:
+            return None
+        if type_name in result:
+            continue
+        new_types = _with_subtypes(typesystem, type_name) - result
+        result.update(new_types)
+        for name in new_types:
+            for feature in typesystem.get_type(name).all_features:
+                range_name = feature.rangeTypeName
+                if (
+                    feature.name == "sofa"
+                    or typesystem.is_primitive(range_name)
+                    or typesystem.is_primitive_collection(range_name)
+                ):
+                    continue
+                open_list.append(range_name)
+                if typesystem.is_collection(name, feature):
+                    open_list.append(feature.elementType or TOP_TYPE_NAME)
+    return result
+
+
+class SelectiveCasXmiDeserializer(CasXmiDeserializer):
+    def deserialize(
+        self,
+        source,
+        typesystem: TypeSystem,
+        views: Optional[Set[str]] = None,
+        types: Optional[Set[str]] = None,
+    ) -> Cas:
+        """
+        Load a CAS with only the given views and types.
+
+        :param source: A file-like object with the XMI.
+        :param typesystem: The type system that belongs to this CAS.
+        :param views: The names of the views whose members are added to the
+            CAS. All views are kept if this is None.
+        :param types: The types whose feature structures are needed. All types
+            are kept if this is None.
+        :return: The deserialized CAS. All sofas of the XMI are present, but
+            the views only contain the members of the needed types.
+        """
+        if types is None:
+            kept = None
+            reachable = None
+        else:
+            kept = set()
+            for type_name in types:
+                kept |= _with_subtypes(typesystem, type_name)
+            reachable = reachable_types(typesystem, kept | {NULL_TYPE_NAME})
+
+        OUTSIDE_FS = 1
+        INSIDE_FS = 2
+        INSIDE_ARRAY = 3
+
+        sofas = []
+        proto_views = {}
+        # The needed elements are kept as attribute dictionaries first. Their
+        # feature structures are built when they are members of a needed view
+        # or referenced by another built feature structure.
+        raw_elements = {}
+        children = defaultdict(list)
+
+        context = etree.iterparse(source, events=("start", "end"))
+
+        state = OUTSIDE_FS
+
+        for event, elem in context:
+            if elem.tag == TAG_XMI:
+                pass
+            elif elem.tag == TAG_CAS_SOFA:
+                if event == "end":
+                    sofas.append(self._parse_sofa(elem))
+            elif elem.tag == TAG_CAS_VIEW:
+                if event == "end":
+                    proto_view = self._parse_view(elem)
+                    proto_views[proto_view.sofa] = proto_view
+            elif event == "start":
+                if state == OUTSIDE_FS:
+                    state = INSIDE_FS
+                elif state == INSIDE_FS:
+                    state = INSIDE_ARRAY
+                else:
+                    raise RuntimeError("Invalid state transition: [{0}] 'start'".format(state))
+            elif state == INSIDE_FS:
+                state = OUTSIDE_FS
+                type_name = _type_name(elem.tag)
+                if reachable is None or type_name in reachable:
+                    attributes = dict(elem.attrib)
+                    xmi_id = int(attributes[NS_XMI + "id"])
+                    raw_elements[xmi_id] = (
+                        type_name,
+                        _RawElement(elem.tag, attributes),
+                        dict(children),
+                    )
+                children.clear()
+            elif state == INSIDE_ARRAY:
+                children[elem.tag].append(elem.text)
+                state = INSIDE_FS
+            else:
+                raise RuntimeError("Invalid state transition: [{0}] 'end'".format(state))
+
+            # Free already processed elements from memory
+            if event == "end":
+                self._clear_elem(elem)
+
+        members = []
+        for sofa in sofas:
+            if views is None or sofa.sofaID in views:
+                proto_view = proto_views.get(sofa.xmiID, ProtoView(sofa.xmiID))
+                members.extend(
+                    member_id
+                    for member_id in proto_view.members
+                    if member_id in raw_elements
+                    and (kept is None or raw_elements[member_id][0] in kept)
+                )
+        feature_structures, referenced_fs = self._build(typesystem, members, raw_elements)
+
+        fs_in_views = set()
+        cas = Cas(typesystem=typesystem)
+        for sofa in sofas:
+            if sofa.sofaID == "_InitialView":
+                view = cas.get_view("_InitialView")
+            else:
+                view = cas.create_view(sofa.sofaID)
+
+            view.sofa_string = sofa.sofaString
+            view.sofa_mime = sofa.mimeType
+
+            # Feature structures of other views that were built because they
+            # are referenced are added to their views as well.
+            proto_view = proto_views.get(sofa.xmiID, ProtoView(sofa.xmiID))
+            for member_id in proto_view.members:
+                annotation = feature_structures.get(member_id)
+                if annotation is None:
+                    continue
+                view.add_annotation(annotation)
+                fs_in_views.add(annotation.xmiID)
+
+        # As in cassis, feature structures that are only referenced get new IDs.
+        referenced_fs = referenced_fs.difference(fs_in_views)
+        referenced_fs.discard(0)
+        for target_id in sorted(referenced_fs):
+            feature_structures[target_id].xmiID = cas._get_next_xmi_id()
+
+        return cas
+
+    def _build(self, typesystem, members, raw_elements):
+        """
+        Build the feature structures of the view members and of everything
+        they reference, and replace reference IDs by feature structures like
+        cassis does.
+
+        :return: The built feature structures by ID and the IDs of all
+            referenced feature structures.
+        """
+        feature_structures = {}
+        referenced_fs = set()
+        open_list = []
+
+        def build(xmi_id):
+            if xmi_id not in feature_structures:
+                _, elem, children = raw_elements[xmi_id]
+                fs = self._parse_feature_structure(typesystem, elem, children)
+                feature_structures[xmi_id] = fs
+                open_list.append(fs)
+            return feature_structures[xmi_id]
+
+        def target(target_id):
+            referenced_fs.add(target_id)
+            return build(target_id)
+
+        for member_id in members:
+            build(member_id)
+
+        while open_list:
+            fs = open_list.pop()
+            t = typesystem.get_type(fs.type)
+
+            for feature in t.all_features:
+                feature_name = feature.name
+
+                if feature_name == "sofa":
+                    continue
+
+                if (
+                    typesystem.is_primitive(feature.rangeTypeName)
+                    or typesystem.is_primitive_collection(feature.rangeTypeName)
+                    or typesystem.is_primitive_collection(fs.type)
+                ):
+                    continue
+
+                value = getattr(fs, feature_name)
+                if value is None:
+                    continue
+
+                if typesystem.is_collection(fs.type, feature):
+                    setattr(fs, feature_name, [target(int(ref)) for ref in value.split()])
+                else:
+                    setattr(fs, feature_name, target(int(value)))
+
+        return feature_structures, referenced_fs
+
+
+def load_selected_cas_from_xmi(
+    source, typesystem: TypeSystem, views: Set[str] = None, types: Set[str] = None
+) -> Cas:
+    """
+    Load a CAS from XMI with only the given views and types.
+
+    :param source: A file-like object or a string with the XMI.
+    :param typesystem: The type system that belongs to this CAS.
+    :param views: The names of the views to fill, all views if None.
+    :param types: The names of the needed types, all types if None.
+    """
+    if isinstance(source, str):
+        source = BytesIO(source.encode("utf-8"))
+    return SelectiveCasXmiDeserializer().deserialize(source, typesystem, views, types)
+
+
+class CasUsage:
+    """The views and types the feature extractors selected from a CAS."""
+
+    def __init__(self):
+        self.views = set()
+        self.types = set()
+        # Set if an extractor iterated over all views or all annotations.
+        self.everything = False
+
+    def covered_by(self, other: "CasUsage") -> bool:
+        if self.everything:
+            return other.everything
+        return other.everything or (
+            self.views <= other.views and self.types <= other.types
+        )
+
+    def update(self, other: "CasUsage"):
+        self.views |= other.views
+        self.types |= other.types
+        self.everything = self.everything or other.everything
+
+
+class RecordingCas(Cas):
+    """A view on a CAS that records which views and types are selected."""
+
+    def __init__(self, cas: Cas, usage: CasUsage):
+        super().__init__(cas.typesystem)
+        self._views = cas._views
+        self._sofas = cas._sofas
+        self._current_view = cas._current_view
+        self._sofa_num_generator = cas._sofa_num_generator
+        self._xmi_id_generator = cas._xmi_id_generator
+        self.usage = usage
+
+    def _copy(self) -> Cas:
+        return RecordingCas(self, self.usage)
+
+    def get_view(self, name: str) -> Cas:
+        self.usage.views.add(name)
+        return super().get_view(name)
+
+    @property
+    def views(self):
+        self.usage.everything = True
+        return super().views
+
+    def select_all(self):
+        self.usage.everything = True
+        return super().select_all()
+
+    def _get_feature_structures(self, type_name):
+        self.usage.views.add(self._current_view.sofa.sofaID)
+        self.usage.types.add(type_name)
+        return super()._get_feature_structures(type_name)
+
+    def _get_feature_structures_in_range(self, type_name, begin, end):
+        self.usage.views.add(self._current_view.sofa.sofaID)
+        self.usage.types.add(type_name)
+        return super()._get_feature_structures_in_range(type_name, begin, end)
+
+
+class SelectiveCasLoader:
+    """
+    Load CASes and extract their features with a selective XMI parse.
+
+    The loader learns the views and types that the extraction needs from the
+    CASes it extracts. It is safe to share between requests: the recorded
+    usage only grows.
+    """
+
+    def __init__(self, typesystem: TypeSystem, extraction):
+        self.typesystem = typesystem
+        self.extraction = extraction
+        self.usage = None
+
+    def _extract(self, cas: Cas):
+        usage = CasUsage()
+        feats = self.extraction.from_cases([RecordingCas(cas, usage)])
+        return feats, usage
+
+    def _extract_full(self, xmi_bytes: bytes):
+        cas = load_cas_from_xmi(BytesIO(xmi_bytes), typesystem=self.typesystem)
+        feats, usage = self._extract(cas)
+        # The recorded usage is replaced and never changed in place, because
+        # other requests may be reading it.
+        if self.usage is not None:
+            usage.update(self.usage)
+        self.usage = usage
+        return feats
+
+    def extract(self, xmi_bytes: bytes):
+        """
+        Extract the features of a CAS given as XMI bytes.
+
+        :param xmi_bytes: The XMI of the CAS.
+        :return: The features as returned by FeatureExtraction.from_cases.
+        """
+        usage = self.usage
+        if usage is None or usage.everything:
+            return self._extract_full(xmi_bytes)
+
+        cas = load_selected_cas_from_xmi(
+            BytesIO(xmi_bytes), self.typesystem, usage.views, usage.types
+        )
+        feats, needed = self._extract(cas)
+        if needed.covered_by(usage):
+            return feats
+        # The extractors needed something that was not loaded.
+        return self._extract_full(xmi_bytes)
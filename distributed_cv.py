@@ -0,0 +1,385 @@
+"""
+Cross-validation folds on worker processes.
+
+A worker listens on a TCP port and fits the folds it gets:
+
+    CV_AUTHKEY=<secret> python distributed_cv.py --port 7001
+
+The service sends its folds to the workers in CV_WORKERS
+("host:port,host:port"), with the same CV_AUTHKEY.
+
+The coordinator in do_training sends the feature matrix and the labels once to
+every registered worker and then hands out the fold indices one at a time.
+Each fold result (the fitted model and its metrics) comes back to the
+coordinator, which picks the best model as before. A fold whose worker fails
+is handed out again, a lost worker is reconnected a few times, and folds that
+are left when no worker is reachable are fitted locally.
+
+The messages are pickled (multiprocessing.connection), so whoever knows the
+key can run code on the other side. They are authenticated with CV_AUTHKEY,
+which has no default: workers and coordinators refuse to start without it.
+Only run workers in a trusted network.
+"""
+import argparse
+import os
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+from multiprocessing.connection import Listener
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import accuracy_score
+from sklearn.metrics import classification_report
+from sklearn.metrics import cohen_kappa_score
+from training_data import FoldMatrices
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+Address = Tuple[str, int]
+Split = Tuple[np.ndarray, np.ndarray]
+
+# The shared secret of the service and its workers, None if it is not set.
+AUTHKEY = os.environ["CV_AUTHKEY"].encode() if os.environ.get("CV_AUTHKEY") else None
+
+# The workers do_training distributes its folds to, set with CV_WORKERS
+# ("host:port,host:port").
+registered_workers = []  # type: List[Address]
+
+
+def require_authkey(authkey: Optional[bytes]) -> bytes:
+    """
+    :raises ValueError: If no key is given and CV_AUTHKEY is not set.
+    """
+    if authkey is None:
+        authkey = AUTHKEY
+    if not authkey:
+        raise ValueError(
+            "CV_AUTHKEY must be set to a secret to distribute cross-validation folds."
+        )
+    return authkey
+
+
+class FoldResult(NamedTuple):
+    fold: int
+    model: RandomForestClassifier
+    metrics: Dict
+    accuracy: float
+    f1: float
+    cohens_kappa: float
+    train_time: float
+    # The indices of the columns of x the model was fitted on.
+    columns: np.ndarray
+
+
+def important_columns(x_train: np.ndarray, y_train: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    The indices of the columns with a feature importance of at least
+    threshold in a random forest fitted on the training rows. The most
+    important column is always kept.
+    """
+    clf = RandomForestClassifier(random_state=2)
+    clf.fit(x_train, y_train)
+    keep = clf.feature_importances_ >= threshold
+    keep[np.argmax(clf.feature_importances_)] = True
+    return np.flatnonzero(keep)
+
+
+def fit_fold(
+    fold: int,
+    x_train: np.ndarray,
+    y_train: np.ndarray,
+    x_test: np.ndarray,
+    y_test: np.ndarray,
+    estimator=None,
+    importance_threshold: float = 0.0,
+) -> FoldResult:
+    """
+    Fit a classifier on a fold and evaluate it on the test rows.
+
+    :param estimator: An unfitted classifier, by default a random forest.
+    :param importance_threshold: If greater than 0, the columns with a lower
+        feature importance on the training rows of the fold are dropped
+        before the classifier is fitted (see important_columns).
+    """
+    start = time.time()
+
+    if importance_threshold > 0:
+        columns = important_columns(x_train, y_train, importance_threshold)
+        x_train = x_train[:, columns]
+        x_test = x_test[:, columns]
+    else:
+        columns = np.arange(x_train.shape[1])
+
+    clf = estimator if estimator is not None else RandomForestClassifier()
+
+    clf.fit(x_train, y_train)
+
+    y_pred = clf.predict(x_test)
+
+    end = time.time()
+
+    metrics = classification_report(
+        y_test, y_pred, output_dict=True, target_names=["False", "True"]
+    )
+
+    accuracy = accuracy_score(y_test, y_pred)
+    f1 = metrics["macro avg"]["f1-score"]
+    cohens_kappa = cohen_kappa_score(y_test, y_pred)
+
+    # Add accuracy and cohens kappa to the metrics dictionary.
+    metrics["accuracy"] = accuracy
+    metrics["cohens_kappa"] = cohens_kappa
+
+    return FoldResult(fold, clf, metrics, accuracy, f1, cohens_kappa, end - start, columns)
+
+
+def fit_folds_locally(
+    x: np.ndarray, y: np.ndarray, splits: List[Split], importance_threshold: float = 0.0
+) -> List[FoldResult]:
+    folds = FoldMatrices(x)
+    results = []
+    for fold, (train_ids, test_ids) in enumerate(splits):
+        x_train, x_test = folds.split(train_ids, test_ids)
+        results.append(
+            fit_fold(
+                fold,
+                x_train,
+                y[train_ids],
+                x_test,
+                y[test_ids],
+                importance_threshold=importance_threshold,
+            )
+        )
+    return results
+
+
+def register_worker(address: Address):
+    if address not in registered_workers:
+        registered_workers.append(address)
+
+
+def parse_address(address: str) -> Address:
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+class Worker:
+    """
+    A worker that fits the folds of the coordinators connected to it.
+
+    :param address: The host and port to listen on, port 0 for any free port.
+    """
+
+    def __init__(self, address: Address = ("localhost", 0), authkey: bytes = None):
+        self.listener = Listener(address, authkey=require_authkey(authkey))
+        self.address = self.listener.address
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                # The listener was closed.
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        folds = y = None
+        importance_threshold = 0.0
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == "data":
+                    _, x, y, importance_threshold = message
+                    folds = FoldMatrices(x)
+                elif message[0] == "fold":
+                    _, fold, train_ids, test_ids = message
+                    try:
+                        x_train, x_test = folds.split(train_ids, test_ids)
+                        result = fit_fold(
+                            fold,
+                            x_train,
+                            y[train_ids],
+                            x_test,
+                            y[test_ids],
+                            importance_threshold=importance_threshold,
+                        )
+                        conn.send(("result", result))
+                    except Exception:
+                        conn.send(("error", fold, traceback.format_exc()))
+                else:
+                    return
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        self.listener.close()
+
+
+class Coordinator:
+    """
+    Distribute the folds of a cross-validation to workers.
+
+    :param workers: The addresses of the workers.
+    :param retries: How often a fold is handed out again after an error, and
+        how often a lost worker is reconnected.
+    :param timeout: Seconds to wait for a fold result before the worker is
+        considered lost (None to wait forever).
+    """
+
+    def __init__(
+        self,
+        workers: List[Address],
+        authkey: bytes = None,
+        retries: int = 2,
+        timeout: float = None,
+    ):
+        self.workers = workers
+        self.authkey = require_authkey(authkey)
+        self.retries = retries
+        self.timeout = timeout
+
+    def run_folds(
+        self,
+        x: np.ndarray,
+        y: np.ndarray,
+        splits: List[Split],
+        importance_threshold: float = 0.0,
+    ) -> List[FoldResult]:
+        """
+        Fit all folds and return their results in fold order.
+
+        :param importance_threshold: See fit_fold.
+
+        :raises RuntimeError: If a fold failed on more than `retries` workers.
+        """
+        pending = queue.Queue()
+        for fold in range(len(splits)):
+            pending.put(fold)
+        results = {}
+        errors = {}
+        attempts = [0] * len(splits)
+        lock = threading.Lock()
+
+        def failed(fold: int, error: str):
+            with lock:
+                attempts[fold] += 1
+                if attempts[fold] > self.retries:
+                    errors[fold] = error
+                    return
+            pending.put(fold)
+
+        def drive(address: Address):
+            connection_failures = 0
+            while connection_failures <= self.retries:
+                fold = None
+                try:
+                    conn = Client(address, authkey=self.authkey)
+                    try:
+                        conn.send(("data", x, y, importance_threshold))
+                        while True:
+                            try:
+                                fold = pending.get_nowait()
+                            except queue.Empty:
+                                conn.send(("close",))
+                                return
+                            conn.send(("fold", fold) + tuple(splits[fold]))
+                            if self.timeout is not None and not conn.poll(self.timeout):
+                                raise TimeoutError("No result after {}s".format(self.timeout))
+                            reply = conn.recv()
+                            if reply[0] == "result":
+                                with lock:
+                                    results[fold] = reply[1]
+                            else:
+                                failed(fold, reply[2])
+                            fold = None
+                    finally:
+                        conn.close()
+                except (OSError, EOFError, AuthenticationError) as e:
+                    print("CV worker {}:{} failed: {}".format(address[0], address[1], e))
+                    if fold is not None:
+                        failed(fold, repr(e))
+                    connection_failures += 1
+                    time.sleep(0.1 * connection_failures)
+
+        threads = [
+            threading.Thread(target=drive, args=(address,), daemon=True)
+            for address in self.workers
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise RuntimeError(
+                "Folds {} failed on the CV workers:\n{}".format(
+                    sorted(errors), "\n".join(errors.values())
+                )
+            )
+        # Folds that are left when no worker could be reached are fitted here.
+        left = []
+        while not pending.empty():
+            left.append(pending.get())
+        if left:
+            folds = FoldMatrices(x)
+            for fold in sorted(left):
+                train_ids, test_ids = splits[fold]
+                x_train, x_test = folds.split(train_ids, test_ids)
+                results[fold] = fit_fold(
+                    fold,
+                    x_train,
+                    y[train_ids],
+                    x_test,
+                    y[test_ids],
+                    importance_threshold=importance_threshold,
+                )
+        return [results[fold] for fold in range(len(splits))]
+
+
+def run_folds(
+    x: np.ndarray, y: np.ndarray, splits: List[Split], importance_threshold: float = 0.0
+) -> List[FoldResult]:
+    """Fit the folds on the registered workers, or locally if there are none."""
+    if registered_workers:
+        return Coordinator(list(registered_workers)).run_folds(
+            x, y, splits, importance_threshold
+        )
+    return fit_folds_locally(x, y, splits, importance_threshold)
+
+
+for worker_address in os.environ.get("CV_WORKERS", "").split(","):
+    if worker_address:
+        register_worker(parse_address(worker_address))
+if registered_workers:
+    # The service does not start with workers but without a key.
+    require_authkey(None)
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Run a cross-validation worker.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=7001)
+    args = parser.parse_args(argv)
+
+    worker = Worker((args.host, args.port))
+    print("CV worker listening on {}:{}".format(*worker.address))
+    worker.serve_forever()
+
+
+if __name__ == "__main__":
+    # The fold results must be pickled as distributed_cv.FoldResult, not
+    # __main__.FoldResult, for the coordinator to load them.
+    import distributed_cv
+
+    distributed_cv.main()
@@ -0,0 +1,108 @@
+"""
+Assembly of the model input from extracted features without pandas.
+
+For every prediction the extracted features used to be put into a DataFrame,
+one-hot encoded with pd.get_dummies, aligned to the model columns with
+reindex(columns=model_columns, fill_value=0) and converted to float32. A
+FeatureLayout is compiled once per model from its model columns and writes the
+features straight into a preallocated float32 buffer instead:
+
+- numeric features go to the column with their name (missing values are NaN),
+- categorical features set the column of their dummy "<name>_<value>" to 1,
+- columns the features do not fill, and features the model does not know,
+  are 0 or ignored, like after the reindex.
+
+The result is the same matrix as the pandas path.
+"""
+import numbers
+
+import numpy as np
+
+from pandas.api.types import is_numeric_dtype
+from pandas.core.frame import DataFrame
+from typing import List
+from typing import Mapping
+from typing import Sequence
+from typing import Union
+
+Features = Union[DataFrame, Mapping[str, Sequence]]
+
+# The types the feature extractors produce, checked before the slower
+# numbers.Number check.
+_NUMBER_TYPES = {float, int, np.float64, np.float32, np.int64, np.int32}
+
+
+def _is_numeric(values: Sequence) -> bool:
+    # The dtype pandas would infer for the column: numbers (None becomes NaN)
+    # are numeric, so are bools without missing values. Everything else,
+    # including a column with only None, is an object column.
+    if isinstance(values, np.ndarray) and values.dtype != object:
+        return is_numeric_dtype(values.dtype)
+    if all(type(value) in _NUMBER_TYPES for value in values):
+        return len(values) > 0
+    present = [value for value in values if value is not None]
+    if not present:
+        return False
+    if all(isinstance(value, (bool, np.bool_)) for value in present):
+        return len(present) == len(values)
+    return all(
+        isinstance(value, numbers.Number) and not isinstance(value, (bool, np.bool_))
+        for value in present
+    )
+
+
+def _is_missing(value) -> bool:
+    return value is None or (isinstance(value, float) and value != value)
+
+
+class FeatureLayout:
+    """The position of every feature (and feature dummy) in the input of a model."""
+
+    def __init__(self, model_columns: List[str]):
+        self.model_columns = list(model_columns)
+        self.index = {column: i for i, column in enumerate(self.model_columns)}
+
+    def assemble(self, features: Features) -> np.ndarray:
+        """
+        Write the features of one or more instances into a model input.
+
+        :param features: Feature name -> one value per instance, like the
+            OrderedDict of FeatureExtraction.from_cases or a DataFrame.
+        :return: A float32 matrix with one row per instance and the model
+            columns in order.
+        """
+        if isinstance(features, DataFrame):
+            n_rows = features.shape[0]
+            columns = (
+                (name, values.to_numpy(), is_numeric_dtype(values.dtype))
+                for name, values in features.items()
+            )
+        else:
+            n_rows = len(next(iter(features.values()))) if features else 0
+            columns = (
+                (name, values, _is_numeric(values)) for name, values in features.items()
+            )
+
+        query = np.zeros((n_rows, len(self.model_columns)), dtype=np.float32)
+        for name, values, numeric in columns:
+            if numeric:
+                column = self.index.get(name)
+                if column is None:
+                    continue
+                if n_rows == 1:
+                    value = values[0]
+                    query[0, column] = np.nan if value is None else value
+                else:
+                    if not isinstance(values, np.ndarray):
+                        values = [np.nan if value is None else value for value in values]
+                    query[:, column] = values
+                continue
+            # One-hot encoding, as pd.get_dummies does for object columns.
+            # Missing values do not get a dummy.
+            for row, value in enumerate(values):
+                if _is_missing(value):
+                    continue
+                column = self.index.get("{}_{}".format(name, value))
+                if column is not None:
+                    query[row, column] = 1.0
+        return query
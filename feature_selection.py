@@ -0,0 +1,105 @@
+"""
+Per-model selection of the feature extractors.
+
+FeatureExtraction.from_cases runs every extractor, but a model only uses the
+features in its model columns. FeatureSelection learns from the first CAS
+which features every extractor produces and then extracts the features of a
+model with a FeatureExtraction that only has the extractors those features
+come from. Each such subset gets its own SelectiveCasLoader, so the CAS is
+also parsed with only the views and types of these extractors.
+
+If the extractors do not produce the same features one by one as all
+together, the selection is switched off and all extractors are run.
+"""
+import copy
+import threading
+
+from cas_loading import SelectiveCasLoader
+from cassis.typesystem import TypeSystem
+from cassis.xmi import load_cas_from_xmi
+from io import BytesIO
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+
+def restricted_extraction(extraction, extractors: List):
+    """A copy of a FeatureExtraction that only runs the given extractors."""
+    restricted = copy.copy(extraction)
+    restricted.extractors = list(extractors)
+    return restricted
+
+
+def feature_of_column(column: str, feature_names: List[str]) -> Optional[str]:
+    """
+    The feature a model column comes from: the feature itself, or a
+    categorical feature whose one-hot dummy "<feature>_<value>" it is.
+    """
+    if column in feature_names:
+        return column
+    for name in feature_names:
+        if column.startswith(name + "_"):
+            return name
+    return None
+
+
+class FeatureSelection:
+    """
+    Extract only the features of a model from CASes.
+
+    :param typesystem: The type system of the CASes.
+    :param extraction: The FeatureExtraction with all extractors.
+    """
+
+    def __init__(self, typesystem: TypeSystem, extraction):
+        self.typesystem = typesystem
+        self.extraction = extraction
+        # The names of the features of every extractor, learned from the
+        # first CAS. An empty list switches the selection off.
+        self.extractor_features = None  # type: Optional[List[List[str]]]
+        # The SelectiveCasLoader of every subset of extractor indices.
+        self.loaders = {}
+        self.lock = threading.Lock()
+
+    def learn(self, xmi_bytes: bytes):
+        """Run every extractor on its own to find out which features it produces."""
+        cas = load_cas_from_xmi(BytesIO(xmi_bytes), typesystem=self.typesystem)
+        extractor_features = [
+            list(restricted_extraction(self.extraction, [extractor]).from_cases([cas]))
+            for extractor in self.extraction.extractors
+        ]
+        all_features = list(self.extraction.from_cases([cas]))
+        if sorted(sum(extractor_features, [])) != sorted(all_features):
+            print("The feature extractors can not be selected, all of them are run.")
+            extractor_features = []
+        self.extractor_features = extractor_features
+
+    def needed_extractors(self, model_columns: List[str]) -> Tuple[int, ...]:
+        """The indices of the extractors that produce the model columns."""
+        needed = set()
+        for index, names in enumerate(self.extractor_features):
+            if any(feature_of_column(column, names) for column in model_columns):
+                needed.add(index)
+        return tuple(sorted(needed))
+
+    def loader(self, model_columns: List[str], xmi_bytes: bytes) -> Optional[SelectiveCasLoader]:
+        """
+        The loader for the extractors of a model, None to run all extractors.
+
+        :param xmi_bytes: A CAS to learn the features of the extractors from,
+            if they are not known yet.
+        """
+        with self.lock:
+            if self.extractor_features is None:
+                self.learn(xmi_bytes)
+            if not self.extractor_features:
+                return None
+            needed = self.needed_extractors(model_columns)
+            if len(needed) == len(self.extractor_features):
+                return None
+            if needed not in self.loaders:
+                extractors = [self.extraction.extractors[index] for index in needed]
+                self.loaders[needed] = SelectiveCasLoader(
+                    self.typesystem, restricted_extraction(self.extraction, extractors)
+                )
+            return self.loaders[needed]
@@ -0,0 +1,291 @@
+"""
+Everything that is needed to predict with trained models.
+
+The training code and its dependencies (scikit-learn, skl2onnx, the
+metrics) live in main.py. The inference-only app in serve.py only imports
+this module, so serving workers do not pay for them.
+"""
+import json
+import os
+import onnxruntime as rt
+
+import artifacts
+
+from cas_loading import SelectiveCasLoader
+from cassis.xmi import load_cas_from_xmi
+from feature_layout import Features
+from feature_layout import FeatureLayout
+from feature_selection import FeatureSelection
+from features import uima
+from features.extractor import FeatureExtraction
+from features.feature_groups import BOWGroupExtractor
+from io import BytesIO
+from native_forest import PackedForest
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Union
+
+# The model directories, set with ONNX_MODEL_DIR and BOW_MODEL_DIR to run
+# several instances from one checkout.
+onnx_model_dir = os.environ.get("ONNX_MODEL_DIR", "onnx_models")
+bow_model_dir = os.environ.get("BOW_MODEL_DIR", "bow_models")
+
+# UIMA / features stuff
+# type system
+isaac_ts = uima.load_isaac_ts()
+# feature extraction
+extraction = FeatureExtraction()
+# CASes are parsed selectively with only the views and types the extraction
+# needs (see cas_loading.py). Set SELECTIVE_CAS_LOADING=0 to always parse the
+# full CAS.
+selective_cas_loading = os.environ.get("SELECTIVE_CAS_LOADING", "1") != "0"
+cas_loader = SelectiveCasLoader(isaac_ts, extraction)
+# With SELECTIVE_FEATURES=1, only the extractors of the features in the model
+# columns of a model are run (see feature_selection.py), and /predict returns
+# only these features. By default all features are extracted.
+selective_features = os.environ.get("SELECTIVE_FEATURES", "0") != "0"
+feature_selection = FeatureSelection(isaac_ts, extraction)
+
+# Inference session object for predictions.
+inf_sessions = {}
+# The ONNX file (or serialized model) every session was created from.
+model_sources = {}
+# For prediction from ShortAnswerInstances the BOW model belonging to the ML model
+# must be loaded for feature extraction.
+bow_models = {}
+
+
+def bow_from_state(state_dict: dict) -> BOWGroupExtractor:
+    # Instances list is passed empty here because bag of words setup has
+    # already been done.
+    bow_extractor = BOWGroupExtractor([])
+    bow_extractor.bag = state_dict["bag"]
+    return bow_extractor
+
+
+def load_session(model_id: str, model: Union[str, bytes]):
+    """
+    Create the inference session of a model from its file or bytes.
+
+    The session is compiled together with its BOW model before it replaces
+    the previous one in a single assignment, so predictions that are running
+    meanwhile keep using the previous session and BOW model.
+    """
+    session = rt.InferenceSession(model)
+    metadata = session.get_modelmeta().custom_metadata_map
+    if artifacts.BOW in metadata:
+        bow_extractor = bow_from_state(json.loads(metadata[artifacts.BOW]))
+    elif artifacts.MODEL_VERSION in metadata:
+        # The model was stored with all its artifacts and has no BOW model.
+        bow_extractor = None
+    else:
+        # The model was stored before its BOW model was part of the ONNX
+        # file, the BOW model is loaded from the BOW model directory.
+        bow_extractor = bow_models.get(model_id)
+    compiled_sessions[model_id] = compile_model(
+        session, model, bow_extractor, uses_native_forest(model_id)
+    )
+    inf_sessions[model_id] = session
+    model_sources[model_id] = model
+    if bow_extractor is not None:
+        bow_models[model_id] = bow_extractor
+    else:
+        bow_models.pop(model_id, None)
+
+
+def unload_session(model_id: str):
+    """Forget the session and BOW model of a model."""
+    compiled_sessions.pop(model_id, None)
+    inf_sessions.pop(model_id, None)
+    model_sources.pop(model_id, None)
+    bow_models.pop(model_id, None)
+
+
+# Models whose random forest is evaluated with the packed arrays of
+# native_forest.py instead of onnxruntime, as a comma-separated list of model
+# IDs in NATIVE_FOREST_MODELS ("*" for all models).
+native_forest_models = set(
+    model_id for model_id in os.environ.get("NATIVE_FOREST_MODELS", "").split(",") if model_id
+)
+
+
+def extract_from_xmi(
+    xmi_bytes: bytes, model_id: str = None, model_columns: List[str] = None
+):
+    """
+    Extract the features of a CAS.
+
+    :param model_id: If given, only the features this model uses are
+        extracted where the extractors allow it.
+    :param model_columns: If given, only the features of these model columns
+        are extracted where the extractors allow it.
+    """
+    if model_id is not None:
+        model_columns = compile_session(model_id).columns
+    loader = cas_loader
+    if model_columns is not None and selective_features:
+        loader = feature_selection.loader(model_columns, xmi_bytes) or cas_loader
+    if selective_cas_loading:
+        return loader.extract(xmi_bytes)
+    cas = load_cas_from_xmi(BytesIO(xmi_bytes), typesystem=isaac_ts)
+    return loader.extraction.from_cases([cas])
+
+
+class CompiledModel(NamedTuple):
+    session: rt.InferenceSession
+    # The ONNX file (or serialized model) the session was created from.
+    source: Union[str, bytes]
+    # The model columns the model was trained on.
+    columns: List[str]
+    layout: FeatureLayout
+    input_name: str
+    label_name: str
+    native: bool
+    # The packed forest if the model is evaluated natively, else None.
+    forest: PackedForest
+    # The BOW model of a model trained from answers, else None.
+    bow: BOWGroupExtractor
+    # The version of the stored artifacts, None for models stored without.
+    version: str
+
+
+# The feature layout, the input and output names, the BOW model and the packed
+# forest of every inference session, keyed by model ID. An entry is replaced
+# as a whole when training stores a new session or the backend changes.
+compiled_sessions = {}
+
+
+def uses_native_forest(model_id: str) -> bool:
+    return model_id in native_forest_models or "*" in native_forest_models
+
+
+def compile_model(
+    session: rt.InferenceSession,
+    source: Union[str, bytes],
+    bow_extractor: BOWGroupExtractor,
+    native: bool,
+) -> CompiledModel:
+    metadata = session.get_modelmeta().custom_metadata_map
+    # The columns in string format are retrieved from the model and
+    # converted back to a list.
+    model_columns = metadata[artifacts.MODEL_COLUMNS].split(" ")
+    input_name = session.get_inputs()[0].name
+    # The predict_proba function is used because get_outputs() is indexed
+    # at 1. If it is indexed at 0, the predict method is used.
+    label_name = session.get_outputs()[1].name
+    forest = None
+    if native:
+        try:
+            forest = PackedForest.from_onnx(source)
+        except ValueError as e:
+            # onnxruntime still predicts with this model.
+            print("Model is evaluated with onnxruntime: {}".format(e))
+    return CompiledModel(
+        session,
+        source,
+        model_columns,
+        FeatureLayout(model_columns),
+        input_name,
+        label_name,
+        native,
+        forest,
+        bow_extractor,
+        metadata.get(artifacts.MODEL_VERSION),
+    )
+
+
+def compile_session(model_id: str) -> CompiledModel:
+    """
+    The current session of a model with everything needed to predict with it.
+
+    Callers that use several parts of it (like the BOW model and the session)
+    must take them from the same returned object.
+    """
+    compiled = compiled_sessions[model_id]
+    native = uses_native_forest(model_id)
+    if compiled.native != native:
+        current = compiled
+        compiled = compile_model(compiled.session, compiled.source, compiled.bow, native)
+        # A session that training stored meanwhile is not replaced.
+        if compiled_sessions.get(model_id) is current:
+            compiled_sessions[model_id] = compiled
+    return compiled
+
+
+def model_id_of(file_name: str, suffix: str) -> Optional[str]:
+    """
+    The model ID of a file in a model directory, None for hidden files like
+    .keep, temporary files of interrupted writes and files of other types.
+    """
+    if file_name.startswith(".") or not file_name.endswith(suffix):
+        return None
+    return file_name[: -len(suffix)]
+
+
+# BOW models stored before they were part of the ONNX file are loaded first,
+# so that the sessions of their models are compiled with them.
+for bow_file in os.listdir(bow_model_dir):
+    model_id = model_id_of(bow_file, ".json")
+    if model_id is None:
+        continue
+    if model_id not in bow_models:
+        bow_path = os.path.join(bow_model_dir, bow_file)
+        with open(bow_path) as bowf:
+            bow_models[model_id] = bow_from_state(json.load(bowf))
+
+# Store all model objects and inference session objects in memory for
+# quick access.
+for model_file in os.listdir(onnx_model_dir):
+    model_id = model_id_of(model_file, ".onnx")
+    if model_id is None:
+        continue
+    if model_id not in inf_sessions:
+        load_session(model_id, os.path.join(onnx_model_dir, model_file))
+
+
+def do_prediction(data: Features, model_id: str = None, compiled: CompiledModel = None) -> dict:
+    return do_batch_prediction(data, model_id, compiled)[0]
+
+
+def do_batch_prediction(
+    data: Features, model_id: str = None, compiled: CompiledModel = None
+) -> List[dict]:
+    """
+    Predict the classes of instances with a model.
+
+    :param data: The extracted features, as a DataFrame or as feature name ->
+        one value per instance.
+    :param model_id: The ID of the model.
+    :param compiled: The compiled session to predict with, if the features
+        were extracted with its BOW model. By default the current session of
+        the model.
+    """
+    if compiled is None:
+        compiled = compile_session(model_id)
+
+    # The features are one-hot encoded and aligned to the model columns, like
+    # pd.get_dummies(data).reindex(columns=model_columns, fill_value=0).
+    # https://github.com/amirziai/sklearnflask/issues/3
+    # Thanks to @lorenzori
+    query = compiled.layout.assemble(data)
+    if query.shape[0] == 0:
+        return []
+
+    # Prediction takes place here.
+    if compiled.forest is not None:
+        pred = compiled.forest.run(query)
+    else:
+        pred = compiled.session.run(
+            [compiled.label_name], {compiled.input_name: query}
+        )[0]
+
+    # ONNX returns one prediction dictionary per row of the query.
+    # prediction is the class with max probability
+    return [
+        {
+            "prediction": max(probs, key=lambda k: probs[k]),
+            "classProbabilities": probs,
+        }
+        for probs in pred
+    ]
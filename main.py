@@ -1,25 +1,27 @@
-import json
+import base64
 import os
 import shutil
 import time
-import base64
 import numpy as np
-import onnxruntime as rt
 import pandas as pd
-import math
-import sys
 
+import artifacts
+import capture
+import distributed_cv
+import inference
+import model_selection
+
+from admission import training_pool
 from fastapi import FastAPI
 from fastapi import HTTPException
-from features import uima
-from features.extractor import FeatureExtraction
 from features.feature_groups import BOWGroupExtractor
-from features.feature_groups import SIMGroupExtractor
 from features.data import ShortAnswerInstance
-from cassis.xmi import load_cas_from_xmi
-from io import BytesIO
+from inference import extract_from_xmi
 from pandas.core.frame import DataFrame
 from pydantic import BaseModel
+from serve import ClassificationInstance
+from serve import router as prediction_router
+from similarity import BatchSIMGroupExtractor
 from skl2onnx import convert_sklearn
 from skl2onnx.common.data_types import FloatTensorType
 from sklearn.ensemble import RandomForestClassifier
@@ -28,9 +30,12 @@ from sklearn.metrics import classification_report
 from sklearn.metrics import cohen_kappa_score
 from sklearn.svm import SVC
 from sklearn.model_selection import StratifiedKFold
-from typing import Dict
+from training_data import FoldMatrices
+from training_data import fold_rows
+from training_data import training_matrix
+from training_data import unique_rows
 from typing import List
-from typing import Union
+from typing import Optional
 
 try:
     from _thread import allocate_lock as Lock
@@ -38,6 +43,8 @@ except:
     from _dummy_thread import allocate_lock as Lock
 
 app = FastAPI()
+# /predict and /predictFromAnswers are shared with the inference-only app.
+app.include_router(prediction_router)
 
 # These are the standard input features for the two endpoints
 # /train and /trainFromCASes.
@@ -57,65 +64,41 @@ include_norm = [
 ]
 dependent_variable = include_norm[-1]
 
-onnx_model_dir = "onnx_models"
-bow_model_dir = "bow_models"
+# Trained models are written to the directories the inference module loads
+# them from.
+onnx_model_dir = inference.onnx_model_dir
+bow_model_dir = inference.bow_model_dir
+metrics_dir = os.environ.get("MODEL_METRICS_DIR", "model_metrics")
+
+# Features whose importance in a random forest fitted on the training rows of
+# a fold is below this threshold are dropped before the classifier of the fold
+# is fitted, so the stored model does not use them and their extractors are
+# not run at prediction. 0 (the default) keeps all features.
+feature_importance_threshold = float(
+    os.environ.get("FEATURE_IMPORTANCE_THRESHOLD", "0")
+)
+
+# The default wall-clock budget in seconds of the model selection of
+# do_training. 0 (the default) fits a random forest with the default
+# parameters on every fold.
+model_selection_budget = float(os.environ.get("MODEL_SELECTION_BUDGET", "0"))
 
-# UIMA / features stuff
-# type system
-isaac_ts = uima.load_isaac_ts()
-# feature extraction
-extraction = FeatureExtraction()
 # in-memory feature data
 features = {}
 lock = Lock()
 
-# Inference session object for predictions.
-inf_sessions = {}
-# Store all model objects and inference session objects in memory for
-# quick access.
-for model_file in os.listdir(onnx_model_dir):
-    model_id = model_file.rstrip(".onnx")
-    if model_id not in inf_sessions:
-        inf_sessions[model_id] = rt.InferenceSession(
-            os.path.join(onnx_model_dir, model_file)
-        )
-
-# For prediction from ShortAnswerInstances the BOW model belonging to the ML model
-# must be loaded for feature extraction.
-bow_models = {}
-for bow_file in os.listdir(bow_model_dir):
-    # Ignore hidden files like .keep
-    if bow_file.startswith("."):
-        continue
-    model_id = bow_file.rstrip(".json")
-    if model_id not in bow_models:
-        bow_path = os.path.join(bow_model_dir, bow_file)
-        with open(bow_path) as bowf:
-            state_dict = json.load(bowf)
-            # Instances list is passed empty here because bag of words setup has 
-            # already been done.
-            bow_models[model_id] = BOWGroupExtractor([])
-            bow_models[model_id].bag = state_dict["bag"]
-
-
-class ClassificationInstance(BaseModel):
-    modelId: str
-    cas: str
-
-
-class CASPrediction(BaseModel):
-    prediction: int
-    classProbabilities: Dict[Union[str, int], float]
-    features: Dict[str, Union[float, int, None]]
-
 
 class TrainFromCASRequest(BaseModel):
     modelId: str
+    # Seconds for the model selection (see model_selection.py).
+    selectionBudget: Optional[float] = None
 
 
 class TrainingInstance(BaseModel):
     fileName: str
     modelId: str
+    # Seconds for the model selection (see model_selection.py).
+    selectionBudget: Optional[float] = None
 
 
 class TrainFromLanguageDataRequest(BaseModel):
@@ -123,84 +106,9 @@ class TrainFromLanguageDataRequest(BaseModel):
     modelId: str
 
 
-class PredictFromLanguageDataRequest(BaseModel):
-    instances: List[ShortAnswerInstance]
-    modelId: str
-
-
-class SinglePrediction(BaseModel):
-    prediction: int
-    classProbabilities: Dict[Union[str, int], float]
-
-
-class PredictFromLanguageDataResponse(BaseModel):
-    predictions: List[SinglePrediction]
-
-
-def do_prediction(data: DataFrame, model_id: str = None) -> dict:
-
-    session = inf_sessions[model_id]
-
-    query = pd.get_dummies(data)
-    # The columns in string format are retrieved from the model and converted
-    # back to a list.
-    model_columns = (
-        session.get_modelmeta().custom_metadata_map["model_columns"].split(" ")
-    )
-
-    # https://github.com/amirziai/sklearnflask/issues/3
-    # Thanks to @lorenzori
-    query = query.reindex(columns=model_columns, fill_value=0)
-    response_model=CASPrediction
-    input_name = session.get_inputs()[0].name
-    # The predict_proba function is used because get_outputs() is indexed at 1.
-    # If it is indexed at 0, the predict method is used.
-    label_name = session.get_outputs()[1].name
-    # Prediction takes place here.
-    pred = session.run([label_name], {input_name: query.to_numpy(dtype=np.float32)})[0]
-
-    # The Prediction dictionary is stored in a list by ONNX so it can be
-    # retrieved by indexing.
-    probs = pred[0]
-
-    # prediction is the class with max probability
-    return {
-        "prediction": max(probs, key=lambda k: probs[k]),
-        "classProbabilities": probs,
-    }
-
-
-@app.post("/predict", response_model=CASPrediction)
-def predict(req: ClassificationInstance):
-    model_id = req.modelId
-    base64_cas = base64.b64decode(req.cas)
-
-    # Check that the model is stored in a file.
-    if model_id not in [model.rstrip(".onnx") for model in os.listdir(onnx_model_dir)]:
-        raise HTTPException(
-            status_code=422,
-            detail='Model with model ID "{}" could not be'
-            " found in the ONNX model directory."
-            " Please train first.".format(model_id),
-        )
-
-    print("printing deseralized json cas modelID: ", model_id)
-
-    # from_cases feature extraction
-    cas = load_cas_from_xmi(BytesIO(base64_cas), typesystem=isaac_ts)
-    print("loaded the cas...")
-    feats = extraction.from_cases([cas])
-    print("extracted feats")
-    data = pd.DataFrame.from_dict(feats)
-    prediction = do_prediction(data, model_id)
-    nan_to_none = lambda f: None if math.isnan(f) else f
-    prediction["features"] = {k: nan_to_none(v[0]) for k, v in feats.items()}
-    print(prediction)
-    return prediction
-
-
 @app.post("/addInstance")
 def addInstance(req: ClassificationInstance):
+    capture.record("/addInstance", req)
     model_id = req.modelId
     base64_string = base64.b64decode(req.cas)
 
@@ -210,8 +118,7 @@ def addInstance(req: ClassificationInstance):
             detail="No model ID passed as argument." " Please include a model ID.",
         )
 
-    cas = load_cas_from_xmi(BytesIO(base64_string), typesystem=isaac_ts)
-    feats = extraction.from_cases([cas])
+    feats = extract_from_xmi(base64_string)
     with lock:
         if model_id in features:
             # append new features
@@ -225,7 +132,21 @@ def addInstance(req: ClassificationInstance):
 
 
 @app.post("/trainFromCASes")
-def trainFromCASes(req: TrainFromCASRequest):
+async def trainFromCASes(req: TrainFromCASRequest):
+    return await training_pool.run(req.modelId, train_from_cases, req)
+
+
+@app.post("/trainFromAnswers")
+async def trainFromAnswers(req: TrainFromLanguageDataRequest):
+    return await training_pool.run(req.modelId, train_from_answers, req)
+
+
+@app.post("/train")
+async def train(req: TrainingInstance):
+    return await training_pool.run(req.modelId, train_from_file, req)
+
+
+def train_from_cases(req: TrainFromCASRequest):
 
     model_id = req.modelId
 
@@ -242,7 +163,7 @@ def trainFromCASes(req: TrainFromCASRequest):
         data = pd.DataFrame.from_dict(features[model_id])
         print("type of data in trainFromCASes (after DataFrame.from_dict: ", type(data))
 
-        return do_training(data, model_id)
+        return do_training(data, model_id, selection_budget=req.selectionBudget)
     else:
         raise HTTPException(
             status_code=422,
@@ -251,59 +172,88 @@ def trainFromCASes(req: TrainFromCASRequest):
         )
 
 
-@app.post("/trainFromAnswers")
-def trainFromAnswers(req: TrainFromLanguageDataRequest):
+def train_from_answers(req: TrainFromLanguageDataRequest):
     model_id = req.modelId
     # All feature extractor objects that should be used, are defined here.
-    ft_extractors = [SIMGroupExtractor()]
+    ft_extractors = [BatchSIMGroupExtractor()]
+
+    # Identical instances (same item, answer and label) are extracted and
+    # fitted only once, weighted by how often they occur. The folds are still
+    # split over all instances.
+    distinct_ids, inverse = unique_rows(
+        [
+            (instance.itemId, tuple(instance.itemTargets), instance.answer, instance.label)
+            for instance in req.instances
+        ]
+    )
+    instances = [req.instances[idx] for idx in distinct_ids]
 
     df = pd.DataFrame()
     
     # Note that the BOW feature extractor is set up later because it needs a new
     # setup for every new train-test split.
     for ft_extractor in ft_extractors:
-        df = pd.concat([df, ft_extractor.extract(req.instances)], axis=1)
+        df = pd.concat([df, ft_extractor.extract(instances)], axis=1)
 
-    labels = pd.DataFrame([instance.label for instance in req.instances], columns=["labels"])
+    labels = np.array([instance.label for instance in req.instances])
+    distinct_labels = labels[distinct_ids]
+    # The similarity features are the same in every fold and are only
+    # converted once.
+    x_sim, sim_columns = training_matrix(df, fill_na=False)
 
     best_metrics = init_best_metrics(model_id)
     best_model = None
 
-    n_splits = (10 if df.shape[0] > 1000 else 5) if df.shape[0] > 50 else 2
+    n_instances = len(req.instances)
+    n_splits = (10 if n_instances > 1000 else 5) if n_instances > 50 else 2
 
     skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=2)
-    for train_ids, test_ids in skf.split(df, labels):
-        
-        # The right indices must be found to extract the BOW features for the correct instances.
-        train_instances = [req.instances[idx] for idx in train_ids]
-        bow_extractor = BOWGroupExtractor(train_instances)
-
-        x = pd.concat([df, bow_extractor.extract(req.instances)], axis=1)
+    splits = list(skf.split(np.zeros((n_instances, 1)), labels))
+
+    # The right indices must be found to extract the BOW features for the correct instances.
+    bow_extractors = [
+        BOWGroupExtractor([req.instances[idx] for idx in train_ids])
+        for train_ids, _ in splits
+    ]
+    # The fold matrices are allocated once, for the largest bag of words.
+    folds = FoldMatrices(
+        x_sim,
+        n_columns=x_sim.shape[1] + max(len(extractor.bag) for extractor in bow_extractors),
+    )
+    for (train_ids, test_ids), bow_extractor in zip(splits, bow_extractors):
+        bow_features = bow_extractor.extract(instances)
 
         # NOTE: If categorical features are included, One-hot should be included here as well.
+        train_rows, train_weights = fold_rows(inverse, train_ids, len(instances))
+        test_rows, test_weights = fold_rows(inverse, test_ids, len(instances))
+        folds.set_blocks(x_sim, bow_features.to_numpy(dtype=np.float32))
+        x_train, x_test = folds.split(train_rows, test_rows)
+        y_train = distinct_labels[train_rows]
+        y_test = distinct_labels[test_rows]
 
         start = time.time()
 
         clf = RandomForestClassifier()
 
-        x_train = x.iloc[train_ids]
-        y_train = labels.iloc[train_ids]
-        x_test = x.iloc[test_ids]
-        y_test = labels.iloc[test_ids]
-
-        clf.fit(x_train, y_train)
+        clf.fit(x_train, y_train, sample_weight=train_weights)
 
         y_pred = clf.predict(x_test)
 
         end = time.time()
 
+        # The test instances are weighted like in the training, so the
+        # metrics are those of all test instances.
         metrics = classification_report(
-            y_test, y_pred, output_dict=True, target_names=["False", "True"]
+            y_test,
+            y_pred,
+            output_dict=True,
+            target_names=["False", "True"],
+            sample_weight=test_weights,
         )
 
-        accuracy = accuracy_score(y_test, y_pred)
+        accuracy = accuracy_score(y_test, y_pred, sample_weight=test_weights)
         f1 = metrics["macro avg"]["f1-score"]
-        cohens_kappa = cohen_kappa_score(y_test, y_pred)
+        cohens_kappa = cohen_kappa_score(y_test, y_pred, sample_weight=test_weights)
 
         # Add accuracy and cohens kappa to the metrics dictionary.
         metrics["accuracy"] = accuracy
@@ -322,10 +272,6 @@ def trainFromAnswers(req: TrainFromLanguageDataRequest):
                 best["value"] = current
                 best["metrics"] = metrics
                 best["model_type"] = clf.__class__.__name__
-                bow_models[model_id] = bow_extractor
-                bow_path = os.path.join(bow_model_dir, model_id + ".json")
-                with open(bow_path, "w") as bowf:
-                    json.dump(bow_extractor.__dict__, bowf)
 
         best_list["train_time"] = end - start
 
@@ -333,15 +279,15 @@ def trainFromAnswers(req: TrainFromLanguageDataRequest):
         # (accuracy, f1, cohens kappa)?
         if not best_model or accuracy > best_acc["value"]:
             best_model = clf
-            model_columns = list(x.columns)
+            # The BOW model is stored with the model whose features it made.
+            best_bow = bow_extractor
+            model_columns = sim_columns + list(bow_features.columns)
             num_features = clf.n_features_
 
-    # Write best results metrics to file
-    with open("model_metrics/" + model_id + ".json", "w") as score_file:
-        json.dump(best_metrics, score_file, indent=4)
-
-    # Store all models (no double storing if same model).
-    store_as_onnx(best_model, model_id, model_columns, num_features)
+    # Store the model with its BOW model and metrics.
+    store_as_onnx(
+        best_model, model_id, model_columns, num_features, best_metrics, best_bow
+    )
 
     return best_metrics
 
@@ -353,30 +299,30 @@ def do_training(
     model_id: str = None,
     include: List[str] = include_norm,
     dependent_variable: str = dependent_variable,
+    selection_budget: float = None,
 ) -> str:
+    """
+    Train a model with cross-validation and store the best fold model.
+
+    :param selection_budget: Seconds to select the classifier with successive
+        halving (see model_selection.py). By default MODEL_SELECTION_BUDGET;
+        0 fits the default random forest.
+    """
 
-    df_ = df[include]
     # The label is taken out before one-hot encoded variables are computed.
     # This is important not to have the one-hot transformation performed on the label.
-    y = df[dependent_variable]
-    df_.drop(columns=[dependent_variable], axis=1, inplace=True)
+    y = df[dependent_variable].to_numpy()
 
-    categoricals = []  # going to one-hot encode categorical variables
-
-    for col, col_type in df_.dtypes.items():
-        if col_type == "O":
-            categoricals.append(col)
-        else:
-            df_[col].fillna(
-                0, inplace=True
-            )  # fill NA's with 0 for ints/floats, too generic
-
-    # get_dummies effectively creates one-hot encoded variables
-    df_ohe = pd.get_dummies(df_, columns=categoricals, dummy_na=True)
-    x = df_ohe[df_ohe.columns.difference([dependent_variable])]
+    # Categorical variables are one-hot encoded, NA's of ints/floats are
+    # filled with 0 (too generic). The features are written into one float32
+    # matrix without intermediate copies of the DataFrame.
+    x, model_columns = training_matrix(
+        df, [col for col in include if col != dependent_variable]
+    )
 
     best_metrics = init_best_metrics(model_id)
     best_model = None
+    best_columns = None
 
     n_splits = (10 if x.shape[0] > 1000 else 5) if x.shape[0] > 50 else 2
 
@@ -384,35 +330,28 @@ def do_training(
     with lock:
 
         skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=2)
-        for train_ids, test_ids in skf.split(x, y):
-
-            start = time.time()
-
-            clf = RandomForestClassifier()
-
-            x_train = x.iloc[train_ids]
-            y_train = y.iloc[train_ids]
-            x_test = x.iloc[test_ids]
-            y_test = y.iloc[test_ids]
-
-            clf.fit(x_train, y_train)
-
-            y_pred = clf.predict(x_test)
-
-            end = time.time()
-
-            metrics = classification_report(
-                y_test, y_pred, output_dict=True, target_names=["False", "True"]
+        splits = list(skf.split(x, y))
+        if selection_budget is None:
+            selection_budget = model_selection_budget
+        if selection_budget > 0:
+            # The candidates are evaluated here, with the time spent on each
+            # of them in the metrics.
+            fold_results, report = model_selection.select_model(
+                x,
+                y,
+                splits,
+                selection_budget,
+                importance_threshold=feature_importance_threshold,
+            )
+            best_metrics[model_id]["model_selection"] = report
+        else:
+            # The folds are fitted on the registered CV workers, or here if
+            # there are none (see distributed_cv.py).
+            fold_results = distributed_cv.run_folds(
+                x, y, splits, feature_importance_threshold
             )
 
-            accuracy = accuracy_score(y_test, y_pred)
-            f1 = metrics["macro avg"]["f1-score"]
-            cohens_kappa = cohen_kappa_score(y_test, y_pred)
-
-            # Add accuracy and cohens kappa to the metrics dictionary.
-            metrics["accuracy"] = accuracy
-            metrics["cohens_kappa"] = cohens_kappa
-
+        for result in fold_results:
             best_list = best_metrics[model_id]
 
             best_acc = best_list["accuracy"]
@@ -420,28 +359,33 @@ def do_training(
             best_ck = best_list["cohens_kappa"]
 
             for best, current in zip(
-                (best_acc, best_f1, best_ck), (accuracy, f1, cohens_kappa)
+                (best_acc, best_f1, best_ck),
+                (result.accuracy, result.f1, result.cohens_kappa),
             ):
                 if current > best["value"]:
                     best["value"] = current
-                    best["metrics"] = metrics
-                    best["model_type"] = clf.__class__.__name__
+                    best["metrics"] = result.metrics
+                    best["model_type"] = result.model.__class__.__name__
 
-            best_list["train_time"] = end - start
+            best_list["train_time"] = result.train_time
 
             # TODO: How to determine which model should be stored 
             # (accuracy, f1, cohens kappa)?
-            if not best_model or accuracy > best_acc["value"]:
-                best_model = clf
-
-    # Write best results metrics to file
-    with open("model_metrics/" + model_id + ".json", "w") as score_file:
-        json.dump(best_metrics, score_file, indent=4)
-
-    model_columns = list(x.columns)
-    num_features = x.shape[1]
-    # Store all models (no double storing if same model).
-    store_as_onnx(best_model, model_id, model_columns, num_features)
+            if not best_model or result.accuracy > best_acc["value"]:
+                best_model = result.model
+                best_columns = result.columns
+
+    if feature_importance_threshold > 0:
+        # The columns that were dropped on the training rows of the fold of
+        # the stored model.
+        kept = set(best_columns)
+        best_metrics[model_id]["pruned_features"] = [
+            name for index, name in enumerate(model_columns) if index not in kept
+        ]
+    model_columns = [model_columns[index] for index in best_columns]
+    num_features = len(best_columns)
+    # Store the model with its metrics.
+    store_as_onnx(best_model, model_id, model_columns, num_features, best_metrics)
 
     return best_metrics
 
@@ -471,64 +415,39 @@ def init_best_metrics(model_id):
     return metrics_out
 
 
-def store_as_onnx(model, model_id, model_columns, num_features):
+def store_as_onnx(
+    model, model_id, model_columns, num_features, metrics, bow_extractor=None
+):
+    """
+    Store a trained model with all its artifacts and swap in its session.
+
+    The model is converted and bundled with its model columns, metrics and
+    BOW model in memory, written with one atomic rename (see artifacts.py)
+    and loaded from the same bytes, not read back from the file.
+    """
     initial_type = [("float_input", FloatTensorType([None, num_features]))]
     clf_onnx = convert_sklearn(model, initial_types=initial_type, target_opset=12)
 
-    # Manually pass the model columns to the converted model using the
-    # metadata_props attribute.
-    new_meta = clf_onnx.metadata_props.add()
-    new_meta.key = "model_columns"
-    # The metadata lists must be converted to a string because the
-    # metadata_props attribute only allows sending strings.
-    new_meta.value = " ".join(model_columns)
-
-    with open("{}/{}.onnx".format(onnx_model_dir, model_id), "wb") as onnx_file:
-        onnx_file.write(clf_onnx.SerializeToString())
-
-    # Store an inference session for this model to be used during prediction.
-    inf_sessions[model_id] = rt.InferenceSession(
-        "{}/{}.onnx".format(onnx_model_dir, model_id)
+    bow_state = bow_extractor.__dict__ if bow_extractor is not None else None
+    model_bytes = artifacts.bundle(clf_onnx, model_columns, metrics, bow_state)
+    artifacts.write_atomic(
+        os.path.join(onnx_model_dir, model_id + ".onnx"), model_bytes
     )
 
+    # Store an inference session for this model to be used during prediction.
+    inference.load_session(model_id, model_bytes)
 
-@app.post("/predictFromAnswers", response_model=PredictFromLanguageDataResponse)
-def predictFromAnswers(req: PredictFromLanguageDataRequest):
-    model_id = req.modelId
-
-    if model_id not in [model.rstrip(".onnx") for model in os.listdir(onnx_model_dir)]:
-        raise HTTPException(
-            status_code=422,
-            detail='Model with model ID "{}" could not be'
-            " found in the ONNX model directory."
-            " Please train first.".format(model_id),
-        )
-    if model_id not in [model.rstrip(".json") for model in os.listdir(bow_model_dir)]:
-        raise HTTPException(
-            status_code=422,
-            detail='BOW Model with model ID "{}" could not be'
-            " found in the Bag of words model directory."
-            " Please check that the model was trained with training"
-            " instances (not with CAS).".format(model_id),
+    # Write best results metrics to file
+    artifacts.write_json_atomic(
+        os.path.join(metrics_dir, model_id + ".json"), metrics, indent=4
+    )
+    if bow_state is not None:
+        artifacts.write_json_atomic(
+            os.path.join(bow_model_dir, model_id + ".json"), bow_state
         )
 
-    bow_extractor = bow_models[model_id]
-    ft_extractors = [SIMGroupExtractor(), bow_extractor]
-
-    predictions = []
 
-    for instance in req.instances:        
-        data = pd.DataFrame()
-        for ft_extractor in ft_extractors:
-            data = pd.concat([data, ft_extractor.extract([instance])], axis=1)
-
-        predictions.append(do_prediction(data, model_id))
-
-    return {"predictions": predictions}
-
-
-@app.post("/train")
-def train(req: TrainingInstance):
+def train_from_file(req: TrainingInstance):
     model_id = req.modelId
     file_name = req.fileName
 
@@ -540,7 +459,7 @@ def train(req: TrainingInstance):
         )
 
     df = pd.read_csv(file_name, delimiter="\t")
-    return do_training(df, model_id)
+    return do_training(df, model_id, selection_budget=req.selectionBudget)
 
 
 @app.get("/wipe_models")
@@ -0,0 +1,243 @@
+"""
+Time-budgeted model selection with successive halving.
+
+Instead of fitting a default random forest on every fold, do_training can
+select among candidate classifiers (random forests of several sizes and
+depths and an SVC) within a wall-clock budget. All candidates are first
+evaluated on the folds with a small stratified sample of the training rows.
+The best 1/eta of them are evaluated again with eta times as many rows, and
+so on, until the last ones get the full cross-validation.
+
+A candidate is only evaluated in a round if its expected time still fits
+into the budget: its time in the previous round scaled to eta times as many
+rows, or, in the first round, the time of a smaller candidate of the same
+kind scaled by the number of estimators. A candidate of a kind that has not
+been evaluated yet is first fitted on a few rows (a probe), and that time is
+scaled to the rows of the round. The fitting time of a forest grows about
+linearly with the rows, that of a kernel SVC with their square. When the budget is used up, the best candidate of the last
+round that was evaluated is chosen, and it is cross-validated on all rows
+even if that exceeds the budget, so that the stored model is never fitted
+on a sample of the training rows.
+"""
+import math
+import time
+
+import numpy as np
+
+from distributed_cv import FoldResult
+from distributed_cv import Split
+from distributed_cv import fit_fold
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.svm import SVC
+from training_data import FoldMatrices
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+# The number of training rows a candidate is fitted on to estimate its time.
+PROBE_ROWS = 50
+
+
+class Candidate(NamedTuple):
+    estimator: type
+    params: Dict
+
+    @property
+    def name(self) -> str:
+        return "{}({})".format(
+            self.estimator.__name__,
+            ", ".join("{}={}".format(key, value) for key, value in sorted(self.params.items())),
+        )
+
+    def make(self):
+        return self.estimator(**self.params)
+
+    @property
+    def size(self) -> int:
+        # The fitting time of an ensemble grows with its number of estimators.
+        return self.params.get("n_estimators", 1)
+
+    @property
+    def row_exponent(self) -> int:
+        # The fitting time of a kernel SVC grows with the square of the rows.
+        return 2 if issubclass(self.estimator, SVC) else 1
+
+
+def estimate_time(
+    candidate: Candidate, previous_time: float, eta: int, times: List[Tuple[Candidate, float]]
+) -> Optional[float]:
+    """
+    The expected time of a candidate in a round: its time in the previous
+    round scaled to eta times as many rows, or, in the first round, the time
+    of a candidate with the same estimator in this round scaled by the sizes
+    (None if there is none).
+    """
+    if previous_time is not None:
+        return previous_time * eta ** candidate.row_exponent
+    estimates = [
+        elapsed / other.size * candidate.size
+        for other, elapsed in times
+        if other.estimator is candidate.estimator
+    ]
+    return max(estimates) if estimates else None
+
+
+def default_candidates() -> List[Candidate]:
+    candidates = [
+        Candidate(RandomForestClassifier, {"n_estimators": n_estimators, "max_depth": max_depth})
+        for n_estimators in (10, 50, 100, 300)
+        for max_depth in (None, 8)
+    ]
+    # The probabilities are needed for the classProbabilities of predictions.
+    candidates.append(Candidate(SVC, {"gamma": "scale", "probability": True}))
+    return candidates
+
+
+def subsample(
+    train_ids: np.ndarray, y: np.ndarray, fraction: float, random: np.random.RandomState
+) -> np.ndarray:
+    """A sorted sample of the training rows with the same class proportions."""
+    if fraction >= 1:
+        return train_ids
+    sample = []
+    for label in np.unique(y[train_ids]):
+        label_ids = train_ids[y[train_ids] == label]
+        size = max(int(math.ceil(fraction * len(label_ids))), 1)
+        sample.append(random.choice(label_ids, size, replace=False))
+    return np.sort(np.concatenate(sample))
+
+
+def select_model(
+    x: np.ndarray,
+    y: np.ndarray,
+    splits: List[Split],
+    budget: float,
+    candidates: List[Candidate] = None,
+    eta: int = 3,
+    random_state: int = 2,
+    importance_threshold: float = 0.0,
+) -> Tuple[List[FoldResult], dict]:
+    """
+    Select a classifier with successive halving within a time budget.
+
+    :param splits: The cross-validation folds.
+    :param budget: The wall-clock budget in seconds.
+    :param eta: The factor by which the candidates are reduced and the rows
+        are increased from one round to the next.
+    :param importance_threshold: See distributed_cv.fit_fold.
+    :return: The fold results of the chosen candidate on all training rows
+        and a report with the rounds and the time spent on every candidate.
+    """
+    start = time.time()
+    if candidates is None:
+        candidates = default_candidates()
+    random = np.random.RandomState(random_state)
+    folds = FoldMatrices(x)
+
+    # Enough rounds for one candidate to be left in the last one.
+    n_rounds = 1
+    while eta ** (n_rounds - 1) < len(candidates):
+        n_rounds += 1
+    report = {
+        "budget": budget,
+        "candidates": {
+            candidate.name: {"time": 0.0, "rounds": []} for candidate in candidates
+        },
+    }
+
+    def evaluate(candidate: Candidate, samples: List[Split], fraction: float):
+        """Cross-validate a candidate on the sampled folds and report it."""
+        candidate_start = time.time()
+        results = []
+        for fold, (train_ids, test_ids) in enumerate(samples):
+            x_train, x_test = folds.split(train_ids, test_ids)
+            results.append(
+                fit_fold(
+                    fold,
+                    x_train,
+                    y[train_ids],
+                    x_test,
+                    y[test_ids],
+                    estimator=candidate.make(),
+                    importance_threshold=importance_threshold,
+                )
+            )
+        elapsed = time.time() - candidate_start
+        candidate_report = report["candidates"][candidate.name]
+        candidate_report["time"] += elapsed
+        candidate_report["rounds"].append(
+            {
+                "fraction": fraction,
+                "accuracy": float(np.mean([result.accuracy for result in results])),
+                "f1": float(np.mean([result.f1 for result in results])),
+                "cohens_kappa": float(np.mean([result.cohens_kappa for result in results])),
+                "time": elapsed,
+            }
+        )
+        return results, elapsed
+
+    def probe(candidate: Candidate, samples: List[Split]) -> float:
+        """
+        Estimate the time of a candidate on the sampled folds from a fit on
+        PROBE_ROWS rows of the first one.
+        """
+        probe_start = time.time()
+        train_ids = samples[0][0]
+        probe_ids = subsample(
+            train_ids,
+            y,
+            PROBE_ROWS / len(train_ids),
+            np.random.RandomState(random_state),
+        )
+        candidate.make().fit(x[probe_ids], y[probe_ids])
+        elapsed = time.time() - probe_start
+        report["candidates"][candidate.name]["time"] += elapsed
+        scale = (len(train_ids) / len(probe_ids)) ** candidate.row_exponent
+        return elapsed * max(scale, 1) * len(samples)
+
+    last_time = {}
+    survivors = list(range(len(candidates)))
+    chosen = None
+
+    for round_index in range(n_rounds):
+        fraction = float(eta) ** (round_index - n_rounds + 1)
+        samples = [
+            (subsample(train_ids, y, fraction, random), test_ids)
+            for train_ids, test_ids in splits
+        ]
+        evaluated = []
+        round_times = []
+        for index in survivors:
+            candidate = candidates[index]
+            remaining = budget - (time.time() - start)
+            estimate = estimate_time(candidate, last_time.get(index), eta, round_times)
+            # The first candidate is always evaluated, to have a model.
+            if evaluated or chosen is not None:
+                if estimate is None and remaining > 0:
+                    estimate = probe(candidate, samples)
+                    remaining = budget - (time.time() - start)
+                if remaining <= 0 or estimate > remaining:
+                    continue
+            results, elapsed = evaluate(candidate, samples, fraction)
+            last_time[index] = elapsed
+            round_times.append((candidate, elapsed))
+            evaluated.append((float(np.mean([r.accuracy for r in results])), index, results))
+
+        if not evaluated:
+            break
+        evaluated.sort(key=lambda item: -item[0])
+        chosen = evaluated[0]
+        survivors = [index for _, index, _ in evaluated[: max(len(evaluated) // eta, 1)]]
+
+    _, index, results = chosen
+    candidate = candidates[index]
+    report["chosen"] = candidate.name
+    # Whether the chosen candidate reached the full cross-validation within
+    # the budget. If not, it is cross-validated on all rows now.
+    report["full_cv"] = report["candidates"][candidate.name]["rounds"][-1]["fraction"] >= 1
+    if not report["full_cv"]:
+        results, _ = evaluate(candidate, splits, 1.0)
+    report["time"] = time.time() - start
+    return results, report
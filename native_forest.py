@@ -0,0 +1,315 @@
+"""
+Packed-array evaluation of the random forests the service trains.
+
+store_as_onnx exports every model as an ONNX TreeEnsembleClassifier followed
+by a ZipMap. PackedForest compiles that node into flat NumPy arrays (feature,
+threshold and children of every node of every tree, and the class weights of
+the leaves) and evaluates all rows and trees at once, one tree level per step.
+It returns the same probability dictionaries as the onnxruntime session.
+
+Every step is a few NumPy calls, whose overhead dominates for a single row.
+So unless the forest has many nodes for its depth, a single row is compared
+with all nodes at once first, and a step is a single lookup of the next node.
+
+Which models are evaluated with it is configured in inference.py. To compare
+it with onnxruntime on a model:
+
+    python native_forest.py onnx_models/default.onnx
+"""
+import argparse
+import time
+
+import numpy as np
+
+from typing import Dict
+from typing import List
+from typing import Union
+
+LEAF = b"LEAF"
+BRANCH_LEQ = b"BRANCH_LEQ"
+
+# About how many nodes are compared with a row in the time of one step of
+# PackedForest.leaves.
+NODES_PER_STEP = 1000
+
+
+class PackedForest:
+    """
+    A tree ensemble classifier in packed arrays.
+
+    Node i of the packed forest is stored at index 2 * i, so that the next
+    node is children[node + (x <= threshold)], with the false child first.
+    Leaves are their own children, which lets all trees take the same number
+    of steps.
+
+    :param feature: Feature index of every (doubled) node.
+    :param threshold: Threshold of every (doubled) node.
+    :param children: False and true child of every node (doubled indices).
+    :param tracks_true: Whether a missing value goes to the true child.
+    :param roots: The (doubled) root of every tree.
+    :param depth: The number of steps to reach every leaf.
+    :param leaf_weights: Class weights of every (doubled) node.
+    :param labels: The class labels.
+    :param binary: Whether leaf_weights only has the weight of the second
+        class, the first one is 1 minus it.
+    """
+
+    def __init__(
+        self,
+        feature: np.ndarray,
+        threshold: np.ndarray,
+        children: np.ndarray,
+        tracks_true: np.ndarray,
+        roots: np.ndarray,
+        depth: int,
+        leaf_weights: np.ndarray,
+        labels: List[Union[int, str]],
+        binary: bool,
+    ):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.tracks_true = tracks_true if tracks_true.any() else None
+        self.roots = roots
+        self.depth = depth
+        self.leaf_weights = leaf_weights
+        self.labels = labels
+        self.binary = binary
+        # The same nodes without the doubling, for the table of next nodes.
+        self.node_feature = np.ascontiguousarray(feature[0::2])
+        self.node_threshold = np.ascontiguousarray(threshold[0::2])
+        self.node_tracks_true = np.ascontiguousarray(tracks_true[0::2])
+        self.false_child = children[0::2] // 2
+        self.true_child = children[1::2] // 2
+        self.node_roots = roots // 2
+
+    @classmethod
+    def from_onnx(cls, model: Union[bytes, str]) -> "PackedForest":
+        """
+        Compile the TreeEnsembleClassifier of an ONNX model.
+
+        :param model: The serialized model or the path of the model file.
+        :raises ValueError: If the model is not a tree ensemble this class can
+            evaluate like onnxruntime.
+        """
+        # onnx is a dependency of skl2onnx, it is only needed here.
+        import onnx
+        from onnx import helper
+
+        if isinstance(model, bytes):
+            model = onnx.load_model_from_string(model)
+        else:
+            model = onnx.load(model)
+        ensembles = [
+            node for node in model.graph.node if node.op_type == "TreeEnsembleClassifier"
+        ]
+        if len(ensembles) != 1:
+            raise ValueError("The model has no single TreeEnsembleClassifier.")
+        attributes = {
+            attribute.name: helper.get_attribute_value(attribute)
+            for attribute in ensembles[0].attribute
+        }
+        if attributes.get("post_transform", b"NONE") != b"NONE":
+            raise ValueError("Only post_transform NONE is supported.")
+        if attributes.get("base_values"):
+            raise ValueError("base_values are not supported.")
+        modes = attributes["nodes_modes"]
+        if set(modes) - {LEAF, BRANCH_LEQ}:
+            raise ValueError("Only BRANCH_LEQ nodes are supported.")
+
+        if "classlabels_int64s" in attributes:
+            labels = list(attributes["classlabels_int64s"])
+        else:
+            labels = [label.decode() for label in attributes["classlabels_strings"]]
+
+        tree_ids = attributes["nodes_treeids"]
+        node_ids = attributes["nodes_nodeids"]
+        n_nodes = len(tree_ids)
+        index = {node: i for i, node in enumerate(zip(tree_ids, node_ids))}
+        n_missing = n_nodes - len(attributes.get("nodes_missing_value_tracks_true", []))
+
+        is_leaf = np.array([mode == LEAF for mode in modes])
+        own = np.arange(n_nodes)
+        false_child = np.array(
+            [index[tree, child] for tree, child in zip(tree_ids, attributes["nodes_falsenodeids"])]
+        )
+        true_child = np.array(
+            [index[tree, child] for tree, child in zip(tree_ids, attributes["nodes_truenodeids"])]
+        )
+        false_child = np.where(is_leaf, own, false_child)
+        true_child = np.where(is_leaf, own, true_child)
+
+        feature = np.where(is_leaf, 0, attributes["nodes_featureids"]).astype(np.intp)
+        threshold = np.asarray(attributes["nodes_values"], dtype=np.float32)
+        tracks_true = np.concatenate(
+            [
+                np.asarray(attributes.get("nodes_missing_value_tracks_true", []), dtype=bool),
+                np.zeros(n_missing, dtype=bool),
+            ]
+        ) & ~is_leaf
+
+        children = np.empty(2 * n_nodes, dtype=np.intp)
+        children[0::2] = 2 * false_child
+        children[1::2] = 2 * true_child
+
+        class_ids = np.asarray(attributes["class_ids"])
+        binary = len(labels) == 2 and len(set(class_ids)) == 1
+        leaf_weights = np.zeros((2 * n_nodes, 1 if binary else len(labels)), dtype=np.float32)
+        for tree, node, class_id, weight in zip(
+            attributes["class_treeids"],
+            attributes["class_nodeids"],
+            class_ids,
+            attributes["class_weights"],
+        ):
+            leaf_weights[2 * index[tree, node], 0 if binary else class_id] += weight
+
+        # The trees in the order onnxruntime adds up their scores.
+        roots = np.array(
+            [2 * index[tree, 0] for tree in sorted(set(tree_ids))], dtype=np.intp
+        )
+        depth = _depth(true_child, false_child, is_leaf, roots // 2)
+
+        return cls(
+            feature=np.repeat(feature, 2),
+            threshold=np.repeat(threshold, 2),
+            children=children,
+            tracks_true=np.repeat(tracks_true, 2),
+            roots=roots,
+            depth=depth,
+            leaf_weights=leaf_weights,
+            labels=labels,
+            binary=binary,
+        )
+
+    def leaves(self, x: np.ndarray) -> np.ndarray:
+        """The (doubled) leaf index of every row in every tree, shape (trees, rows)."""
+        n_rows, n_features = x.shape
+        if n_rows == 1 and len(self.node_threshold) <= NODES_PER_STEP * self.depth:
+            return self.row_leaves(np.asarray(x[0], dtype=np.float32))[:, None]
+
+        flat_x = np.ascontiguousarray(x, dtype=np.float32).ravel()
+        node = np.repeat(self.roots[:, None], n_rows, axis=1)
+        row_offset = np.arange(n_rows) * n_features
+        for _ in range(self.depth):
+            values = flat_x[self.feature[node] + row_offset]
+            go_true = values <= self.threshold[node]
+            if self.tracks_true is not None:
+                go_true |= np.isnan(values) & self.tracks_true[node]
+            node = self.children[node + go_true]
+        return node
+
+    def row_leaves(self, row: np.ndarray) -> np.ndarray:
+        """
+        The (doubled) leaf index of a single row in every tree, from the next
+        node of every node for the row.
+        """
+        values = row[self.node_feature]
+        go_true = values <= self.node_threshold
+        if self.tracks_true is not None:
+            go_true |= np.isnan(values) & self.node_tracks_true
+        next_node = np.where(go_true, self.true_child, self.false_child)
+        node = self.node_roots
+        for _ in range(self.depth):
+            node = next_node.take(node)
+        return 2 * node
+
+    def predict_proba(self, x: np.ndarray) -> np.ndarray:
+        """
+        The class probabilities of the rows of x, in the order of labels.
+
+        The scores of the trees are added up one tree after the other in
+        float32, as onnxruntime does.
+        """
+        scores = np.add.reduce(self.leaf_weights[self.leaves(x)], axis=0)
+        if self.binary:
+            return np.concatenate([np.float32(1) - scores, scores], axis=1)
+        return scores
+
+    def run(self, x: np.ndarray) -> List[Dict[Union[int, str], float]]:
+        """The probabilities like the ZipMap output of the onnxruntime session."""
+        return [dict(zip(self.labels, row)) for row in self.predict_proba(x).tolist()]
+
+
+def _depth(
+    true_child: np.ndarray, false_child: np.ndarray, is_leaf: np.ndarray, roots: np.ndarray
+) -> int:
+    depth = 0
+    level = roots
+    while not is_leaf[level].all():
+        level = level[~is_leaf[level]]
+        level = np.concatenate([true_child[level], false_child[level]])
+        depth += 1
+    return depth
+
+
+def benchmark(
+    model_path: str, batch_sizes: List[int], seconds: float = 1.0, seed: int = 0
+) -> List[dict]:
+    """
+    Time a model with onnxruntime and with PackedForest on random inputs.
+
+    :return: Per batch size the mean seconds per call of both backends and
+        the largest difference of their probabilities.
+    """
+    import onnxruntime as rt
+
+    session = rt.InferenceSession(model_path)
+    input_name = session.get_inputs()[0].name
+    label_name = session.get_outputs()[1].name
+    n_features = session.get_inputs()[0].shape[1]
+    forest = PackedForest.from_onnx(model_path)
+    random = np.random.RandomState(seed)
+
+    results = []
+    for batch_size in batch_sizes:
+        x = random.rand(batch_size, n_features).astype(np.float32)
+        result = {"batch_size": batch_size}
+        outputs = {}
+        for backend, predict in (
+            ("onnxruntime", lambda: session.run([label_name], {input_name: x})[0]),
+            ("native", lambda: forest.run(x)),
+        ):
+            calls = 0
+            start = time.perf_counter()
+            while True:
+                outputs[backend] = predict()
+                calls += 1
+                elapsed = time.perf_counter() - start
+                if elapsed >= seconds:
+                    break
+            result[backend] = elapsed / calls
+        result["max_difference"] = max(
+            abs(expected[label] - actual[label])
+            for expected, actual in zip(outputs["onnxruntime"], outputs["native"])
+            for label in forest.labels
+        )
+        results.append(result)
+    return results
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(
+        description="Compare onnxruntime and the packed forest on a model."
+    )
+    parser.add_argument("model", help="an ONNX model file")
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=[1, 10, 100, 1000, 10000]
+    )
+    parser.add_argument("--seconds", type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    print("{:>10} {:>14} {:>14} {:>14}".format("batch", "onnxruntime", "native", "max diff"))
+    for result in benchmark(args.model, args.batch_sizes, args.seconds):
+        print(
+            "{batch_size:>10} {onnxruntime:>12.1f}us {native:>12.1f}us"
+            " {max_difference:>14.2e}".format(
+                batch_size=result["batch_size"],
+                onnxruntime=result["onnxruntime"] * 1e6,
+                native=result["native"] * 1e6,
+                max_difference=result["max_difference"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
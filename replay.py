@@ -0,0 +1,309 @@
+"""
+Load test with captured traffic.
+
+Replays the requests of a capture file (see capture.py) against a running
+instance of the service and reports the throughput, latency percentiles and
+error rate of every endpoint. Redacted CASes are replaced by XMI files of a
+corpus (testdata/xmi by default) and redacted answers by one of the targets of
+their item, so the requests keep the shape of the captured ones.
+
+Requests are sent by --concurrency threads, either
+- at the captured pace, sped up by --speed (the default),
+- at a fixed rate of --qps requests per second, or
+- as fast as possible with --qps 0.
+With --duration the capture is repeated until the time is up.
+
+Example, with a locally started inference-only instance:
+    python replay.py traffic.jsonl --start "uvicorn serve:app --port 9999" \\
+        --concurrency 16 --qps 100 --duration 60
+"""
+import argparse
+import base64
+import json
+import os
+import queue
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+DEFAULT_URL = "http://localhost:9999"
+
+
+def load_records(path: str) -> List[dict]:
+    with open(path) as in_file:
+        return [json.loads(line) for line in in_file if line.strip()]
+
+
+def _redacted_digest(value) -> Optional[str]:
+    """The hex digest of a redacted value, None if the value is not redacted."""
+    if not isinstance(value, dict) or len(value) != 2 or "length" not in value:
+        return None
+    return value.get("hmac")
+
+
+class PayloadFiller:
+    """
+    Rebuild request bodies from redacted records.
+
+    The same hash always gets the same replacement, so repeated CASes and
+    answers stay repeated.
+
+    :param cas_corpus: XMI files for the redacted CASes.
+    """
+
+    def __init__(self, cas_corpus: List[str]):
+        self.cases = []
+        for path in cas_corpus:
+            with open(path, "rb") as xmi_file:
+                self.cases.append(base64.b64encode(xmi_file.read()).decode())
+
+    def fill(self, body):
+        if isinstance(body, list):
+            return [self.fill(value) for value in body]
+        if not isinstance(body, dict):
+            return body
+        filled = {}
+        for key, value in body.items():
+            digest = _redacted_digest(value)
+            if digest is None:
+                filled[key] = self.fill(value)
+                continue
+            number = int(digest[:8], 16)
+            if key == "cas":
+                if not self.cases:
+                    raise ValueError("A CAS corpus is needed to replay redacted CASes.")
+                filled[key] = self.cases[number % len(self.cases)]
+            elif key == "answer" and body.get("itemTargets"):
+                filled[key] = body["itemTargets"][number % len(body["itemTargets"])]
+            else:
+                filled[key] = digest[: max(value["length"], 1)]
+        return filled
+
+
+def schedule(
+    records: List[dict], qps: float = None, speed: float = 1.0, duration: float = None
+) -> Iterator[Tuple[float, dict]]:
+    """
+    Yield (seconds after the start, record) in sending order.
+
+    :param qps: A fixed rate; 0 for no pacing; None for the captured pace.
+    :param speed: How much faster than captured to replay.
+    :param duration: Repeat the records until this many seconds are scheduled.
+    """
+    if not records:
+        return
+    first = records[0]["time"]
+    span = records[-1]["time"] - first
+    # A repeated capture continues one mean request gap after its end.
+    gap = span / (len(records) - 1) if len(records) > 1 else 1.0
+    index = 0
+    rounds = 0
+    while True:
+        for record in records:
+            if qps is None:
+                offset = (rounds * (span + gap) + record["time"] - first) / speed
+            else:
+                offset = index / qps if qps > 0 else 0.0
+            if duration is not None and offset >= duration:
+                return
+            yield offset, record
+            index += 1
+        if duration is None:
+            return
+        rounds += 1
+
+
+class Result:
+    __slots__ = ["endpoint", "latency", "status", "error"]
+
+    def __init__(self, endpoint: str, latency: float, status: int, error: str):
+        self.endpoint = endpoint
+        self.latency = latency
+        self.status = status
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and 200 <= self.status < 300
+
+
+def run(
+    url: str,
+    requests_to_send: Iterator[Tuple[float, dict]],
+    filler: PayloadFiller,
+    concurrency: int,
+    paced: bool,
+    timeout: float = 60.0,
+    duration: float = None,
+) -> Tuple[List[Result], float]:
+    """
+    Send the scheduled requests with a pool of threads.
+
+    The latency of a paced request is measured from the time it was scheduled
+    for, so that a slow server is not hidden by requests that are sent late.
+
+    :return: The results and the elapsed seconds.
+    """
+    pending = queue.Queue(maxsize=concurrency * 4)
+    results = []
+    results_lock = threading.Lock()
+
+    def worker():
+        session = requests.Session()
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            due, record = item
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            start = due if paced else time.perf_counter()
+            status, error = 0, None
+            try:
+                response = session.post(
+                    url + record["endpoint"], json=filler.fill(record["body"]), timeout=timeout
+                )
+                status = response.status_code
+            except requests.RequestException as e:
+                error = e.__class__.__name__
+            result = Result(record["endpoint"], time.perf_counter() - start, status, error)
+            with results_lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    for offset, record in requests_to_send:
+        if duration is not None and time.perf_counter() - start >= duration:
+            break
+        pending.put((start + offset, record))
+    for _ in threads:
+        pending.put(None)
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def summarize(results: List[Result], elapsed: float) -> dict:
+    """
+    Throughput, latency percentiles (in milliseconds) and errors per endpoint
+    and for all requests together ("all").
+    """
+    by_endpoint = {"all": results}
+    for result in results:
+        by_endpoint.setdefault(result.endpoint, []).append(result)
+
+    summary = {}
+    for endpoint, endpoint_results in by_endpoint.items():
+        latencies = np.array([result.latency for result in endpoint_results]) * 1000
+        errors = [result for result in endpoint_results if not result.ok]
+        statuses = {}
+        for result in endpoint_results:
+            key = result.error or str(result.status)
+            statuses[key] = statuses.get(key, 0) + 1
+        summary[endpoint] = {
+            "requests": len(endpoint_results),
+            "throughput": len(endpoint_results) / elapsed if elapsed > 0 else 0.0,
+            "errors": len(errors),
+            "error_rate": len(errors) / len(endpoint_results) if endpoint_results else 0.0,
+            "statuses": statuses,
+        }
+        for name, percentile in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100)):
+            summary[endpoint][name] = (
+                float(np.percentile(latencies, percentile)) if len(latencies) else None
+            )
+    return summary
+
+
+def start_instance(
+    command: str, url: str, timeout: float = 60.0, env: dict = None
+) -> subprocess.Popen:
+    """Start the service and wait until it answers."""
+    process = subprocess.Popen(shlex.split(command), env=env)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The instance exited with code {}".format(process.returncode))
+        try:
+            requests.get(url + "/docs", timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("The instance did not start within {} seconds".format(timeout))
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Load test with captured traffic.")
+    parser.add_argument("capture", help="a capture file of capture.py")
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--start", help="command that starts a local instance at --url")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--qps", type=float, default=None, help="0 for no pacing")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--duration", type=float, default=None, help="seconds")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--cas-corpus", default="testdata/xmi")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args(argv)
+
+    corpus = []
+    if os.path.isdir(args.cas_corpus):
+        corpus = [
+            os.path.join(args.cas_corpus, file_name)
+            for file_name in sorted(os.listdir(args.cas_corpus))
+            if file_name.endswith(".xmi")
+        ]
+    filler = PayloadFiller(corpus)
+    records = load_records(args.capture)
+
+    process = start_instance(args.start, args.url) if args.start else None
+    try:
+        results, elapsed = run(
+            args.url,
+            schedule(records, args.qps, args.speed, args.duration),
+            filler,
+            args.concurrency,
+            paced=args.qps != 0,
+            timeout=args.timeout,
+            duration=args.duration,
+        )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    if not results:
+        print("No requests were sent.", file=sys.stderr)
+        return
+    summary = summarize(results, elapsed)
+    if args.json:
+        print(json.dumps(summary, indent=4))
+        return
+    print(
+        "{:<22} {:>8} {:>9} {:>8} {:>9} {:>9} {:>9} {:>9}".format(
+            "endpoint", "requests", "req/s", "errors", "p50 ms", "p90 ms", "p99 ms", "max ms"
+        )
+    )
+    for endpoint, stats in summary.items():
+        print(
+            "{:<22} {requests:>8} {throughput:>9.1f} {error_rate:>7.1%} {p50:>9.1f}"
+            " {p90:>9.1f} {p99:>9.1f} {max:>9.1f}".format(endpoint, **stats)
+        )
+    print("elapsed {:.1f}s".format(elapsed), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
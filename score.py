@@ -0,0 +1,316 @@
+"""
+Offline bulk scoring of archived answers without the web service.
+
+Inputs are XMI files (or directories of them, like testdata/xmi) and JSONL
+files with one ShortAnswerInstance per line. CAS parsing and feature
+extraction run in a process pool, the inference is done in batches with the
+model loading and prediction code of inference.py and the predictions are
+appended to a JSONL or CSV file as soon as a batch is done.
+
+Every input gets an id (the XMI path or "<jsonl path>:<line number>").
+Ids that already have a prediction in the output file are skipped, so an
+interrupted run can simply be started again. A partial last line that the
+interrupted run left in the output file is cut off before appending.
+
+Example:
+    python score.py --model-id default testdata/xmi --output predictions.jsonl
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+from itertools import islice
+from multiprocessing import Pool
+from typing import Iterator
+from typing import List
+from typing import Set
+from typing import Tuple
+
+import pandas as pd
+
+# An input to score: (id, kind, payload). The payload of a CAS is the path of
+# the XMI file, the payload of an instance is the parsed JSON object.
+Task = Tuple[str, str, object]
+
+CAS = "cas"
+INSTANCE = "instance"
+
+# Feature extraction state of a pool worker, set up by _init_worker.
+_worker = {}
+
+
+def iter_tasks(paths: List[str]) -> Iterator[Task]:
+    """
+    Stream the inputs from disk in a stable order.
+
+    :param paths: XMI files, directories with XMI files and JSONL files.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for file_name in sorted(os.listdir(path)):
+                if file_name.endswith(".xmi"):
+                    yield os.path.join(path, file_name), CAS, os.path.join(path, file_name)
+        elif path.endswith(".jsonl"):
+            with open(path) as in_file:
+                for line_number, line in enumerate(in_file, 1):
+                    if line.strip():
+                        yield "{}:{}".format(path, line_number), INSTANCE, json.loads(line)
+        else:
+            yield path, CAS, path
+
+
+def read_done_ids(output: str) -> Set[str]:
+    """Collect the ids that already have a prediction in the output file."""
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, newline="") as out_file:
+        # A partial last line of an interrupted run has no prediction, it is
+        # cut off by PredictionWriter.
+        lines = (line for line in out_file if line.endswith("\n"))
+        if output.endswith(".csv"):
+            records = csv.DictReader(lines)
+        else:
+            records = (json.loads(line) for line in lines if line.strip())
+        for record in records:
+            if not record.get("error"):
+                done.add(record["id"])
+    return done
+
+
+def truncate_partial_line(output: str):
+    """Cut a partial last line, left by an interrupted run, off the output file."""
+    with open(output, "rb+") as out_file:
+        end = out_file.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(position - 4096, 0)
+            out_file.seek(start)
+            newline = out_file.read(position - start).rfind(b"\n")
+            if newline >= 0:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            out_file.truncate(position)
+
+
+def _init_worker(bag: List[str]):
+    # Every worker process sets up its own type system and extractors once.
+    from features import uima
+    from features.extractor import FeatureExtraction
+    from features.feature_groups import BOWGroupExtractor
+    from cas_loading import SelectiveCasLoader
+    from similarity import BatchSIMGroupExtractor
+
+    _worker["cas_loader"] = SelectiveCasLoader(uima.load_isaac_ts(), FeatureExtraction())
+    _worker["ft_extractors"] = [BatchSIMGroupExtractor()]
+    if bag is not None:
+        bow_extractor = BOWGroupExtractor([])
+        bow_extractor.bag = bag
+        _worker["ft_extractors"].append(bow_extractor)
+
+
+def extract_batch(batch: List[Task]) -> List[Tuple[str, dict, str]]:
+    """
+    Extract the features of a batch of inputs in a pool worker.
+
+    :param batch: The tasks to extract.
+    :return: One (id, features, error) triple per task. The features are None
+        if the extraction failed.
+    """
+    from features.data import ShortAnswerInstance
+
+    results = {}
+    instances = []
+    for task_id, kind, payload in batch:
+        try:
+            if kind == CAS:
+                with open(payload, "rb") as xmi_file:
+                    feats = _worker["cas_loader"].extract(xmi_file.read())
+                results[task_id] = ({k: v[0] for k, v in feats.items()}, None)
+            else:
+                if len(_worker["ft_extractors"]) < 2:
+                    raise ValueError("The model has no BOW model for answer instances.")
+                instances.append((task_id, ShortAnswerInstance(**payload)))
+        except Exception as e:
+            results[task_id] = (None, "{}: {}".format(e.__class__.__name__, e))
+
+    if instances:
+        # Short answer instances are extracted together to use the batched
+        # similarity kernels, so they fail together.
+        try:
+            data = pd.DataFrame()
+            for ft_extractor in _worker["ft_extractors"]:
+                extracted = ft_extractor.extract([instance for _, instance in instances])
+                data = pd.concat([data, extracted], axis=1)
+            records = data.to_dict("records")
+        except Exception as e:
+            error = "{}: {}".format(e.__class__.__name__, e)
+            for task_id, _ in instances:
+                results[task_id] = (None, error)
+        else:
+            for (task_id, _), feats in zip(instances, records):
+                results[task_id] = (feats, None)
+
+    return [(task_id,) + results[task_id] for task_id, _, _ in batch]
+
+
+def _batches(tasks: Iterator[Task], batch_size: int) -> Iterator[List[Task]]:
+    while True:
+        batch = list(islice(tasks, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class PredictionWriter:
+    """Append predictions to a JSONL or CSV file and flush after every batch."""
+
+    csv_fields = ["id", "prediction", "classProbabilities", "error"]
+
+    def __init__(self, output: str):
+        self.is_csv = output.endswith(".csv")
+        if os.path.exists(output):
+            truncate_partial_line(output)
+        new_file = not os.path.exists(output) or os.path.getsize(output) == 0
+        self.out_file = open(output, "a", newline="")
+        if self.is_csv:
+            self.writer = csv.DictWriter(self.out_file, fieldnames=self.csv_fields)
+            if new_file:
+                self.writer.writeheader()
+
+    def write(self, records: List[dict]):
+        for record in records:
+            if self.is_csv:
+                row = dict(record)
+                if "classProbabilities" in row:
+                    row["classProbabilities"] = json.dumps(row["classProbabilities"])
+                self.writer.writerow(row)
+            else:
+                self.out_file.write(json.dumps(record) + "\n")
+        self.out_file.flush()
+
+    def close(self):
+        self.out_file.close()
+
+
+def score(
+    model_id: str,
+    paths: List[str],
+    output: str,
+    workers: int = None,
+    batch_size: int = 256,
+    report_every: float = 10.0,
+) -> dict:
+    """
+    Score all inputs with one model and append the predictions to output.
+
+    :param model_id: The ID of a model in the ONNX model directory.
+    :param paths: XMI files, directories with XMI files and JSONL files.
+    :param output: A .jsonl or .csv file for the predictions.
+    :param workers: The number of extraction processes (default: CPU count).
+    :param batch_size: The number of inputs per extraction and inference batch.
+    :param report_every: Seconds between two throughput reports on stderr.
+    :return: Counts of scored, failed and skipped inputs and the throughput.
+    """
+    # The inference module loads the type system and all models on import.
+    import inference
+
+    if model_id not in inference.inf_sessions:
+        raise ValueError(
+            'Model with model ID "{}" could not be found in the ONNX model'
+            " directory.".format(model_id)
+        )
+    bow_model = inference.bow_models.get(model_id)
+    bag = bow_model.bag if bow_model is not None else None
+
+    done = read_done_ids(output)
+    stats = {"scored": 0, "failed": 0, "skipped": 0}
+
+    def pending_tasks():
+        for task in iter_tasks(paths):
+            if task[0] in done:
+                stats["skipped"] += 1
+            else:
+                yield task
+
+    tasks = pending_tasks()
+
+    writer = PredictionWriter(output)
+    start = last_report = time.time()
+    try:
+        with Pool(workers, initializer=_init_worker, initargs=(bag,)) as pool:
+            for results in pool.imap(extract_batch, _batches(tasks, batch_size)):
+                records = [
+                    {"id": task_id, "error": error}
+                    for task_id, feats, error in results
+                    if feats is None
+                ]
+                scored = [(task_id, feats) for task_id, feats, _ in results if feats is not None]
+                if scored:
+                    data = pd.DataFrame([feats for _, feats in scored])
+                    predictions = inference.do_batch_prediction(data, model_id)
+                    for (task_id, _), prediction in zip(scored, predictions):
+                        records.append(
+                            {
+                                "id": task_id,
+                                "prediction": int(prediction["prediction"]),
+                                "classProbabilities": {
+                                    str(k): float(v)
+                                    for k, v in prediction["classProbabilities"].items()
+                                },
+                            }
+                        )
+                writer.write(records)
+
+                stats["scored"] += len(scored)
+                stats["failed"] += len(results) - len(scored)
+                now = time.time()
+                if now - last_report >= report_every:
+                    last_report = now
+                    print(
+                        "scored {} ({:.1f}/s), failed {}".format(
+                            stats["scored"], stats["scored"] / (now - start), stats["failed"]
+                        ),
+                        file=sys.stderr,
+                    )
+    finally:
+        writer.close()
+
+    elapsed = time.time() - start
+    stats["seconds"] = elapsed
+    stats["per_second"] = stats["scored"] / elapsed if elapsed > 0 else 0.0
+    return stats
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="XMI files, XMI directories or JSONL files")
+    parser.add_argument("--model-id", required=True)
+    parser.add_argument("--output", required=True, help="a .jsonl or .csv file")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--report-every", type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    stats = score(
+        args.model_id,
+        args.paths,
+        args.output,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        report_every=args.report_every,
+    )
+    print(
+        "scored {scored}, failed {failed}, skipped {skipped} in {seconds:.1f}s"
+        " ({per_second:.1f}/s)".format(**stats),
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
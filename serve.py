@@ -0,0 +1,326 @@
+"""
+Inference-only app.
+
+The prediction endpoints are defined on a router that main.py includes as
+well. Serving workers that never train can run this app instead, which does
+not import scikit-learn, skl2onnx or the training code:
+
+    uvicorn serve:app --port 9999
+"""
+import base64
+import math
+import os
+import pandas as pd
+
+import admission
+import artifacts
+import capture
+import inference
+
+from admission import prediction_pool
+from fastapi import APIRouter
+from fastapi import Depends
+from fastapi import FastAPI
+from fastapi import HTTPException
+from fastapi import Request
+from fastapi import Response
+from features.data import ShortAnswerInstance
+from inference import compile_session
+from inference import do_batch_prediction
+from inference import do_prediction
+from inference import extract_from_xmi
+from pydantic import BaseModel
+from shard_auth import check_shard_key
+from similarity import BatchSIMGroupExtractor
+from starlette.concurrency import run_in_threadpool
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Union
+
+router = APIRouter()
+
+
+class ClassificationInstance(BaseModel):
+    modelId: str
+    cas: str
+
+
+class CASPrediction(BaseModel):
+    prediction: int
+    classProbabilities: Dict[Union[str, int], float]
+    features: Dict[str, Union[float, int, None]]
+
+
+class PredictFromLanguageDataRequest(BaseModel):
+    instances: List[ShortAnswerInstance]
+    modelId: str
+
+
+class SinglePrediction(BaseModel):
+    prediction: int
+    classProbabilities: Dict[Union[str, int], float]
+
+
+class PredictFromLanguageDataResponse(BaseModel):
+    predictions: List[SinglePrediction]
+
+
+class PredictFromModelsRequest(BaseModel):
+    modelIds: List[str]
+    # Either a CAS or a ShortAnswerInstance is scored.
+    cas: Optional[str] = None
+    instance: Optional[ShortAnswerInstance] = None
+    # Also return the average of the class probabilities of all models.
+    ensemble: bool = False
+
+
+class ModelPrediction(BaseModel):
+    modelId: str
+    prediction: int
+    classProbabilities: Dict[Union[str, int], float]
+
+
+class PredictFromModelsResponse(BaseModel):
+    predictions: List[ModelPrediction]
+    ensemble: Optional[SinglePrediction] = None
+    # The features extracted from the CAS, shared by all models.
+    features: Optional[Dict[str, Union[float, int, None]]] = None
+
+
+@router.post("/predict", response_model=CASPrediction)
+async def predict(req: ClassificationInstance):
+    capture.record("/predict", req)
+    return await prediction_pool.run(req.modelId, predict_from_cas, req)
+
+
+@router.post("/predictFromAnswers", response_model=PredictFromLanguageDataResponse)
+async def predictFromAnswers(req: PredictFromLanguageDataRequest):
+    capture.record("/predictFromAnswers", req)
+    return await prediction_pool.run(req.modelId, predict_from_answers, req)
+
+
+@router.post("/predictFromModels", response_model=PredictFromModelsResponse)
+async def predictFromModels(req: PredictFromModelsRequest):
+    capture.record("/predictFromModels", req)
+    # The request counts against the limit of each of its models.
+    return await prediction_pool.run(req.modelIds, predict_from_models, req)
+
+
+@router.get("/queueMetrics")
+def queueMetrics():
+    # Queue depths and admission counts of the prediction and training pools.
+    return {name: pool.metrics() for name, pool in admission.pools.items()}
+
+
+# The stored models can be listed, downloaded, uploaded and deleted, so that
+# the shard router (see shard_router.py) can move them between instances.
+# They require the shared secret SHARD_AUTHKEY (see shard_auth.py).
+@router.get("/models", dependencies=[Depends(check_shard_key)])
+def listModels():
+    versions = {}
+    for model_id in stored_model_ids():
+        compiled = inference.compiled_sessions.get(model_id)
+        versions[model_id] = compiled.version if compiled is not None else None
+    return {"models": versions}
+
+
+@router.get("/models/{model_id}", dependencies=[Depends(check_shard_key)])
+def getModel(model_id: str):
+    check_model_id(model_id)
+    check_model_stored(model_id)
+    return Response(content=model_file_bytes(model_id), media_type="application/octet-stream")
+
+
+@router.put("/models/{model_id}", dependencies=[Depends(check_shard_key)])
+async def putModel(model_id: str, request: Request):
+    check_model_id(model_id)
+    model_bytes = await request.body()
+    await run_in_threadpool(store_model, model_id, model_bytes)
+    return {"modelId": model_id, "version": inference.compile_session(model_id).version}
+
+
+@router.delete("/models/{model_id}", dependencies=[Depends(check_shard_key)])
+def deleteModel(model_id: str):
+    check_model_id(model_id)
+    inference.unload_session(model_id)
+    for path in (model_path(model_id), os.path.join(inference.bow_model_dir, model_id + ".json")):
+        if os.path.exists(path):
+            os.remove(path)
+    return {"modelId": model_id}
+
+
+def check_model_stored(model_id: str):
+    """Check that the model is stored in a file."""
+    if model_id not in stored_model_ids():
+        raise HTTPException(
+            status_code=422,
+            detail='Model with model ID "{}" could not be'
+            " found in the ONNX model directory."
+            " Please train first.".format(model_id),
+        )
+
+
+def check_model_id(model_id: str):
+    # Model IDs are file names.
+    if not model_id or model_id.startswith(".") or os.path.basename(model_id) != model_id:
+        raise HTTPException(
+            status_code=422, detail='Invalid model ID "{}".'.format(model_id)
+        )
+
+
+def model_path(model_id: str) -> str:
+    return os.path.join(inference.onnx_model_dir, model_id + ".onnx")
+
+
+def stored_model_ids() -> List[str]:
+    model_ids = (
+        inference.model_id_of(model_file, ".onnx")
+        for model_file in os.listdir(inference.onnx_model_dir)
+    )
+    return [model_id for model_id in model_ids if model_id is not None]
+
+
+def model_file_bytes(model_id: str) -> bytes:
+    """
+    The stored model as one file. The BOW model of a model that was stored
+    before it was part of the ONNX file is added to it.
+    """
+    with open(model_path(model_id), "rb") as model_file:
+        model_bytes = model_file.read()
+    compiled = inference.compiled_sessions.get(model_id)
+    metadata = compiled.session.get_modelmeta().custom_metadata_map if compiled else {}
+    if compiled is not None and compiled.bow is not None and artifacts.BOW not in metadata:
+        model_bytes = artifacts.add_bow(model_bytes, compiled.bow.__dict__)
+    return model_bytes
+
+
+def store_model(model_id: str, model_bytes: bytes):
+    """Load a model that another instance stored and store it here."""
+    try:
+        inference.load_session(model_id, model_bytes)
+    except Exception as e:
+        raise HTTPException(
+            status_code=422, detail="The model could not be loaded: {}".format(e)
+        )
+    artifacts.write_atomic(model_path(model_id), model_bytes)
+
+
+def check_bow_model(model_id: str, compiled: inference.CompiledModel):
+    if compiled.bow is None:
+        raise HTTPException(
+            status_code=422,
+            detail='BOW Model with model ID "{}" could not be'
+            " found in the Bag of words model directory."
+            " Please check that the model was trained with training"
+            " instances (not with CAS).".format(model_id),
+        )
+
+
+def nan_to_none(f):
+    return None if math.isnan(f) else f
+
+
+def predict_from_cas(req: ClassificationInstance) -> dict:
+    model_id = req.modelId
+    base64_cas = base64.b64decode(req.cas)
+
+    check_model_stored(model_id)
+
+    print("printing deseralized json cas modelID: ", model_id)
+
+    # The model columns and the session are taken from the same compiled
+    # session, which is only looked up once.
+    compiled = compile_session(model_id)
+    feats = extract_from_xmi(base64_cas, model_columns=compiled.columns)
+    print("extracted feats")
+    prediction = do_prediction(feats, compiled=compiled)
+    prediction["features"] = {k: nan_to_none(v[0]) for k, v in feats.items()}
+    print(prediction)
+    return prediction
+
+
+def predict_from_answers(req: PredictFromLanguageDataRequest) -> dict:
+    model_id = req.modelId
+
+    check_model_stored(model_id)
+
+    # The BOW model and the session are taken from the same compiled session,
+    # so a training that stores a new model meanwhile does not mix them.
+    compiled = compile_session(model_id)
+    check_bow_model(model_id, compiled)
+
+    bow_extractor = compiled.bow
+    ft_extractors = [BatchSIMGroupExtractor(), bow_extractor]
+
+    # The features of all instances are extracted and predicted in one batch.
+    data = pd.DataFrame()
+    for ft_extractor in ft_extractors:
+        data = pd.concat([data, ft_extractor.extract(req.instances)], axis=1)
+
+    return {"predictions": do_batch_prediction(data, compiled=compiled)}
+
+
+
+def average_probabilities(predictions: List[dict]) -> dict:
+    """
+    The mean of the class probabilities of several predictions, a class
+    that a model does not know has probability 0 in its prediction.
+    """
+    probs = {}
+    for prediction in predictions:
+        for label, probability in prediction["classProbabilities"].items():
+            probs[label] = probs.get(label, 0.0) + probability / len(predictions)
+    return {
+        "prediction": max(probs, key=lambda k: probs[k]),
+        "classProbabilities": probs,
+    }
+
+
+def predict_from_models(req: PredictFromModelsRequest) -> dict:
+    """
+    Score one CAS or answer with several models from a single extraction.
+    """
+    if not req.modelIds:
+        raise HTTPException(status_code=422, detail="No model IDs were passed.")
+    if (req.cas is None) == (req.instance is None):
+        raise HTTPException(
+            status_code=422, detail="Either a CAS or an instance must be passed."
+        )
+    for model_id in req.modelIds:
+        check_model_stored(model_id)
+    compiled_models = [compile_session(model_id) for model_id in req.modelIds]
+
+    response = {}
+    predictions = []
+    if req.cas is not None:
+        # The features of all models are extracted at once, and every model
+        # picks its columns from them.
+        model_columns = sorted(
+            set(column for compiled in compiled_models for column in compiled.columns)
+        )
+        feats = extract_from_xmi(base64.b64decode(req.cas), model_columns=model_columns)
+        for compiled in compiled_models:
+            predictions.append(do_batch_prediction(feats, compiled=compiled)[0])
+        response["features"] = {k: nan_to_none(v[0]) for k, v in feats.items()}
+    else:
+        for model_id, compiled in zip(req.modelIds, compiled_models):
+            check_bow_model(model_id, compiled)
+        # The similarity features are the same for all models, only the bag
+        # of words depends on the model.
+        sim_features = BatchSIMGroupExtractor().extract([req.instance])
+        for compiled in compiled_models:
+            data = pd.concat([sim_features, compiled.bow.extract([req.instance])], axis=1)
+            predictions.append(do_batch_prediction(data, compiled=compiled)[0])
+
+    response["predictions"] = [
+        dict(prediction, modelId=model_id)
+        for model_id, prediction in zip(req.modelIds, predictions)
+    ]
+    if req.ensemble:
+        response["ensemble"] = average_probabilities(predictions)
+    return response
+
+
+app = FastAPI()
+app.include_router(router)
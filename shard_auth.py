@@ -0,0 +1,41 @@
+"""
+The shared secret of the shard router and the instances.
+
+The /models endpoints of the instances (see serve.py) replace and delete
+models, and the /shards endpoints of the router (see shard_router.py) move
+models to any URL. Both require the secret SHARD_AUTHKEY in the X-Shard-Key
+header. SHARD_AUTHKEY has no default: if it is not set, the endpoints are
+disabled and the router can not move models.
+"""
+import hmac
+import os
+
+from fastapi import Header
+from fastapi import HTTPException
+from typing import Optional
+
+HEADER = "X-Shard-Key"
+
+# The shared secret, None if it is not set.
+AUTHKEY = os.environ.get("SHARD_AUTHKEY") or None
+
+
+def require_authkey(authkey: Optional[str] = None) -> str:
+    """
+    :raises ValueError: If no key is given and SHARD_AUTHKEY is not set.
+    """
+    if authkey is None:
+        authkey = AUTHKEY
+    if not authkey:
+        raise ValueError("SHARD_AUTHKEY must be set to a secret to move models.")
+    return authkey
+
+
+def check_shard_key(x_shard_key: str = Header(None)):
+    """Reject a request without the shared secret (an endpoint dependency)."""
+    if not AUTHKEY:
+        raise HTTPException(
+            status_code=403, detail="Moving models is disabled, SHARD_AUTHKEY is not set."
+        )
+    if x_shard_key is None or not hmac.compare_digest(x_shard_key.encode(), AUTHKEY.encode()):
+        raise HTTPException(status_code=401, detail="The shard key is missing or wrong.")
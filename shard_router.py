@@ -0,0 +1,526 @@
+"""
+Model-affinity sharding over several instances of the service.
+
+The router maps every model ID to one instance (its owner) with a consistent
+hash ring and forwards the prediction, addInstance and training requests of
+a model to its owner. So each instance only holds the models it owns, and the
+addInstance data of a model is collected where the model is trained.
+
+When an instance joins or leaves, only the models whose owner changes are
+moved: the router copies them to their new owner over the /models endpoints
+of the instances (see serve.py), switches to the new ring and then deletes
+the copies that are no longer owned. Data of /addInstance that was not
+trained yet stays on the previous owner.
+
+While the models are moved, the trainings of the models that are moved or
+deleted are held back, and running trainings of these models are waited
+for before their copies are collected. Otherwise a training that finished on
+the previous owner after the copy would be deleted with it. A model that is
+trained for the first time during a rebalance stays where it was trained
+until the next rebalance.
+
+The router does not import the models or the feature extraction:
+
+    SHARD_NODES=http://localhost:9001,http://localhost:9002 SHARD_AUTHKEY=<secret> \\
+        uvicorn shard_router:app --port 9999
+
+The instances and the router share the secret SHARD_AUTHKEY (see
+shard_auth.py), which the /models endpoints of the instances and the /shards
+endpoints of the router require.
+
+Or, to try it with local instances on consecutive ports, each with its own
+model directories and the first one with copies of onnx_models/ and
+bow_models/:
+
+    python shard_router.py --port 9999 --local 3
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import secrets
+import shlex
+import shutil
+import sys
+import tempfile
+import threading
+
+import requests
+import shard_auth
+
+from fastapi import Depends
+from fastapi import FastAPI
+from fastapi import HTTPException
+from fastapi import Request
+from fastapi import Response
+from pydantic import BaseModel
+from shard_auth import check_shard_key
+from starlette.concurrency import run_in_threadpool
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+
+# Points per node on the ring. More points spread the models more evenly.
+REPLICAS = 100
+
+# The endpoints that are forwarded to the owner of the modelId in the body.
+FORWARDED_ENDPOINTS = [
+    "/predict",
+    "/predictFromAnswers",
+    "/addInstance",
+    "/trainFromCASes",
+    "/trainFromAnswers",
+    "/train",
+]
+
+# The forwarded endpoints that store a new version of the model.
+TRAINING_ENDPOINTS = ["/trainFromCASes", "/trainFromAnswers", "/train"]
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    A consistent hash ring of nodes. A ring is not changed, joins and leaves
+    make a new one.
+
+    :param nodes: The base URLs of the instances.
+    :param replicas: The number of points of every node.
+    """
+
+    def __init__(self, nodes: List[str] = (), replicas: int = REPLICAS):
+        self.nodes = sorted(set(nodes))
+        self.replicas = replicas
+        points = sorted(
+            (_hash("{}#{}".format(node, i)), node)
+            for node in self.nodes
+            for i in range(replicas)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key: str) -> str:
+        """
+        The node of the first point after the hash of the key.
+
+        :raises LookupError: If the ring has no nodes.
+        """
+        if not self.nodes:
+            raise LookupError("The ring has no nodes.")
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[index]
+
+    def with_node(self, node: str) -> "HashRing":
+        return HashRing(self.nodes + [node], self.replicas)
+
+    def without_node(self, node: str) -> "HashRing":
+        return HashRing([n for n in self.nodes if n != node], self.replicas)
+
+
+class ShardRouter:
+    """
+    Forward requests to the owners of their models and move models when
+    nodes join or leave.
+
+    :param nodes: The base URLs of the instances.
+    :param timeout: Seconds to wait for a forwarded request (None to wait
+        as long as a training takes).
+    :param authkey: The shared secret of the /models endpoints of the nodes,
+        by default SHARD_AUTHKEY.
+    """
+
+    def __init__(self, nodes: List[str], timeout: float = None, authkey: str = None):
+        self.ring = HashRing([node.rstrip("/") for node in nodes])
+        self.timeout = timeout
+        self.authkey = authkey
+        self.session = requests.Session()
+        # Sessions for single nodes, e.g. test clients.
+        self.sessions = {}  # type: Dict[str, requests.Session]
+        # Joins, leaves and rebalances run one at a time.
+        self.lock = threading.Lock()
+        # The models whose trainings are held back by a rebalance and the
+        # number of forwarded trainings of every model.
+        self.blocked = set()
+        self.trainings = {}  # type: Dict[str, int]
+        self.trainings_changed = threading.Condition()
+
+    def session_for(self, node: str) -> requests.Session:
+        return self.sessions.get(node, self.session)
+
+    def key_headers(self) -> Dict[str, str]:
+        """
+        The headers of the requests to the /models endpoints.
+
+        :raises ValueError: If no key was given and SHARD_AUTHKEY is not set.
+        """
+        return {shard_auth.HEADER: shard_auth.require_authkey(self.authkey)}
+
+    def forward(self, path: str, model_id: str, body: bytes) -> Response:
+        if path not in TRAINING_ENDPOINTS:
+            return self.send(path, model_id, body)
+        with self.trainings_changed:
+            self.trainings_changed.wait_for(lambda: model_id not in self.blocked)
+            self.trainings[model_id] = self.trainings.get(model_id, 0) + 1
+        try:
+            return self.send(path, model_id, body)
+        finally:
+            with self.trainings_changed:
+                self.trainings[model_id] -= 1
+                if not self.trainings[model_id]:
+                    del self.trainings[model_id]
+                self.trainings_changed.notify_all()
+
+    def send(self, path: str, model_id: str, body: bytes) -> Response:
+        try:
+            node = self.ring.owner(model_id)
+        except LookupError:
+            raise HTTPException(status_code=503, detail="No shard nodes are registered.")
+        try:
+            response = self.session_for(node).post(
+                node + path,
+                data=body,
+                headers={"Content-Type": "application/json"},
+                timeout=self.timeout,
+            )
+        except requests.RequestException as e:
+            raise HTTPException(
+                status_code=503,
+                detail="Shard {} is not reachable: {}".format(node, e),
+                headers={"Retry-After": "1"},
+            )
+        headers = {}
+        if "Retry-After" in response.headers:
+            headers["Retry-After"] = response.headers["Retry-After"]
+        return Response(
+            content=response.content,
+            status_code=response.status_code,
+            media_type=response.headers.get("Content-Type"),
+            headers=headers,
+        )
+
+    def stored_models(self, nodes: List[str]) -> Dict[str, Dict[str, Optional[str]]]:
+        """The models and their versions on every reachable node."""
+        stored = {}
+        for node in nodes:
+            try:
+                response = self.session_for(node).get(
+                    node + "/models", headers=self.key_headers(), timeout=10
+                )
+                response.raise_for_status()
+            except requests.RequestException as e:
+                print("Shard {} is not reachable: {}".format(node, e))
+                continue
+            stored[node] = response.json()["models"]
+        return stored
+
+    def shard_map(self) -> dict:
+        """The owner of every stored model and the models on every node."""
+        ring = self.ring
+        stored = self.stored_models(ring.nodes)
+        model_ids = sorted(set(model_id for models in stored.values() for model_id in models))
+        return {
+            "nodes": ring.nodes,
+            "owners": {model_id: ring.owner(model_id) for model_id in model_ids},
+            "stored": {node: sorted(models) for node, models in stored.items()},
+        }
+
+    def move(self, model_id: str, source: str, target: str) -> Optional[str]:
+        """
+        Copy a model from source to target.
+
+        :return: The version of the model on target.
+        """
+        response = self.session_for(source).get(
+            "{}/models/{}".format(source, model_id),
+            headers=self.key_headers(),
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        stored = self.session_for(target).put(
+            "{}/models/{}".format(target, model_id),
+            data=response.content,
+            headers=dict(self.key_headers(), **{"Content-Type": "application/octet-stream"}),
+            timeout=self.timeout,
+        )
+        stored.raise_for_status()
+        return stored.json()["version"]
+
+    def affected_models(
+        self, ring: HashRing, stored: Dict[str, Dict[str, Optional[str]]]
+    ) -> Set[str]:
+        """
+        The models that switching to ring moves or deletes: those that are
+        stored on other nodes than their owner in ring, or whose owner
+        changes.
+        """
+        affected = set()
+        for model_id in set(model_id for models in stored.values() for model_id in models):
+            owner = ring.owner(model_id)
+            holders = [node for node, models in stored.items() if model_id in models]
+            if holders != [owner] or (self.ring.nodes and self.ring.owner(model_id) != owner):
+                affected.add(model_id)
+        return affected
+
+    def block_trainings(
+        self, ring: HashRing, nodes: List[str]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        """
+        Hold back the trainings of the models that switching to ring moves or
+        deletes and wait for their running trainings.
+
+        :return: The models on the nodes, collected while none of the
+            affected models was trained.
+        """
+        while True:
+            stored = self.stored_models(nodes)
+            affected = self.affected_models(ring, stored)
+            with self.trainings_changed:
+                if affected <= self.blocked:
+                    return stored
+                # A training that finished before the trainings were held
+                # back can have stored another model, so the models are
+                # collected again.
+                self.blocked |= affected
+                self.trainings_changed.wait_for(
+                    lambda: not any(model_id in self.trainings for model_id in self.blocked)
+                )
+
+    def rebalance(self, ring: HashRing, nodes: List[str] = None) -> List[dict]:
+        """
+        Switch to a new ring and move the models to their owners in it.
+
+        The models are copied before the ring is switched, so requests keep
+        reaching a node that has the model, and the copies on other nodes of
+        the ring are deleted afterwards. The trainings of these models wait
+        until the rebalance is done.
+
+        :param nodes: The nodes to collect the models from, by default the
+            nodes of the current and the new ring.
+        :return: The moves, as modelId, from and to.
+        """
+        if nodes is None:
+            nodes = sorted(set(self.ring.nodes) | set(ring.nodes))
+        try:
+            return self.move_models(ring, self.block_trainings(ring, nodes))
+        finally:
+            with self.trainings_changed:
+                self.blocked.clear()
+                self.trainings_changed.notify_all()
+
+    def move_models(
+        self, ring: HashRing, stored: Dict[str, Dict[str, Optional[str]]]
+    ) -> List[dict]:
+        model_ids = sorted(set(model_id for models in stored.values() for model_id in models))
+        moves = []
+        # The models whose owner in the new ring has the newest version, only
+        # their other copies are deleted.
+        confirmed = set()
+        for model_id in model_ids:
+            owner = ring.owner(model_id)
+            versions = {
+                node: models[model_id] or ""
+                for node, models in stored.items()
+                if model_id in models
+            }
+            newest = max(versions.values())
+            if versions.get(owner) == newest:
+                confirmed.add(model_id)
+                continue
+            # The model is copied from its current owner if it has the
+            # newest version.
+            current = self.ring.owner(model_id) if self.ring.nodes else None
+            source = current if versions.get(current) == newest else None
+            if source is None:
+                source = next(node for node, version in versions.items() if version == newest)
+            if (self.move(model_id, source, owner) or "") == newest:
+                confirmed.add(model_id)
+            else:
+                print("Shard {} did not store the newest {}.".format(owner, model_id))
+            moves.append({"modelId": model_id, "from": source, "to": owner})
+
+        self.ring = ring
+
+        for node, models in stored.items():
+            if node not in ring.nodes:
+                continue
+            for model_id in models:
+                if ring.owner(model_id) != node and model_id in confirmed:
+                    self.session_for(node).delete(
+                        "{}/models/{}".format(node, model_id),
+                        headers=self.key_headers(),
+                        timeout=self.timeout,
+                    ).raise_for_status()
+        return moves
+
+    def join(self, node: str) -> List[dict]:
+        with self.lock:
+            return self.rebalance(self.ring.with_node(node.rstrip("/")))
+
+    def leave(self, node: str) -> List[dict]:
+        with self.lock:
+            return self.rebalance(self.ring.without_node(node.rstrip("/")))
+
+
+class NodeRequest(BaseModel):
+    url: str
+
+
+shard_router = ShardRouter(
+    [node for node in os.environ.get("SHARD_NODES", "").split(",") if node]
+)
+
+app = FastAPI()
+
+
+def _model_id(body: bytes) -> str:
+    try:
+        model_id = json.loads(body)["modelId"]
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=422, detail="The request has no modelId.")
+    if not isinstance(model_id, str):
+        raise HTTPException(status_code=422, detail="The request has no modelId.")
+    return model_id
+
+
+def _forwarding_endpoint(path: str):
+    async def endpoint(request: Request):
+        body = await request.body()
+        return await run_in_threadpool(shard_router.forward, path, _model_id(body), body)
+
+    endpoint.__name__ = "forward" + path.replace("/", "_")
+    return endpoint
+
+
+for endpoint_path in FORWARDED_ENDPOINTS:
+    app.post(endpoint_path)(_forwarding_endpoint(endpoint_path))
+
+
+@app.post("/predictFromModels")
+async def predictFromModels(request: Request):
+    body = await request.body()
+    try:
+        model_ids = json.loads(body)["modelIds"]
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=422, detail="The request has no modelIds.")
+    if not isinstance(model_ids, list) or not all(isinstance(m, str) for m in model_ids):
+        raise HTTPException(status_code=422, detail="The modelIds must be a list of strings.")
+    if not model_ids:
+        raise HTTPException(status_code=422, detail="The modelIds must not be empty.")
+    try:
+        owners = set(shard_router.ring.owner(model_id) for model_id in model_ids)
+    except LookupError:
+        raise HTTPException(status_code=503, detail="No shard nodes are registered.")
+    # The models are scored together where they are stored.
+    if len(owners) != 1:
+        raise HTTPException(
+            status_code=422,
+            detail="The models are on different shards: {}".format(sorted(owners)),
+        )
+    return await run_in_threadpool(shard_router.forward, "/predictFromModels", model_ids[0], body)
+
+
+@app.get("/shards", dependencies=[Depends(check_shard_key)])
+def shards():
+    return shard_router.shard_map()
+
+
+@app.post("/shards/join", dependencies=[Depends(check_shard_key)])
+def joinShard(req: NodeRequest):
+    return {"moves": shard_router.join(req.url), "nodes": shard_router.ring.nodes}
+
+
+@app.post("/shards/leave", dependencies=[Depends(check_shard_key)])
+def leaveShard(req: NodeRequest):
+    return {"moves": shard_router.leave(req.url), "nodes": shard_router.ring.nodes}
+
+
+@app.post("/shards/rebalance", dependencies=[Depends(check_shard_key)])
+def rebalanceShards():
+    # Moves models that were stored on other nodes, e.g. after a restart.
+    with shard_router.lock:
+        moves = shard_router.rebalance(shard_router.ring)
+    return {"moves": moves, "nodes": shard_router.ring.nodes}
+
+
+def start_local_nodes(count: int, base_port: int, directory: str, command: str):
+    """
+    Start instances on the ports after base_port, each with its own model
+    directories in directory. The first one gets a copy of onnx_models/ and
+    bow_models/.
+    """
+    from replay import start_instance
+
+    # The local instances share a new secret if SHARD_AUTHKEY is not set.
+    if not shard_auth.AUTHKEY:
+        shard_auth.AUTHKEY = secrets.token_hex(16)
+    processes = []
+    for index in range(count):
+        port = base_port + 1 + index
+        node_dir = os.path.join(directory, "node-{}".format(port))
+        model_dirs = {
+            "ONNX_MODEL_DIR": os.path.join(node_dir, "onnx_models"),
+            "BOW_MODEL_DIR": os.path.join(node_dir, "bow_models"),
+            "MODEL_METRICS_DIR": os.path.join(node_dir, "model_metrics"),
+        }
+        for model_dir in model_dirs.values():
+            os.makedirs(model_dir, exist_ok=True)
+        if index == 0:
+            # The BOW models of models that were stored before they were
+            # part of the ONNX file are copied as well.
+            for source, model_dir, suffix in (
+                ("onnx_models", "ONNX_MODEL_DIR", ".onnx"),
+                ("bow_models", "BOW_MODEL_DIR", ".json"),
+            ):
+                for model_file in os.listdir(source):
+                    if model_file.endswith(suffix):
+                        shutil.copy(os.path.join(source, model_file), model_dirs[model_dir])
+        url = "http://localhost:{}".format(port)
+        env = dict(os.environ, SHARD_AUTHKEY=shard_auth.AUTHKEY, **model_dirs)
+        processes.append(start_instance(command.format(port=port), url, env=env))
+        shard_router.ring = shard_router.ring.with_node(url)
+    return processes
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Route requests to model shards.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--nodes", default="", help="comma-separated base URLs")
+    parser.add_argument("--local", type=int, default=0, help="start local instances")
+    parser.add_argument("--local-dir", help="directory for the model directories")
+    parser.add_argument(
+        "--node-command",
+        default="{} -m uvicorn main:app --port {{port}}".format(shlex.quote(sys.executable)),
+    )
+    args = parser.parse_args(argv)
+
+    for node in args.nodes.split(","):
+        if node:
+            shard_router.ring = shard_router.ring.with_node(node.rstrip("/"))
+    processes = []
+    try:
+        if args.local:
+            processes = start_local_nodes(
+                args.local,
+                args.port,
+                args.local_dir or tempfile.mkdtemp(prefix="shards-"),
+                args.node_command,
+            )
+        moves = shard_router.rebalance(shard_router.ring)
+        print("Shards {} ({} models moved)".format(shard_router.ring.nodes, len(moves)))
+
+        import uvicorn
+
+        uvicorn.run(app, host=args.host, port=args.port)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
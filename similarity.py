@@ -0,0 +1,369 @@
+"""
+Batched string similarity kernels for the SIM feature group.
+
+The SIM features are the normalized similarities of the textdistance
+package (NeedlemanWunsch, SmithWaterman, LCSSeq, LCSStr, Length, Editex,
+MRA, Overlap and Cosine) between a student answer and the target answers of
+its item. textdistance computes them one pair of strings at a time in pure
+Python. Here all pairs of a request are deduplicated, grouped by length and
+computed together: the dynamic programming measures are evaluated one
+anti-diagonal at a time over NumPy arrays holding a whole chunk of pairs,
+and the set based measures work on character count matrices.
+
+The values match textdistance (4.2.1, default parameters) per pair.
+"""
+from itertools import groupby
+from typing import List
+from typing import Sequence
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+# Order of the SIM feature columns. The names are the textdistance class names
+# that are stored as model columns of the trained models.
+SIM_MEASURES = [
+    "NeedlemanWunsch",
+    "SmithWaterman",
+    "LCSSeq",
+    "LCSStr",
+    "Length",
+    "Editex",
+    "MRA",
+    "Overlap",
+    "Cosine",
+]
+
+# Upper bound for the number of DP cells (pairs x rows x columns) that are
+# kept in memory at once.
+MAX_CHUNK_CELLS = 2 ** 22
+
+# Padding values for the character codes. They never match each other or a
+# real character, so padded cells never count as a match.
+_PAD_LEFT = -1
+_PAD_RIGHT = -2
+
+# Editex letter groups and costs as defined by textdistance.
+_EDITEX_GROUPS = (
+    "AEIOUY",
+    "BP",
+    "CKQ",
+    "DT",
+    "LR",
+    "MN",
+    "GJ",
+    "FPV",
+    "SXZ",
+    "CSZ",
+)
+_EDITEX_UNGROUPED = "HW"
+_EDITEX_MATCH, _EDITEX_GROUP, _EDITEX_MISMATCH = 0, 1, 2
+
+
+def _encode(strings: Sequence[str], pad: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Convert strings to a padded matrix of unicode code points.
+
+    :param strings: The strings to encode.
+    :param pad: The value used for positions behind the end of a string.
+    :return: The code matrix (len(strings) x max length) and the lengths.
+    """
+    lengths = np.array([len(s) for s in strings], dtype=np.int64)
+    codes = np.full((len(strings), max(lengths.max(initial=0), 1)), pad, dtype=np.int64)
+    for row, s in enumerate(strings):
+        if s:
+            codes[row, : len(s)] = np.frombuffer(s.encode("utf-32-le"), dtype=np.uint32)
+    return codes, lengths
+
+
+def _diagonals(rows: int, cols: int):
+    """
+    Yield the (i, j) index arrays of the anti-diagonals of a DP matrix.
+
+    Every cell (i, j) with i, j >= 1 only depends on cells of earlier
+    anti-diagonals, so all cells of one anti-diagonal can be computed at once.
+    """
+    for d in range(2, rows + cols + 1):
+        i = np.arange(max(1, d - cols), min(rows, d - 1) + 1)
+        yield i, d - i
+
+
+def _alignment(
+    eq: np.ndarray, gap_cost: float, local: bool, len_a: np.ndarray, len_b: np.ndarray
+) -> np.ndarray:
+    """
+    Needleman-Wunsch (global) or Smith-Waterman (local) alignment scores.
+
+    A match scores 1, a mismatch 0 and every gap costs gap_cost, as with the
+    textdistance default similarity function.
+    """
+    n, rows, cols = eq.shape
+    dp = np.zeros((n, rows + 1, cols + 1))
+    if not local:
+        dp[:, :, 0] = -np.arange(rows + 1) * gap_cost
+        dp[:, 0, :] = -np.arange(cols + 1) * gap_cost
+    for i, j in _diagonals(rows, cols):
+        best = np.maximum(dp[:, i - 1, j - 1] + eq[:, i - 1, j - 1], dp[:, i - 1, j] - gap_cost)
+        best = np.maximum(best, dp[:, i, j - 1] - gap_cost)
+        if local:
+            best = np.maximum(best, 0)
+        dp[:, i, j] = best
+    return dp[np.arange(n), len_a, len_b]
+
+
+def _lcs_sequence(eq: np.ndarray, len_a: np.ndarray, len_b: np.ndarray) -> np.ndarray:
+    """Length of the longest common subsequence of every pair."""
+    n, rows, cols = eq.shape
+    dp = np.zeros((n, rows + 1, cols + 1), dtype=np.int64)
+    for i, j in _diagonals(rows, cols):
+        best = np.maximum(dp[:, i - 1, j], dp[:, i, j - 1])
+        dp[:, i, j] = np.maximum(best, dp[:, i - 1, j - 1] + eq[:, i - 1, j - 1])
+    return dp[np.arange(n), len_a, len_b]
+
+
+def _lcs_substring(eq: np.ndarray) -> np.ndarray:
+    """Length of the longest common substring of every pair."""
+    n, rows, cols = eq.shape
+    dp = np.zeros((n, rows + 1, cols + 1), dtype=np.int64)
+    for i, j in _diagonals(rows, cols):
+        dp[:, i, j] = np.where(eq[:, i - 1, j - 1], dp[:, i - 1, j - 1] + 1, 0)
+    return dp.reshape(n, -1).max(axis=1)
+
+
+def _editex_groups(codes: np.ndarray) -> np.ndarray:
+    """Bit mask of the Editex letter groups every character belongs to."""
+    masks = np.zeros(codes.shape, dtype=np.int64)
+    for bit, group in enumerate(_EDITEX_GROUPS):
+        member = np.isin(codes, [ord(c) for c in group])
+        masks |= member.astype(np.int64) << bit
+    return masks
+
+
+def _editex_r_cost(a: np.ndarray, b: np.ndarray, mask_a: np.ndarray, mask_b: np.ndarray):
+    shared_group = (mask_a & mask_b) != 0
+    return np.where(
+        a == b,
+        _EDITEX_MATCH,
+        np.where(shared_group, _EDITEX_GROUP, _EDITEX_MISMATCH),
+    )
+
+
+def _editex_d_costs(codes: np.ndarray) -> np.ndarray:
+    """
+    Deletion cost of every position of the (upper case) strings.
+
+    The cost of position i depends on the character before it, with a space
+    in front of the first character.
+    """
+    prev = np.concatenate([np.full((codes.shape[0], 1), ord(" ")), codes[:, :-1]], axis=1)
+    masks = _editex_groups(codes)
+    prev_masks = _editex_groups(prev)
+    costs = _editex_r_cost(prev, codes, prev_masks, masks)
+    ungrouped = np.isin(prev, [ord(c) for c in _EDITEX_UNGROUPED]) & (prev != codes)
+    return np.where(ungrouped, _EDITEX_GROUP, costs)
+
+
+def _editex(lefts: Sequence[str], rights: Sequence[str]) -> np.ndarray:
+    """Editex distance of every pair, computed on the upper case strings."""
+    a, len_a = _encode([s.upper() for s in lefts], _PAD_LEFT)
+    b, len_b = _encode([s.upper() for s in rights], _PAD_RIGHT)
+    n, rows, cols = len(lefts), a.shape[1], b.shape[1]
+    del_a = _editex_d_costs(a)
+    del_b = _editex_d_costs(b)
+    r_cost = _editex_r_cost(
+        a[:, :, None], b[:, None, :], _editex_groups(a)[:, :, None], _editex_groups(b)[:, None, :]
+    )
+    dp = np.zeros((n, rows + 1, cols + 1), dtype=np.int64)
+    dp[:, 1:, 0] = np.cumsum(del_a, axis=1)
+    dp[:, 0, 1:] = np.cumsum(del_b, axis=1)
+    for i, j in _diagonals(rows, cols):
+        best = np.minimum(dp[:, i - 1, j] + del_a[:, i - 1], dp[:, i, j - 1] + del_b[:, j - 1])
+        dp[:, i, j] = np.minimum(best, dp[:, i - 1, j - 1] + r_cost[:, i - 1, j - 1])
+    return dp[np.arange(n), len_a, len_b]
+
+
+def _mra_code(word: str) -> str:
+    if not word:
+        return word
+    word = word.upper()
+    word = word[0] + "".join(c for c in word[1:] if c not in "AEIOU")
+    word = "".join(char for char, _ in groupby(word))
+    if len(word) > 6:
+        return word[:3] + word[-3:]
+    return word
+
+
+def _mra_similarity(left: str, right: str) -> float:
+    """MRA comparison rating divided by the longer code, as in textdistance."""
+    codes = [list(_mra_code(left)), list(_mra_code(right))]
+    maximum = max(map(len, codes))
+    if maximum == 0:
+        return 1.0
+    if not left or not right:
+        return 0.0
+    lengths = list(map(len, codes))
+    if abs(maximum - min(lengths)) > 2:
+        return 0.0
+    for _ in range(2):
+        minlen = min(lengths)
+        unmatched = [chars for chars in zip(*codes) if chars[0] != chars[1]]
+        remaining = [list(s) for s in zip(*unmatched)] or [[], []]
+        codes = [s1 + s2[minlen:] for s1, s2 in zip(remaining, codes)]
+        lengths = list(map(len, codes))
+    return (maximum - max(lengths)) / maximum
+
+
+def _char_counts(lefts: Sequence[str], rights: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Character count matrices of both sides over a shared vocabulary."""
+    vocabulary = {c: idx for idx, c in enumerate(sorted(set("".join(lefts) + "".join(rights))))}
+    counts = []
+    for strings in (lefts, rights):
+        matrix = np.zeros((len(strings), max(len(vocabulary), 1)), dtype=np.int64)
+        for row, s in enumerate(strings):
+            for c in s:
+                matrix[row, vocabulary[c]] += 1
+        counts.append(matrix)
+    return counts[0], counts[1]
+
+
+def _chunks(len_a: np.ndarray, len_b: np.ndarray):
+    """
+    Split pair indices into chunks of similar lengths.
+
+    Sorting by length keeps the padding small and the cell bound keeps the
+    DP matrices of a chunk in memory.
+    """
+    order = np.lexsort((len_b, len_a))
+    start = 0
+    while start < len(order):
+        stop = start + 1
+        while stop < len(order):
+            rows = len_a[order[stop]] + 1
+            cols = len_b[order[start:stop + 1]].max() + 1
+            if (stop + 1 - start) * rows * cols > MAX_CHUNK_CELLS:
+                break
+            stop += 1
+        yield order[start:stop]
+        start = stop
+
+
+def _unique_pair_similarities(lefts: List[str], rights: List[str]) -> np.ndarray:
+    """Similarity matrix (pairs x measures) of already deduplicated pairs."""
+    n = len(lefts)
+    out = np.empty((n, len(SIM_MEASURES)))
+    len_a = np.array([len(s) for s in lefts], dtype=np.int64)
+    len_b = np.array([len(s) for s in rights], dtype=np.int64)
+    longest = np.maximum(len_a, len_b)
+    shortest = np.minimum(len_a, len_b)
+    identical = np.array([l == r for l, r in zip(lefts, rights)])
+    empty = shortest == 0
+
+    nw = np.empty(n)
+    sw = np.empty(n)
+    lcs_seq = np.empty(n)
+    lcs_str = np.empty(n)
+    editex = np.empty(n)
+    for chunk in _chunks(len_a, len_b):
+        chunk_lefts = [lefts[idx] for idx in chunk]
+        chunk_rights = [rights[idx] for idx in chunk]
+        a, _ = _encode(chunk_lefts, _PAD_LEFT)
+        b, _ = _encode(chunk_rights, _PAD_RIGHT)
+        eq = a[:, :, None] == b[:, None, :]
+        nw[chunk] = _alignment(eq, 1.0, False, len_a[chunk], len_b[chunk])
+        sw[chunk] = _alignment(eq, 1.0, True, len_a[chunk], len_b[chunk])
+        lcs_seq[chunk] = _lcs_sequence(eq, len_a[chunk], len_b[chunk])
+        lcs_str[chunk] = _lcs_substring(eq)
+        editex[chunk] = _editex(chunk_lefts, chunk_rights)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # NeedlemanWunsch: (score - minimum) / (2 * maximum)
+        out[:, 0] = np.where(longest == 0, 1.0, (nw + longest) / (2.0 * longest))
+        # SmithWaterman: score / length of the shorter string
+        sw = np.where(identical, shortest, np.where(empty, 0, sw))
+        out[:, 1] = np.where(shortest == 0, 1.0, sw / shortest)
+        out[:, 2] = np.where(longest == 0, 1.0, lcs_seq / longest)
+        out[:, 3] = np.where(longest == 0, 1.0, lcs_str / longest)
+        out[:, 4] = np.where(longest == 0, 1.0, 1.0 - (longest - shortest) / longest)
+        editex = np.where(identical, 0, np.where(empty, 2 * longest, editex))
+        out[:, 5] = np.where(longest == 0, 1.0, 1.0 - editex / (2.0 * longest))
+        out[:, 6] = [_mra_similarity(l, r) for l, r in zip(lefts, rights)]
+
+        counts_a, counts_b = _char_counts(lefts, rights)
+        intersection = np.minimum(counts_a, counts_b).sum(axis=1)
+        overlap = intersection / shortest
+        cosine = intersection / np.sqrt(len_a * len_b)
+        out[:, 7] = np.where(identical, 1.0, np.where(empty, 0.0, overlap))
+        out[:, 8] = np.where(identical, 1.0, np.where(empty, 0.0, cosine))
+    return out
+
+
+def pair_similarities(lefts: Sequence[str], rights: Sequence[str]) -> np.ndarray:
+    """
+    Compute all SIM measures for the pairs (lefts[k], rights[k]).
+
+    :param lefts: The first string of every pair.
+    :param rights: The second string of every pair.
+    :return: A float matrix (pairs x measures) with the columns in the order
+        of SIM_MEASURES.
+    """
+    if len(lefts) != len(rights):
+        raise ValueError("lefts and rights must have the same length")
+    index = {}
+    inverse = np.empty(len(lefts), dtype=np.int64)
+    for k, pair in enumerate(zip(lefts, rights)):
+        inverse[k] = index.setdefault(pair, len(index))
+    if not index:
+        return np.empty((0, len(SIM_MEASURES)))
+    unique_lefts, unique_rights = (list(side) for side in zip(*index))
+    return _unique_pair_similarities(unique_lefts, unique_rights)[inverse]
+
+
+def similarity_matrix(answers: Sequence[str], targets: Sequence[str]) -> np.ndarray:
+    """
+    Compute all SIM measures for N answers against M targets.
+
+    :param answers: The N student answers.
+    :param targets: The M target answers.
+    :return: A float array of shape (N, M, len(SIM_MEASURES)).
+    """
+    lefts = [answer for answer in answers for _ in targets]
+    rights = [target for _ in answers for target in targets]
+    sims = pair_similarities(lefts, rights)
+    return sims.reshape(len(answers), len(targets), len(SIM_MEASURES))
+
+
+class BatchSIMGroupExtractor:
+    """
+    Drop-in replacement for the SIMGroupExtractor of the features package
+    that computes the similarities of all instances in one batch.
+
+    Every feature is the best similarity of the answer to one of the item
+    targets.
+    """
+
+    name = "SIM"
+
+    def extract(self, instances) -> pd.DataFrame:
+        """
+        Extract the SIM features of ShortAnswerInstances.
+
+        :param instances: A list of ShortAnswerInstance objects.
+        :return: A DataFrame with one row per instance and one column per
+            measure in SIM_MEASURES.
+        """
+        owners = []
+        lefts = []
+        rights = []
+        for row, instance in enumerate(instances):
+            for target in instance.itemTargets:
+                owners.append(row)
+                lefts.append(instance.answer)
+                rights.append(target)
+
+        feats = np.full((len(instances), len(SIM_MEASURES)), np.nan)
+        if owners:
+            sims = pair_similarities(lefts, rights)
+            owners = np.array(owners)
+            feats[np.unique(owners)] = -np.inf
+            np.maximum.at(feats, owners, sims)
+        return pd.DataFrame(feats, columns=SIM_MEASURES)
@@ -0,0 +1,70 @@
+"""
+Measure the import time and memory of the app modules.
+
+Every module is imported in a fresh interpreter, which is what a new
+serving worker does before it becomes ready:
+
+    python startup_profile.py serve main
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+from typing import List
+
+# Modules that only the training code needs.
+TRAINING_MODULES = ["skl2onnx", "sklearn.ensemble", "sklearn.model_selection"]
+
+# Run in the child interpreter. ru_maxrss is in kilobytes on Linux.
+_PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    "module": "{module}",
+    "import_seconds": seconds,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "training_modules": sorted(set({training_modules}) & set(sys.modules)),
+}}))
+"""
+
+
+def profile(module: str) -> dict:
+    """
+    Import a module in a new interpreter and report its startup cost.
+
+    :param module: The name of the module, e.g. "serve" or "main".
+    :return: The import time, the peak resident memory and whether the
+        training modules that were imported.
+    """
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            _PROBE.format(module=module, training_modules=TRAINING_MODULES),
+        ]
+    )
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Measure app import time and RSS.")
+    parser.add_argument("modules", nargs="*", default=["serve", "main"])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    for module in args.modules:
+        runs = [profile(module) for _ in range(args.repeat)]
+        best = min(runs, key=lambda run: run["import_seconds"])
+        print(
+            "{module:10} import {import_seconds:6.2f}s  max RSS {max_rss_mb:7.1f} MB"
+            "  training modules: {training}".format(
+                training=", ".join(best["training_modules"]) or "none", **best
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
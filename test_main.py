@@ -1,8 +1,17 @@
 import base64
+import hashlib
 import json
 import os
 import pytest
+import capture
+import inference
 import main
+import replay
+import score
+import serve
+import shard_auth
+import shard_router
+import startup_profile
 
 from fastapi.testclient import TestClient
 from main import app
@@ -13,6 +22,13 @@ def client():
     return TestClient(app)
 
 
+@pytest.fixture()
+def shard_key(monkeypatch):
+    """The shared secret of the /models and /shards endpoints, as headers."""
+    monkeypatch.setattr(shard_auth, "AUTHKEY", "test-key")
+    return {shard_auth.HEADER: "test-key"}
+
+
 @pytest.fixture()
 def xmi_bytes():
     with open("testdata/xmi/1ET5_7_0.xmi", "rb") as in_file:
@@ -131,6 +147,138 @@ def test_predict(client, xmi_bytes):
         assert 0 <= response.json()["features"][cls] <= 1
 
 
+def test_predictFromModels(client, xmi_bytes):
+    """
+    Test the /predictFromModels endpoint with the default model twice.
+
+    :param client: A client for testing.
+    :param xmi_bytes: A byte-encoded CAS instance.
+    """
+    cas = base64.b64encode(xmi_bytes).decode("ascii")
+    single = client.post("/predict", json={"modelId": "default", "cas": cas}).json()
+    response = client.post(
+        "/predictFromModels",
+        json={"modelIds": ["default", "default"], "cas": cas, "ensemble": True},
+    )
+
+    assert response.status_code == 200
+    predictions = response.json()["predictions"]
+    assert [prediction["modelId"] for prediction in predictions] == ["default", "default"]
+    for prediction in predictions + [response.json()["ensemble"]]:
+        assert prediction["prediction"] == single["prediction"]
+        for cls, probability in single["classProbabilities"].items():
+            assert abs(prediction["classProbabilities"][cls] - probability) < 1e-6
+
+    # A missing model is rejected like in /predict.
+    response = client.post(
+        "/predictFromModels", json={"modelIds": ["default", "non-existent"], "cas": cas}
+    )
+    assert response.status_code == 422
+
+
+def test_shard_router(client, xmi_bytes, shard_key):
+    """
+    Test that the shard router forwards /predict to the owner of the model.
+
+    :param client: A client for testing, used as the only shard.
+    :param xmi_bytes: A byte-encoded CAS instance.
+    :param shard_key: The headers with the shared secret.
+    """
+    node = "http://shard-a"
+    router = shard_router.shard_router
+    router.ring = shard_router.HashRing([node])
+    router.sessions[node] = client
+    router_client = TestClient(shard_router.app)
+
+    cas = base64.b64encode(xmi_bytes).decode("ascii")
+    response = router_client.post("/predict", json={"modelId": "default", "cas": cas})
+    shards = router_client.get("/shards", headers=shard_key).json()
+    no_key = router_client.get("/shards")
+    missing_model_id = router_client.post("/predict", json={"cas": cas})
+
+    router.ring = shard_router.HashRing()
+    del router.sessions[node]
+
+    assert response.status_code == 200
+    assert response.json()["prediction"] == 1
+    assert shards["nodes"] == [node]
+    assert shards["owners"]["default"] == node
+    assert no_key.status_code == 401
+    assert missing_model_id.status_code == 422
+
+
+def test_shard_router_predictFromModels_errors(monkeypatch):
+    """
+    Test that the shard router rejects an empty list of model IDs and answers
+    503 while it has no shards.
+    """
+    monkeypatch.setattr(shard_router.shard_router, "ring", shard_router.HashRing())
+    router_client = TestClient(shard_router.app)
+
+    empty = router_client.post("/predictFromModels", json={"modelIds": [], "cas": ""})
+    no_shards = router_client.post("/predictFromModels", json={"modelIds": ["default"], "cas": ""})
+
+    assert empty.status_code == 422
+    assert empty.json()["detail"] == "The modelIds must not be empty."
+    assert no_shards.status_code == 503
+
+
+def test_models_require_shard_key(client, monkeypatch, shard_key):
+    """
+    Test that models can not be read, replaced or deleted without the shared
+    secret, and not at all if SHARD_AUTHKEY is not set.
+
+    :param client: A client for testing.
+    :param shard_key: The headers with the shared secret.
+    """
+    wrong_key = {shard_auth.HEADER: "wrong-key"}
+    assert client.get("/models").status_code == 401
+    assert client.get("/models/default", headers=wrong_key).status_code == 401
+    assert client.put("/models/default", data=b"model").status_code == 401
+    assert client.delete("/models/default", headers=wrong_key).status_code == 401
+    assert "default" in client.get("/models", headers=shard_key).json()["models"]
+
+    monkeypatch.setattr(shard_auth, "AUTHKEY", None)
+    assert client.delete("/models/default", headers=shard_key).status_code == 403
+    assert os.path.exists("onnx_models/default.onnx")
+
+
+def test_move_model_with_bow_file(tmp_path, monkeypatch, client, predict_instances, shard_key):
+    """
+    Test that a model whose BOW model is only in the BOW model directory can
+    be moved to another instance and predict from answers there.
+
+    :param tmp_path: The model directories of the other instance.
+    :param client: A client for testing.
+    :param predict_instances: Mock short answer instances that do not have labels
+    :param shard_key: The headers with the shared secret.
+    """
+    model_bytes = client.get("/models/test_pred_data", headers=shard_key).content
+
+    # The other instance starts without models.
+    for name in ("onnx_models", "bow_models"):
+        (tmp_path / name).mkdir()
+    monkeypatch.setattr(inference, "onnx_model_dir", str(tmp_path / "onnx_models"))
+    monkeypatch.setattr(inference, "bow_model_dir", str(tmp_path / "bow_models"))
+    for sessions in ("inf_sessions", "model_sources", "bow_models", "compiled_sessions"):
+        monkeypatch.setattr(inference, sessions, {})
+
+    response = client.put(
+        "/models/test_pred_data",
+        data=model_bytes,
+        headers=dict(shard_key, **{"Content-Type": "application/octet-stream"}),
+    )
+    assert response.status_code == 200
+    assert os.listdir(str(tmp_path / "bow_models")) == []
+
+    response = client.post(
+        "/predictFromAnswers",
+        json={"instances": predict_instances, "modelId": "test_pred_data"},
+    )
+    assert response.status_code == 200
+    assert [p["prediction"] for p in response.json()["predictions"]] == [1, 1, 2]
+
+
 def test_predict_wrong_model_ID(client, xmi_bytes):
     """
     Test the /predict endpoint with a model ID that is not present in the
@@ -221,12 +369,12 @@ def test_trainFromCASes(client, xmi_bytes):
         os.path.join(main.onnx_model_dir, "default_cas_test.onnx")
     )
     metrics_path_exists = os.path.exists(os.path.join("model_metrics", "random_data.json"))
-    session_stored = "default_cas_test" in main.inf_sessions
+    session_stored = "default_cas_test" in main.inference.inf_sessions
 
     # Change onnx model directory back and delete test file and inference
     # session object.
     if session_stored:
-        del main.inf_sessions["default_cas_test"]
+        del main.inference.inf_sessions["default_cas_test"]
     if path_exists:
         os.remove(os.path.join(main.onnx_model_dir, "default_cas_test.onnx"))
     if metrics_path_exists:
@@ -296,12 +444,12 @@ def test_train(client):
     # Store states to check whether the file and session object were created.
     path_exists = os.path.exists(os.path.join(main.onnx_model_dir, "random_data.onnx"))
     metrics_path_exists = os.path.exists(os.path.join("model_metrics", "random_data.json"))
-    session_stored = "random_data" in main.inf_sessions
+    session_stored = "random_data" in main.inference.inf_sessions
 
     # Change onnx model directory back and delete test file and inference
     # session object.
     if session_stored:
-        del main.inf_sessions["random_data"]
+        del main.inference.inf_sessions["random_data"]
     if path_exists:
         os.remove(os.path.join(main.onnx_model_dir, "random_data.onnx"))
     if metrics_path_exists:
@@ -336,11 +484,11 @@ def test_trainFromAnswers(client, mock_instances):
     path_exists = os.path.exists(os.path.join(main.onnx_model_dir, "random_data.onnx"))
     bow_path_exists = os.path.exists(os.path.join(main.bow_model_dir, "random_data.json"))
     metrics_path_exists = os.path.exists(os.path.join("model_metrics", "random_data.json"))
-    session_stored = "random_data" in main.inf_sessions
+    session_stored = "random_data" in main.inference.inf_sessions
 
     # Delete all files that have been created during training.
     if session_stored:
-        del main.inf_sessions["random_data"]
+        del main.inference.inf_sessions["random_data"]
     if path_exists:
         os.remove(os.path.join(main.onnx_model_dir, "random_data.onnx"))
     if bow_path_exists:
@@ -379,3 +527,122 @@ def test_predictFromAnswers(client, predict_instances):
     assert response_dict["predictions"][0]["prediction"] == 1
     assert response_dict["predictions"][1]["prediction"] == 1
     assert response_dict["predictions"][2]["prediction"] == 2
+
+
+def test_score_resumes(tmp_path, predict_instances):
+    """
+    Test the offline scoring tool with XMI files and a JSONL file of answers.
+
+    A second run over the same inputs must not score anything again.
+
+    :param tmp_path: A temporary directory for the inputs and outputs.
+    :param predict_instances: Mock short answer instances that do not have labels
+    """
+    jsonl_path = tmp_path / "answers.jsonl"
+    with open(jsonl_path, "w") as out_file:
+        for instance in predict_instances:
+            out_file.write(json.dumps(instance) + "\n")
+    output = str(tmp_path / "predictions.jsonl")
+
+    stats = score.score("test_pred_data", [str(jsonl_path)], output, workers=1)
+    assert stats["scored"] == 3
+    assert stats["failed"] == 0
+
+    with open(output) as in_file:
+        records = [json.loads(line) for line in in_file]
+    assert [record["prediction"] for record in records] == [1, 1, 2]
+
+    stats = score.score("test_pred_data", [str(jsonl_path)], output, workers=1)
+    assert stats["scored"] == 0
+    assert stats["skipped"] == 3
+
+    # A run that was interrupted while it wrote the last prediction.
+    with open(output, "r+") as out_file:
+        out_file.truncate(len(out_file.read()) - 10)
+    stats = score.score("test_pred_data", [str(jsonl_path)], output, workers=1)
+    assert stats["scored"] == 1
+    assert stats["skipped"] == 2
+
+    with open(output) as in_file:
+        records = [json.loads(line) for line in in_file]
+    assert [record["prediction"] for record in records] == [1, 1, 2]
+
+    csv_output = str(tmp_path / "predictions.csv")
+    stats = score.score("default", ["testdata/xmi"], csv_output, workers=1)
+    assert stats["scored"] == 2
+
+
+def test_score_batch_extraction_error(monkeypatch, predict_instances):
+    """
+    Test that a failed extraction of a batch of answers marks its instances as
+    failed instead of stopping the scoring.
+
+    :param predict_instances: Mock short answer instances that do not have labels
+    """
+
+    class FailingExtractor:
+        def extract(self, instances):
+            raise ValueError("broken")
+
+    monkeypatch.setitem(score._worker, "ft_extractors", [FailingExtractor()] * 2)
+    batch = [(str(i), score.INSTANCE, instance) for i, instance in enumerate(predict_instances)]
+
+    results = score.extract_batch(batch)
+
+    assert [task_id for task_id, _, _ in results] == ["0", "1", "2"]
+    for _, features, error in results:
+        assert features is None
+        assert error == "ValueError: broken"
+
+
+def test_stored_model_ids(tmp_path, monkeypatch):
+    """
+    Test that only the .onnx suffix is taken off the file names of the models.
+    """
+    for file_name in ["session.onnx", "xn.onnx", ".keep", ".session.onnx.tmp", "notes.txt"]:
+        (tmp_path / file_name).write_bytes(b"")
+    monkeypatch.setattr(serve.inference, "onnx_model_dir", str(tmp_path))
+
+    assert sorted(serve.stored_model_ids()) == ["session", "xn"]
+
+
+def test_serve_does_not_import_training():
+    """
+    Test that the inference-only app does not import the training dependencies.
+    """
+    assert startup_profile.profile("serve")["training_modules"] == []
+
+
+def test_capture_and_replay(tmp_path, client, predict_instances):
+    """
+    Test that captured requests are redacted and can be rebuilt for replay.
+
+    :param tmp_path: A temporary directory for the capture file.
+    :param client: A client for testing.
+    :param predict_instances: Mock short answer instances that do not have labels
+    """
+    capture_file = str(tmp_path / "traffic.jsonl")
+    capture.configure(capture_file)
+    try:
+        response = client.post(
+            "/predictFromAnswers",
+            json={"instances": predict_instances, "modelId": "test_pred_data"},
+        )
+    finally:
+        capture.configure(None)
+    assert response.status_code == 200
+
+    records = replay.load_records(capture_file)
+    assert [record["endpoint"] for record in records] == ["/predictFromAnswers"]
+    for captured, instance in zip(records[0]["body"]["instances"], predict_instances):
+        assert set(captured["answer"]) == {"hmac", "length"}
+        assert set(captured["learnerId"]) == {"hmac", "length"}
+        # The answer can not be looked up by its plain hash.
+        assert captured["answer"]["hmac"] != hashlib.sha256(
+            instance["answer"].encode()
+        ).hexdigest()
+
+    body = replay.PayloadFiller([]).fill(records[0]["body"])
+    for instance in body["instances"]:
+        assert instance["answer"] in instance["itemTargets"]
+    assert client.post("/predictFromAnswers", json=body).status_code == 200
@@ -1,9 +1,56 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
 
+import numpy as np
+import onnxruntime as rt
+import pandas as pd
+import textdistance
+
+import artifacts
+import shard_auth
+
+from features.data import ShortAnswerInstance
 from features.extractor import FeatureExtraction
+from features.feature_groups import SIMGroupExtractor
 from features import uima
+from admission import WorkPool
+from cas_loading import CasUsage
+from cas_loading import RecordingCas
+from cas_loading import SelectiveCasLoader
+from cas_loading import load_selected_cas_from_xmi
 from cassis.xmi import load_cas_from_xmi
 from collections import OrderedDict
+from distributed_cv import Coordinator
+from distributed_cv import Worker
+from distributed_cv import fit_fold
+from distributed_cv import important_columns
+from fastapi import HTTPException
+from feature_layout import FeatureLayout
+from feature_selection import FeatureSelection
+from io import BytesIO
+from model_selection import Candidate
+from model_selection import select_model
+from native_forest import PackedForest
+from shard_router import HashRing
+from shard_router import ShardRouter
+from similarity import BatchSIMGroupExtractor
+from sklearn.metrics import accuracy_score
+from sklearn.model_selection import StratifiedKFold
+from sklearn.svm import SVC
+from similarity import SIM_MEASURES
+from similarity import pair_similarities
+from skl2onnx import convert_sklearn
+from skl2onnx.common.data_types import FloatTensorType
+from sklearn.ensemble import RandomForestClassifier
+from training_data import FoldMatrices
+from training_data import fold_rows
+from training_data import training_matrix
+from training_data import unique_rows
 
 class ReadCASTestCase(unittest.TestCase):
     EXAMPLE_XMI_PATH = "testdata/xmi/1ET5_7_0.xmi"
@@ -20,6 +67,580 @@ class ReadCASTestCase(unittest.TestCase):
         self.assertIsInstance(feats, OrderedDict)
         self.assertEqual(len(extraction.extractors),
                          len(feats))
-        
+
+
+class SelectiveCASTestCase(unittest.TestCase):
+    EXAMPLE_XMI_PATHS = ["testdata/xmi/1ET5_7_0.xmi", "testdata/xmi/1ET5_6_79.xmi"]
+
+    def setUp(self):
+        self.isaac_ts = uima.load_isaac_ts()
+        self.extraction = FeatureExtraction()
+
+    def full_features(self, xmi_bytes):
+        cas = load_cas_from_xmi(BytesIO(xmi_bytes), typesystem=self.isaac_ts)
+        return self.extraction.from_cases([cas])
+
+    def test_selected_features_match_full_parse(self):
+        for path in self.EXAMPLE_XMI_PATHS:
+            with open(path, "rb") as f:
+                xmi_bytes = f.read()
+            full_cas = load_cas_from_xmi(BytesIO(xmi_bytes), typesystem=self.isaac_ts)
+            usage = CasUsage()
+            full_feats = self.extraction.from_cases([RecordingCas(full_cas, usage)])
+
+            cas = load_selected_cas_from_xmi(
+                BytesIO(xmi_bytes), self.isaac_ts, usage.views, usage.types
+            )
+            feats = self.extraction.from_cases([cas])
+
+            self.assertFalse(usage.everything)
+            self.assertEqual(list(full_feats.keys()), list(feats.keys()))
+            for name in full_feats:
+                np.testing.assert_allclose(feats[name], full_feats[name])
+
+    def test_loader_matches_full_parse(self):
+        loader = SelectiveCasLoader(self.isaac_ts, self.extraction)
+        # The first CAS is parsed fully, the following ones selectively.
+        for path in self.EXAMPLE_XMI_PATHS + self.EXAMPLE_XMI_PATHS:
+            with open(path, "rb") as f:
+                xmi_bytes = f.read()
+            feats = loader.extract(xmi_bytes)
+            full_feats = self.full_features(xmi_bytes)
+            self.assertEqual(list(full_feats.keys()), list(feats.keys()))
+            for name in full_feats:
+                np.testing.assert_allclose(feats[name], full_feats[name])
+
+    def test_feature_selection_matches_full_extraction(self):
+        selection = FeatureSelection(self.isaac_ts, self.extraction)
+        for path in self.EXAMPLE_XMI_PATHS:
+            with open(path, "rb") as f:
+                xmi_bytes = f.read()
+            full_feats = self.full_features(xmi_bytes)
+            model_columns = list(full_feats.keys())[:2]
+            loader = selection.loader(model_columns, xmi_bytes)
+            feats = loader.extract(xmi_bytes)
+            self.assertEqual(model_columns, list(feats.keys()))
+            for name in model_columns:
+                np.testing.assert_allclose(feats[name], full_feats[name])
+            # A model that uses every feature runs all extractors.
+            self.assertIsNone(selection.loader(list(full_feats.keys()), xmi_bytes))
+
+
+class BatchSimilarityTestCase(unittest.TestCase):
+    PAIRS = [
+        ("two", "two"),
+        ("two", "three"),
+        ("five", "four"),
+        ("", "six"),
+        ("", ""),
+        ("Photosynthesis", "photo synthesis"),
+        ("the water boils", "Water boils at 100 degrees"),
+        ("Hw shx", "wh czk"),
+    ]
+
+    def test_pairs_match_textdistance(self):
+        lefts, rights = zip(*self.PAIRS)
+        sims = pair_similarities(lefts, rights)
+
+        for row, (left, right) in enumerate(self.PAIRS):
+            for col, measure in enumerate(SIM_MEASURES):
+                expected = getattr(textdistance, measure)().normalized_similarity(
+                    left, right
+                )
+                self.assertAlmostEqual(sims[row, col], expected)
+
+    def test_extract_matches_sim_group_extractor(self):
+        instances = [
+            ShortAnswerInstance(
+                taskId=str(idx),
+                itemId=str(idx),
+                itemPrompt="mock_prompt",
+                itemTargets=["one", "two", "three", "four"],
+                learnerId=str(idx),
+                answer=answer,
+            )
+            for idx, answer in enumerate(["two", "fuor", "none of them"])
+        ]
+        expected = SIMGroupExtractor().extract(instances)
+        batched = BatchSIMGroupExtractor().extract(instances)
+
+        self.assertEqual(list(expected.columns), list(batched.columns))
+        np.testing.assert_allclose(batched.to_numpy(), expected.to_numpy())
+
+
+class FeatureLayoutTestCase(unittest.TestCase):
+    MODEL_COLUMNS = ["a", "b", "c_x", "c_y", "d", "e_True", "f", "h_1", "h_z", "j"]
+    COLUMNS = {
+        "a": [0.5, None, 2.0],
+        "b": [1, 2, 3],
+        "c": ["x", None, "z"],
+        "d": [np.nan, np.nan, 1.5],
+        "e": [True, None, True],
+        "f": [True, False, True],
+        "g": [1.0, 2.0, 3.0],
+        "h": ["z", 1, None],
+        "i": [None, None, None],
+    }
+
+    def pandas_query(self, data):
+        query = pd.get_dummies(data).reindex(columns=self.MODEL_COLUMNS, fill_value=0)
+        return query.to_numpy(dtype=np.float32)
+
+    def test_assemble_matches_pandas(self):
+        layout = FeatureLayout(self.MODEL_COLUMNS)
+        for rows in (slice(0, 1), slice(1, 2), slice(0, 3)):
+            features = OrderedDict((k, v[rows]) for k, v in self.COLUMNS.items())
+            expected = self.pandas_query(pd.DataFrame.from_dict(features))
+
+            for data in (features, pd.DataFrame.from_dict(features)):
+                query = layout.assemble(data)
+                self.assertEqual(query.dtype, np.float32)
+                np.testing.assert_array_equal(query, expected)
+
+
+class TrainingMatrixTestCase(unittest.TestCase):
+    DATA = pd.DataFrame(
+        {
+            "b": [0.5, None, 2.0, 1.0],
+            "a": [1, 2, 3, 4],
+            "c": ["x", None, "z", "x"],
+            "d": [True, False, True, True],
+        }
+    )
+
+    def test_matches_get_dummies(self):
+        df = self.DATA.copy()
+        df["b"] = df["b"].fillna(0)
+        expected = pd.get_dummies(df, columns=["c"], dummy_na=True)
+        expected = expected[expected.columns.difference(["Outcome"])]
+
+        x, columns = training_matrix(self.DATA)
+
+        self.assertEqual(columns, list(expected.columns))
+        self.assertEqual(x.dtype, np.float32)
+        np.testing.assert_array_equal(x, expected.to_numpy(dtype=np.float32))
+
+    def test_folds_match_rows(self):
+        x, _ = training_matrix(self.DATA, ["a", "b"], fill_na=False)
+        extra = np.arange(8, dtype=np.float32).reshape(4, 2)
+        folds = FoldMatrices(x, extra)
+
+        for train_ids, test_ids in (([0, 2], [1, 3]), ([1, 2, 3], [0])):
+            x_train, x_test = folds.split(np.array(train_ids), np.array(test_ids))
+            full = np.hstack([x, extra])
+            np.testing.assert_array_equal(x_train, full[train_ids])
+            np.testing.assert_array_equal(x_test, full[test_ids])
+            self.assertTrue(x_train.flags["C_CONTIGUOUS"])
+
+    def test_folds_reuse_buffer(self):
+        x, _ = training_matrix(self.DATA, ["a", "b"], fill_na=False)
+        folds = FoldMatrices(x, n_columns=5)
+        buffer = folds.buffer
+
+        for width in (1, 3):
+            extra = np.arange(4 * width, dtype=np.float32).reshape(4, width)
+            folds.set_blocks(x, extra)
+            x_train, x_test = folds.split(np.array([0, 2]), np.array([1, 3]))
+            np.testing.assert_array_equal(x_test, np.hstack([x, extra])[[1, 3]])
+        self.assertIs(folds.buffer, buffer)
+
+        # A row can be in the training and the test rows.
+        x_train, x_test = folds.split(np.array([0, 1, 2, 3]), np.array([1, 2]))
+        np.testing.assert_array_equal(x_train, np.hstack([x, extra]))
+        np.testing.assert_array_equal(x_test, np.hstack([x, extra])[[1, 2]])
+
+    def test_duplicates_become_weights(self):
+        keys = [("1", "two", 1), ("2", "five", 2), ("1", "two", 1), ("1", "two", 2)]
+        first_rows, inverse = unique_rows(keys)
+        np.testing.assert_array_equal(first_rows, [0, 1, 3])
+        np.testing.assert_array_equal(inverse, [0, 1, 0, 2])
+
+        rows, weights = fold_rows(inverse, np.array([0, 2, 3]), len(first_rows))
+        np.testing.assert_array_equal(rows, [0, 2])
+        np.testing.assert_array_equal(weights, [2.0, 1.0])
+
+
+class WorkPoolTestCase(unittest.TestCase):
+    def test_rejects_when_saturated(self):
+        pool = WorkPool("test", workers=1, queue_size=1, per_model=1)
+        release = threading.Event()
+
+        async def scenario():
+            running = [
+                asyncio.ensure_future(pool.run(model_id, release.wait))
+                for model_id in ("a", "b")
+            ]
+            await asyncio.sleep(0.1)
+            self.assertEqual(pool.metrics()["running"], 1)
+            self.assertEqual(pool.metrics()["queued"], 1)
+
+            with self.assertRaises(HTTPException) as full:
+                await pool.run("c", release.wait)
+            self.assertEqual(full.exception.status_code, 503)
+
+            release.set()
+            await asyncio.gather(*running)
+            release.clear()
+
+            blocked = asyncio.ensure_future(pool.run("a", release.wait))
+            await asyncio.sleep(0.1)
+            with self.assertRaises(HTTPException) as per_model:
+                await pool.run("a", release.wait)
+            self.assertEqual(per_model.exception.status_code, 429)
+            release.set()
+            await blocked
+
+        asyncio.run(scenario())
+        metrics = pool.metrics()
+        self.assertEqual(metrics["completed"], 3)
+        self.assertEqual(metrics["rejected_full"], 1)
+        self.assertEqual(metrics["rejected_model"], 1)
+        self.assertEqual(metrics["queued"] + metrics["running"], 0)
+
+    def test_several_models_count_against_each_limit(self):
+        pool = WorkPool("test", workers=2, queue_size=2, per_model=1)
+        release = threading.Event()
+
+        async def scenario():
+            blocked = asyncio.ensure_future(pool.run(["a", "b", "a"], release.wait))
+            await asyncio.sleep(0.1)
+            self.assertEqual(pool.metrics()["models"], {"a": 1, "b": 1})
+            # The order of the models does not matter.
+            for model_ids in (["b", "a"], ["c", "b"], "a"):
+                with self.assertRaises(HTTPException) as per_model:
+                    await pool.run(model_ids, release.wait)
+                self.assertEqual(per_model.exception.status_code, 429)
+            # A rejected request does not count against its other models.
+            self.assertEqual(pool.metrics()["models"], {"a": 1, "b": 1})
+            release.set()
+            await blocked
+
+        asyncio.run(scenario())
+        self.assertEqual(pool.metrics()["models"], {})
+
+
+class PackedForestTestCase(unittest.TestCase):
+    MODEL_PATHS = ["onnx_models/default.onnx", "onnx_models/test_pred_data.onnx"]
+
+    def test_probabilities_match_onnxruntime(self):
+        random = np.random.RandomState(0)
+        for model_path in self.MODEL_PATHS:
+            session = rt.InferenceSession(model_path)
+            forest = PackedForest.from_onnx(model_path)
+            for batch_size in (1, 7, 500):
+                x = random.rand(batch_size, 11).astype(np.float32)
+                x[random.rand(*x.shape) < 0.05] = np.nan
+                expected = session.run(
+                    [session.get_outputs()[1].name], {session.get_inputs()[0].name: x}
+                )[0]
+                actual = forest.run(x)
+                self.assertEqual(len(actual), batch_size)
+                for expected_probs, actual_probs in zip(expected, actual):
+                    self.assertEqual(expected_probs.keys(), actual_probs.keys())
+                    for label, probability in expected_probs.items():
+                        self.assertAlmostEqual(actual_probs[label], probability, places=6)
+
+
+class DistributedCVTestCase(unittest.TestCase):
+    def test_folds_on_local_workers(self):
+        random = np.random.RandomState(0)
+        x = random.rand(60, 4).astype(np.float32)
+        y = (x[:, 0] > 0.5).astype(int)
+        splits = list(StratifiedKFold(n_splits=3, shuffle=True, random_state=2).split(x, y))
+
+        authkey = b"test-key"
+        workers = [Worker(authkey=authkey) for _ in range(2)]
+        for worker in workers:
+            threading.Thread(target=worker.serve_forever, daemon=True).start()
+        # A worker that is not running, its folds go to the other workers.
+        unreachable = Worker(authkey=authkey)
+        unreachable.close()
+        try:
+            coordinator = Coordinator(
+                [worker.address for worker in workers] + [unreachable.address],
+                authkey=authkey,
+                retries=1,
+            )
+            results = coordinator.run_folds(x, y, splits)
+        finally:
+            for worker in workers:
+                worker.close()
+
+        self.assertEqual([result.fold for result in results], [0, 1, 2])
+        for result, (_, test_ids) in zip(results, splits):
+            self.assertEqual(
+                result.accuracy, accuracy_score(y[test_ids], result.model.predict(x[test_ids]))
+            )
+            self.assertIn("cohens_kappa", result.metrics)
+
+    def test_pruning_uses_training_rows(self):
+        random = np.random.RandomState(0)
+        x = random.rand(60, 6).astype(np.float32)
+        y = (x[:, 0] > 0.5).astype(int)
+        train_ids, test_ids = np.arange(40), np.arange(40, 60)
+
+        result = fit_fold(
+            0, x[train_ids], y[train_ids], x[test_ids], y[test_ids], importance_threshold=0.3
+        )
+
+        np.testing.assert_array_equal(
+            result.columns, important_columns(x[train_ids], y[train_ids], 0.3)
+        )
+        self.assertIn(0, result.columns)
+        self.assertLess(len(result.columns), 6)
+        self.assertEqual(result.model.estimators_[0].tree_.n_features, len(result.columns))
+
+    def test_no_authkey_is_refused(self):
+        with self.assertRaises(ValueError):
+            Worker(authkey=b"")
+        with self.assertRaises(ValueError):
+            Coordinator([("localhost", 7001)], authkey=b"")
+
+
+class ArtifactsTestCase(unittest.TestCase):
+    def test_write_atomic_replaces_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "model.onnx")
+            artifacts.write_atomic(path, b"old")
+            artifacts.write_atomic(path, b"new")
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"new")
+            # No temporary files are left.
+            self.assertEqual(os.listdir(directory), ["model.onnx"])
+
+    def test_bundle_is_loaded_from_bytes(self):
+        random = np.random.RandomState(0)
+        x = random.rand(40, 3).astype(np.float32)
+        y = (x[:, 0] > 0.5).astype(int)
+        clf = RandomForestClassifier(n_estimators=3, random_state=0).fit(x, y)
+        initial_type = [("float_input", FloatTensorType([None, 3]))]
+        clf_onnx = convert_sklearn(clf, initial_types=initial_type, target_opset=12)
+        metrics = {"accuracy": {"value": 1.0}}
+        bow_state = {"bag": ["four", "five"]}
+
+        model_bytes = artifacts.bundle(
+            clf_onnx, ["a", "b", "c"], metrics, bow_state, version="1"
+        )
+        metadata = rt.InferenceSession(model_bytes).get_modelmeta().custom_metadata_map
+        self.assertEqual(metadata[artifacts.MODEL_COLUMNS], "a b c")
+        self.assertEqual(metadata[artifacts.MODEL_VERSION], "1")
+        self.assertEqual(json.loads(metadata[artifacts.METRICS]), metrics)
+        self.assertEqual(json.loads(metadata[artifacts.BOW]), bow_state)
+
+
+class HashRingTestCase(unittest.TestCase):
+    NODES = ["http://localhost:9001", "http://localhost:9002", "http://localhost:9003"]
+    MODEL_IDS = ["model-{}".format(i) for i in range(1000)]
+
+    def test_models_are_spread(self):
+        ring = HashRing(self.NODES)
+        owners = [ring.owner(model_id) for model_id in self.MODEL_IDS]
+        for node in self.NODES:
+            self.assertGreater(owners.count(node), len(self.MODEL_IDS) / 6)
+        # The owners do not depend on the order of the nodes.
+        self.assertEqual(owners, [HashRing(self.NODES[::-1]).owner(m) for m in self.MODEL_IDS])
+
+    def test_join_only_moves_models_to_new_node(self):
+        ring = HashRing(self.NODES)
+        joined = ring.with_node("http://localhost:9004")
+        moved = [m for m in self.MODEL_IDS if ring.owner(m) != joined.owner(m)]
+        self.assertLess(len(moved), len(self.MODEL_IDS) / 2)
+        for model_id in moved:
+            self.assertEqual(joined.owner(model_id), "http://localhost:9004")
+        # Leaving again restores the previous owners.
+        left = joined.without_node("http://localhost:9004")
+        self.assertEqual(
+            [ring.owner(m) for m in self.MODEL_IDS], [left.owner(m) for m in self.MODEL_IDS]
+        )
+
+
+class FakeNodeResponse:
+    def __init__(self, content: bytes = b"", json_body=None):
+        self.content = content
+        self.json_body = json_body
+        self.status_code = 200
+        self.headers = {}
+
+    def json(self):
+        return self.json_body
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeNode:
+    """The /models endpoints of an instance, with models as bytes."""
+
+    AUTHKEY = "test-key"
+
+    def __init__(self, url: str, models: dict = None):
+        self.url = url
+        self.models = dict(models or {})
+        # Set when a training was forwarded, which then waits for release.
+        self.training_started = threading.Event()
+        self.release_training = threading.Event()
+        self.release_training.set()
+
+    def model_id(self, url: str) -> str:
+        return url[len(self.url + "/models/"):]
+
+    def check_key(self, headers):
+        if (headers or {}).get(shard_auth.HEADER) != self.AUTHKEY:
+            raise AssertionError("The shard key is missing or wrong.")
+
+    def get(self, url, headers=None, timeout=None):
+        self.check_key(headers)
+        if url == self.url + "/models":
+            return FakeNodeResponse(json_body={"models": {m: "1" for m in self.models}})
+        return FakeNodeResponse(self.models[self.model_id(url)])
+
+    def put(self, url, data=None, headers=None, timeout=None):
+        self.check_key(headers)
+        self.models[self.model_id(url)] = data
+        return FakeNodeResponse(json_body={"modelId": self.model_id(url), "version": "1"})
+
+    def delete(self, url, headers=None, timeout=None):
+        self.check_key(headers)
+        del self.models[self.model_id(url)]
+        return FakeNodeResponse()
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        self.training_started.set()
+        self.release_training.wait()
+        self.models[json.loads(data)["modelId"]] = b"trained"
+        return FakeNodeResponse()
+
+
+class ShardRouterTestCase(unittest.TestCase):
+    def test_rebalance_on_join_and_leave(self):
+        model_ids = ["model-{}".format(i) for i in range(50)]
+        first = FakeNode("http://a", {m: m.encode() for m in model_ids})
+        second = FakeNode("http://b")
+        router = ShardRouter([first.url], authkey=FakeNode.AUTHKEY)
+        router.sessions = {first.url: first, second.url: second}
+
+        moves = router.join(second.url)
+
+        self.assertEqual(router.ring.nodes, [first.url, second.url])
+        self.assertTrue(moves)
+        for node in (first, second):
+            for model_id, model in node.models.items():
+                self.assertEqual(router.ring.owner(model_id), node.url)
+                self.assertEqual(model, model_id.encode())
+        self.assertEqual(sorted(list(first.models) + list(second.models)), sorted(model_ids))
+
+        router.leave(second.url)
+
+        self.assertEqual(sorted(first.models), sorted(model_ids))
+        self.assertEqual(router.shard_map()["owners"], {m: first.url for m in model_ids})
+
+    def test_rebalance_waits_for_training(self):
+        first = FakeNode("http://a")
+        second = FakeNode("http://b")
+        model_id = next(
+            "model-{}".format(i)
+            for i in range(100)
+            if HashRing([first.url, second.url]).owner("model-{}".format(i)) == second.url
+        )
+        first.models[model_id] = b"old"
+        first.release_training.clear()
+        self.addCleanup(first.release_training.set)
+        router = ShardRouter([first.url], authkey=FakeNode.AUTHKEY)
+        router.sessions = {first.url: first, second.url: second}
+
+        body = json.dumps({"modelId": model_id}).encode()
+        training = threading.Thread(target=router.forward, args=("/train", model_id, body))
+        training.start()
+        first.training_started.wait()
+        join = threading.Thread(target=router.join, args=(second.url,))
+        join.start()
+        # The model is not moved while it is trained on its previous owner.
+        join.join(0.2)
+        self.assertTrue(join.is_alive())
+        self.assertNotIn(model_id, second.models)
+
+        first.release_training.set()
+        training.join()
+        join.join()
+
+        # The new version is moved, not deleted.
+        self.assertEqual(second.models, {model_id: b"trained"})
+        self.assertEqual(first.models, {})
+        self.assertEqual(router.blocked, set())
+
+    def test_no_moves_without_authkey(self):
+        first = FakeNode("http://a", {"model-{}".format(i): b"" for i in range(10)})
+        second = FakeNode("http://b")
+        router = ShardRouter([first.url], authkey="")
+        router.sessions = {first.url: first, second.url: second}
+
+        with self.assertRaises(ValueError):
+            router.join(second.url)
+        self.assertEqual(router.ring.nodes, [first.url])
+        self.assertEqual(second.models, {})
+
+
+class ModelSelectionTestCase(unittest.TestCase):
+    CANDIDATES = [
+        Candidate(RandomForestClassifier, {"n_estimators": 5, "max_depth": 2}),
+        Candidate(RandomForestClassifier, {"n_estimators": 10, "max_depth": None}),
+        Candidate(SVC, {"gamma": "scale", "probability": True}),
+    ]
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        self.x = random.rand(300, 4).astype(np.float32)
+        self.y = (self.x[:, 0] > 0.5).astype(int)
+        self.splits = list(
+            StratifiedKFold(n_splits=3, shuffle=True, random_state=2).split(self.x, self.y)
+        )
+
+    def test_successive_halving(self):
+        results, report = select_model(
+            self.x, self.y, self.splits, budget=600, candidates=self.CANDIDATES
+        )
+        self.assertTrue(report["full_cv"])
+        self.assertEqual(len(results), len(self.splits))
+        self.assertIn(report["chosen"], [candidate.name for candidate in self.CANDIDATES])
+        # All candidates are evaluated on a third of the rows, one with all.
+        for candidate in self.CANDIDATES:
+            rounds = report["candidates"][candidate.name]["rounds"]
+            self.assertAlmostEqual(rounds[0]["fraction"], 1 / 3)
+            self.assertGreater(report["candidates"][candidate.name]["time"], 0)
+        self.assertEqual(len(report["candidates"][report["chosen"]]["rounds"]), 2)
+
+    def test_no_budget_evaluates_one_candidate(self):
+        results, report = select_model(
+            self.x, self.y, self.splits, budget=0, candidates=self.CANDIDATES
+        )
+        self.assertFalse(report["full_cv"])
+        self.assertEqual(report["chosen"], self.CANDIDATES[0].name)
+        self.assertEqual(len(results), len(self.splits))
+        # The chosen candidate is still fitted on all training rows.
+        rounds = report["candidates"][report["chosen"]]["rounds"]
+        self.assertEqual([r["fraction"] for r in rounds], [1 / 3, 1.0])
+
+    def test_probe_skips_slow_candidate(self):
+        class SlowSVC(SVC):
+            """An SVC whose fitting time grows with the square of the rows."""
+
+            def fit(self, x, y, sample_weight=None):
+                time.sleep(len(x) ** 2 * 1e-5)
+                return super().fit(x, y, sample_weight)
+
+        random = np.random.RandomState(0)
+        x = random.rand(900, 4).astype(np.float32)
+        y = (x[:, 0] > 0.5).astype(int)
+        splits = list(StratifiedKFold(n_splits=3, shuffle=True, random_state=2).split(x, y))
+        fast, slow = self.CANDIDATES[0], Candidate(SlowSVC, {"gamma": "scale"})
+
+        # The SVC would take about 1.2 seconds on a third of the rows.
+        results, report = select_model(x, y, splits, budget=0.5, candidates=[fast, slow])
+
+        self.assertEqual(report["chosen"], fast.name)
+        self.assertEqual(report["candidates"][slow.name]["rounds"], [])
+        self.assertLess(report["candidates"][slow.name]["time"], 0.2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,180 @@
+"""
+Compact training matrices.
+
+The training data is turned into one contiguous float32 matrix instead of a
+chain of float64 DataFrame copies (selection, fillna, get_dummies, column
+sorting). Large matrices are memory-mapped from a temporary file, so they do
+not have to fit into memory at once.
+
+scikit-learn copies every input that is not a C-contiguous float32 array, and
+numpy cannot take a view of an arbitrary set of rows. FoldMatrices therefore
+gathers the training and test rows of a fold into one buffer that is reused
+for all folds and that scikit-learn can use without another copy. The buffer
+is only allocated again if a fold needs more space, e.g. for a wider bag of
+words. The peak memory of a training is about twice the size of the float32
+matrix.
+"""
+import os
+import tempfile
+
+import numpy as np
+
+from pandas.api.types import is_numeric_dtype
+from pandas.core.frame import DataFrame
+from typing import Hashable
+from typing import List
+from typing import Tuple
+
+# Matrices larger than this (in bytes) are memory-mapped from a temporary
+# file in MMAP_DIR (the default temporary directory if not set).
+MMAP_THRESHOLD = int(os.environ.get("TRAINING_MMAP_THRESHOLD", 256 * 2 ** 20))
+MMAP_DIR = os.environ.get("TRAINING_MMAP_DIR")
+
+# The dummy value of the column for missing values.
+_MISSING = object()
+
+
+def allocate(n_rows: int, n_columns: int) -> np.ndarray:
+    """Allocate a zeroed C-contiguous float32 matrix, memory-mapped if large."""
+    if n_rows * n_columns * 4 <= MMAP_THRESHOLD:
+        return np.zeros((n_rows, n_columns), dtype=np.float32)
+    # The file is deleted right away, the mapping keeps the data alive.
+    with tempfile.TemporaryFile(dir=MMAP_DIR) as mmap_file:
+        return np.memmap(
+            mmap_file, dtype=np.float32, mode="w+", shape=(n_rows, n_columns)
+        )
+
+
+def training_matrix(
+    df: DataFrame, columns: List[str] = None, fill_na: bool = True
+) -> Tuple[np.ndarray, List[str]]:
+    """
+    Write the features of a DataFrame into a float32 matrix.
+
+    Columns that are not numeric are one-hot encoded with a dummy for missing
+    values and the columns are sorted by name, the same as
+    pd.get_dummies(df, columns=categoricals, dummy_na=True) followed by
+    selecting df.columns.difference([...]) did.
+
+    :param df: The features.
+    :param columns: The columns of df to use (default: all of them).
+    :param fill_na: Whether missing numeric values are replaced by 0.
+    :return: The matrix and its column names.
+    """
+    # (matrix column, source column, dummy value or None for numeric columns)
+    matrix_columns = []
+    for name in df.columns if columns is None else columns:
+        values = df[name]
+        if is_numeric_dtype(values.dtype):
+            matrix_columns.append((name, name, None))
+            continue
+        for level in values.dropna().unique():
+            matrix_columns.append(("{}_{}".format(name, level), name, level))
+        matrix_columns.append(("{}_nan".format(name), name, _MISSING))
+    matrix_columns.sort(key=lambda column: column[0])
+
+    x = allocate(df.shape[0], len(matrix_columns))
+    for j, (_, name, level) in enumerate(matrix_columns):
+        values = df[name]
+        if level is None:
+            column = x[:, j]
+            column[:] = values.to_numpy(dtype=np.float32)
+            if fill_na:
+                column[np.isnan(column)] = 0.0
+        elif level is _MISSING:
+            x[:, j] = values.isna().to_numpy()
+        else:
+            x[:, j] = (values == level).to_numpy()
+    return x, [name for name, _, _ in matrix_columns]
+
+
+class FoldMatrices:
+    """
+    Training and test rows of cross-validation folds in one reused buffer.
+
+    :param blocks: Matrices with the same rows whose columns are put next to
+        each other, like the similarity and the bag of words features.
+    :param n_columns: The number of columns to allocate the buffer for, if
+        later blocks (see set_blocks) may have more columns than these.
+    """
+
+    def __init__(self, *blocks: np.ndarray, n_columns: int = 0):
+        self.n_rows = blocks[0].shape[0]
+        self.set_blocks(*blocks)
+        # The buffer is flat, so that it can hold matrices of any width.
+        self.buffer = allocate(self.n_rows, max(n_columns, self.n_columns)).ravel()
+
+    def set_blocks(self, *blocks: np.ndarray):
+        """
+        Gather the rows of other blocks from now on, like the bag of words
+        features of the next fold. The blocks have the rows of the first ones.
+        """
+        self.blocks = blocks
+        self.n_columns = sum(block.shape[1] for block in blocks)
+
+    def _take(self, ids: np.ndarray, out: np.ndarray) -> np.ndarray:
+        start = 0
+        for block in self.blocks:
+            end = start + block.shape[1]
+            if len(self.blocks) == 1:
+                np.take(block, ids, axis=0, out=out)
+            else:
+                out[:, start:end] = np.take(block, ids, axis=0)
+            start = end
+        return out
+
+    def split(
+        self, train_ids: np.ndarray, test_ids: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Gather the rows of a fold. The matrices are only valid until the next
+        call.
+
+        :return: The training and the test matrix.
+        """
+        n_train = len(train_ids)
+        # A row can be in both, if rows stand for several identical instances
+        # (see fold_rows).
+        size = (n_train + len(test_ids)) * self.n_columns
+        if size > self.buffer.size:
+            self.buffer = allocate(n_train + len(test_ids), self.n_columns).ravel()
+        matrix = self.buffer[:size].reshape(-1, self.n_columns)
+        x_train = self._take(train_ids, matrix[:n_train])
+        x_test = self._take(test_ids, matrix[n_train:])
+        return x_train, x_test
+
+
+def unique_rows(keys: List[Hashable]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the distinct rows of a training set.
+
+    :param keys: A key per row, rows with the same key are identical.
+    :return: The index of the first row of every distinct key and, for every
+        row, the number of its distinct row.
+    """
+    distinct = {}
+    first_rows = []
+    inverse = np.empty(len(keys), dtype=np.intp)
+    for i, key in enumerate(keys):
+        if key not in distinct:
+            distinct[key] = len(first_rows)
+            first_rows.append(i)
+        inverse[i] = distinct[key]
+    return np.array(first_rows, dtype=np.intp), inverse
+
+
+def fold_rows(
+    inverse: np.ndarray, ids: np.ndarray, n_distinct: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Map the rows of a fold to distinct rows.
+
+    :param inverse: The distinct row of every row, from unique_rows.
+    :param ids: The rows of the fold.
+    :param n_distinct: The number of distinct rows.
+    :return: The distinct rows in the fold and how often each of them is in
+        it, as sample weights.
+    """
+    counts = np.bincount(inverse[ids], minlength=n_distinct)
+    rows = np.flatnonzero(counts)
+    return rows, counts[rows].astype(np.float64)